@@ -27,7 +27,10 @@ class Actions:
         except FileNotFoundError:
             self.db = MemNRDB()
 
-        self.users = self.db.init_table('users', convert=True, convert_exclude=["bdate"])
+        intern = ["university_name", "faculty_name", "cost"]
+        self.users = self.db.init_table('users', convert=True, convert_exclude=["bdate"], intern=intern)
+        # у таблицы из старого снимка пула строк ещё нет
+        self.users.intern_fields(intern)
 
         self.log = logging.getLogger("Actions")
 
@@ -52,13 +55,14 @@ class Actions:
             total = 0
             for ids in group.get_members(self.api):
                 print_line("Total: {}; {} users coming, processing... ".format(total, len(ids)))
-                for user in self.api.get_users(ids):
+                users = list(self.api.get_users(ids))
+                for user in users:
                     user.cost["group_{}".format(group_name)] = cost
-                    user.load_to(self.users)
+                User.load_many_to(self.users, users)
                 total += len(ids)
             print()
             print("Group {} done! Saving...".format(group_name))
-            self.db.serialize("db.json")
+            self.db.serialize("db.json", journal=True)
             print("Saved")
         end = time.time()
         print("==========================")
@@ -66,15 +70,30 @@ class Actions:
         print("{:.2f} sec".format(end - start))
         print("Avg speed: {:.2f} users/sec".format(len(self.users) / (end- start)))
 
+    def db_stats(self):
+        print("Database memory usage (estimated)")
+        stats = self.db.stats()
+        for name, table in stats["tables"].items():
+            print("==========================")
+            print("{}: {} rows, {:.1f} MB ({})".format(name, table["rows"], table["bytes"] / 2 ** 20, table["storage"]))
+            for field, field_stats in table["fields"].items():
+                print("  {}: {} rows, {:.1f} KB".format(field, field_stats["rows"], field_stats["bytes"] / 2 ** 10))
+            for field, index in table["indexes"].items():
+                print("  index {} ({}): {} entries, {:.1f} KB".format(
+                    field, index["kind"], index["entries"], index["bytes"] / 2 ** 10
+                ))
+
     def set_cost(self):
         print("Set costs to users")
 
         count = 0
-        users_len = len(self.users)
-        for user in self.users.rows(to_class=User):
-            count += 1
-            print_line("{}/{}: {}".format(count, users_len, str(user)))
-            user_cost_setter(user)
+        # загрузка может продолжаться в другом потоке -- читаем согласованный снимок
+        with self.users.snapshot() as snapshot:
+            users_len = len(snapshot)
+            for user in snapshot.rows(to_class=User):
+                count += 1
+                print_line("{}/{}: {}".format(count, users_len, str(user)))
+                user_cost_setter(user)
 
     def online_mode(self):
         start = time.time()
@@ -82,31 +101,33 @@ class Actions:
         print("===============================")
         user_count = 0
         users = []
-        for user in self.users.rows(to_class=User):  # type: User
-            user_count += 1
-            users.append(user)
-            if 25 == len(users):
-                for cur_user, dt, text, likes, reposts in self.api.get_wall_posts(users, 2, start):
-                    print("{}:".format(str(cur_user)))
-                    print(" {}; {}/{}".format(
-                        datetime.datetime.fromtimestamp(
-                            int(dt)
-                        ).strftime('%d.%m.%Y %H:%M:%S'),
-                        likes,
-                        reposts
+        # загрузка может продолжаться в другом потоке -- читаем согласованный снимок
+        with self.users.snapshot() as snapshot:
+            for user in snapshot.rows(to_class=User):  # type: User
+                user_count += 1
+                users.append(user)
+                if 25 == len(users):
+                    for cur_user, dt, text, likes, reposts in self.api.get_wall_posts(users, 2, start):
+                        print("{}:".format(str(cur_user)))
+                        print(" {}; {}/{}".format(
+                            datetime.datetime.fromtimestamp(
+                                int(dt)
+                            ).strftime('%d.%m.%Y %H:%M:%S'),
+                            likes,
+                            reposts
+                        ))
+                        print(" {}".format(text))
+                        print("-------------------------------")
+                    self.log.debug("{} by {:.2f} sec, {:.2f} user/sec ({}...{})".format(
+                        user_count,
+                        time.time() - start,
+                        user_count / (time.time() - start),
+                        users[0],
+                        users[-1]
                     ))
-                    print(" {}".format(text))
-                    print("-------------------------------")
-                self.log.debug("{} by {:.2f} sec, {:.2f} user/sec ({}...{})".format(
-                    user_count,
-                    time.time() - start,
-                    user_count / (time.time() - start),
-                    users[0],
-                    users[-1]
-                ))
 
-                # time.sleep(1)
-                users = []
+                    # time.sleep(1)
+                    users = []
 
 
 def user_cost_setter(user: User):
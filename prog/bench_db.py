@@ -0,0 +1,365 @@
+"""
+Замеры производительности MemNRDB на синтетических пользователях VK.
+
+Для каждого размера таблицы (по умолчанию 10k, 100k и 1M записей) замеряются
+вставка (insert, insert_many), ins_upd, запросы Query.all с простым и составным
+фильтром (без индексов и с индексами), преобразование записей в Row,
+serialize и load (JSON и бинарный снимок). Каждый замер повторяется repeat раз
+на свежих данных; данные генерируются из seed, так что прогоны воспроизводимы.
+Результат -- JSON, который можно сравнить с прогоном на другом коммите:
+
+    python -m prog.bench_db --sizes 10000 100000 --output new.json
+    python -m prog.bench_db --compare old.json new.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from prog.mem_nr_db import MemNRDB, Query, Row, Table
+
+SIZES = [10000, 100000, 1000000]
+REPEAT = 3
+# Замедление (в долях), начиная с которого --compare считает замер регрессией
+THRESHOLD = 0.1
+
+# Таблица пользователей -- с теми же параметрами, что и в prog/actions.py
+TABLE_SETTINGS = {
+    "convert": True,
+    "convert_exclude": ["bdate"],
+    "intern": ["university_name", "faculty_name", "cost"],
+}
+
+U = Query("users")
+QUERIES = {
+    "simple": U.university == 671,
+    "compound": ((U.university == 671) & (U.graduation >= 2015) & (U.graduation < 2020))
+                | ((U.sex == 1) & (U.city == 99)),
+}
+
+
+class UserGenerator:
+    """
+    Синтетические пользователи VK в том виде, в котором их возвращает users.get
+    (с полями university, faculty, graduation, city, bdate) и с cost, как после
+    load_from_groups. Одинаковый seed -- одинаковые пользователи.
+
+    >>> users = UserGenerator(seed=1).users(2)
+    >>> [user['id'] for user in users]
+    [1, 2]
+    >>> users == UserGenerator(seed=1).users(2)
+    True
+    """
+    FIRST_NAMES = {
+        1: ["Анна", "Мария", "Екатерина", "Ольга", "Дарья", "Анастасия", "Юлия", "Полина"],
+        2: ["Александр", "Дмитрий", "Сергей", "Иван", "Алексей", "Максим", "Никита", "Андрей"],
+    }
+    LAST_NAMES = ["Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов",
+                  "Новиков", "Фёдоров", "Морозов", "Волков", "Лебедев", "Козлов", "Степанов", "Николаев"]
+    # id университета -> (название, {id факультета: название})
+    UNIVERSITIES = {
+        671: ("НГУ", {12345: "Факультет информационных технологий", 12346: "Механико-математический факультет",
+                      12347: "Физический факультет", 12348: "Гуманитарный институт"}),
+        672: ("НГТУ", {22345: "Факультет автоматики и вычислительной техники", 22346: "Физико-технический факультет"}),
+        1099: ("ТГУ", {32345: "Исторический факультет", 32346: "Факультет прикладной математики и кибернетики"}),
+        1002: ("СибГУТИ", {42345: "Факультет информатики и вычислительной техники"}),
+    }
+    GROUPS = ["group_nsu", "group_fit", "group_mmf", "group_ff", "group_gi", "group_nsu24"]
+    CITIES = [99, 1, 2, 144, 650]
+
+    def __init__(self, seed: int=0):
+        self.random = random.Random(seed)
+
+    def user(self, _id: int) -> dict:
+        """ Пользователь с заданным id """
+        rnd = self.random
+        sex = rnd.choice((1, 2))
+        last_name = rnd.choice(self.LAST_NAMES) + ("а" if 1 == sex else "")
+        user = {
+            "id": _id,
+            "first_name": rnd.choice(self.FIRST_NAMES[sex]),
+            "last_name": last_name,
+            "sex": sex,
+            "city": rnd.choice(self.CITIES),
+            "cost": {group: round(rnd.random(), 2) for group in rnd.sample(self.GROUPS, rnd.randint(1, 3))},
+        }
+        if rnd.random() < 0.7:
+            # год рождения указан не у всех
+            user["bdate"] = "{}.{}.{}".format(rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(1970, 2002)) \
+                if rnd.random() < 0.6 else "{}.{}".format(rnd.randint(1, 28), rnd.randint(1, 12))
+        if rnd.random() < 0.6:
+            university = rnd.choice(list(self.UNIVERSITIES))
+            university_name, faculties = self.UNIVERSITIES[university]
+            faculty = rnd.choice(list(faculties))
+            user.update({
+                "university": university,
+                "university_name": university_name,
+                "faculty": faculty,
+                "faculty_name": faculties[faculty],
+                "graduation": rnd.randint(1990, 2024),
+            })
+        return user
+
+    def users(self, count: int, start: int=1) -> List[dict]:
+        """ count пользователей с id от start подряд """
+        return [self.user(_id) for _id in range(start, start + count)]
+
+
+def _timed(func) -> float:
+    """
+    Время выполнения func (сборщик мусора выключен, как в timeit).
+    Результат func освобождается уже после замера
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        del result
+        return elapsed
+    finally:
+        gc.enable()
+
+
+def _filled_table(rows: List[dict]) -> Table:
+    table = Table("users", **TABLE_SETTINGS)
+    table.insert_many(rows)
+    return table
+
+
+class Benchmark:
+    """ Прогон замеров для одного размера таблицы """
+    BENCHMARKS = ("bench_insert", "bench_ins_upd", "bench_queries", "bench_snapshots")
+
+    def __init__(self, size: int, repeat: int=REPEAT, seed: int=0, directory: str or None=None):
+        """
+        :param size: число записей
+        :param repeat: сколько раз повторять каждый замер
+        :param seed: seed генератора пользователей
+        :param directory: каталог для снимков (по умолчанию -- временный)
+        """
+        self.size = size
+        self.repeat = repeat
+        self.seed = seed
+        self.directory = directory
+        self.results = []  # type: List[dict]
+
+    def _users(self, count: int or None=None, start: int=1) -> List[dict]:
+        return UserGenerator(self.seed + start).users(self.size if count is None else count, start)
+
+    def _record(self, name: str, runs: List[float], rows: int, **extra):
+        result = {
+            "name": name,
+            "rows": self.size,
+            "runs": runs,
+            "min": min(runs),
+            "median": statistics.median(runs),
+            "rows_per_sec": rows / max(min(runs), 1e-9),
+        }
+        result.update(extra)
+        self.results.append(result)
+        return result
+
+    def _measure(self, name: str, setup, run, rows: int or None=None, **extra) -> dict:
+        """
+        Замерить run(setup()) repeat раз; setup не входит в замер
+        :param rows: сколько записей обрабатывает один прогон (по умолчанию -- size)
+        """
+        runs = []
+        for _ in range(self.repeat):
+            state = setup()
+            runs.append(_timed(lambda: run(state)))
+            del state
+        return self._record(name, runs, self.size if rows is None else rows, **extra)
+
+    def run(self, log=None) -> List[dict]:
+        """
+        Выполнить все замеры
+        :param log: файл для вывода хода замеров (None -- без вывода)
+        """
+        for name in self.BENCHMARKS:
+            start = len(self.results)
+            getattr(self, name)()
+            if log is not None:
+                for result in self.results[start:]:
+                    print("{:>8} {:<24} {:9.3f} s {:12.0f} rows/s".format(
+                        self.size, result["name"], result["min"], result["rows_per_sec"]), file=log)
+        return self.results
+
+    def bench_insert(self):
+        def insert(rows: List[dict]) -> Table:
+            table = Table("users", **TABLE_SETTINGS)
+            for row in rows:
+                table.insert(row)
+            return table
+
+        self._measure("insert", self._users, insert)
+        self._measure("insert_many", self._users, _filled_table)
+
+    def bench_ins_upd(self):
+        """ ins_upd size записей: половина -- изменения существующих, половина -- новые """
+        half = self.size // 2
+
+        def setup() -> tuple:
+            table = _filled_table(self._users())
+            updates = [{"id": row["id"], "city": 1, "cost": {"group_nsu": 1.0}} for row in self._users(half, 1)]
+            return table, updates + self._users(self.size - half, self.size + 1)
+
+        def ins_upd(state: tuple):
+            table, rows = state
+            for row in rows:
+                table.ins_upd(row)
+
+        self._measure("ins_upd", setup, ins_upd)
+
+    def bench_queries(self):
+        db = MemNRDB()
+        db.query_cache_size = 0
+        db.tables["users"] = table = _filled_table(self._users())
+
+        def query_all(query: Query, to_class: bool or Row=False):
+            def run(state):
+                for _ in db.query(query).all(to_class=to_class):
+                    pass
+            return run
+
+        for indexed in (False, True):
+            if indexed:
+                for field, kind in (("university", "hash"), ("graduation", "sorted"), ("sex", "hash")):
+                    # индекс строится при первом обращении -- не в замере
+                    table.create_index(field, kind)._ensure()
+            for name, query in QUERIES.items():
+                found = sum(1 for _ in db.query(query).all())
+                self._measure("query_{}{}".format(name, "_indexed" if indexed else ""), lambda: None,
+                              query_all(query), found=found)
+
+        self._measure("query_all_to_row", lambda: None, query_all(U, Row))
+        self._measure("rows_to_row", lambda: None, lambda state: sum(1 for _ in table.rows(to_class=Row)))
+
+    def bench_snapshots(self):
+        directory = self.directory or tempfile.mkdtemp(prefix="bench_db_")
+        try:
+            db = MemNRDB()
+            db.tables["users"] = _filled_table(self._users())
+            for fmt, ext in (("json", ".json"), ("binary", ".mnrdb")):
+                file_name = os.path.join(directory, "bench_{}{}".format(self.size, ext))
+                result = self._measure("serialize_" + fmt, lambda: None, lambda state: db.serialize(file_name))
+                result["bytes"] = os.path.getsize(file_name)
+                # загрузка вместе с созданием таблицы (таблицы загруженной БД создаются при обращении);
+                # записи бинарного снимка декодируются при чтении, так что load_binary -- только открытие
+                self._measure("load_" + fmt, lambda: None, lambda state: MemNRDB.load(file_name)["users"])
+                os.remove(file_name)
+        finally:
+            if self.directory is None:
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def _git_commit() -> str or None:
+    """ Коммит, на котором выполняется замер (None -- не в git) """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes: List[int]=SIZES, repeat: int=REPEAT, seed: int=0, log=None) -> dict:
+    """
+    Выполнить замеры для всех размеров
+    :param sizes: размеры таблицы
+    :param repeat: сколько раз повторять каждый замер
+    :param seed: seed генератора пользователей
+    :param log: файл для вывода хода замеров (None -- без вывода)
+    :return: {"meta": окружение и параметры, "results": список замеров}
+    """
+    results = []
+    for size in sizes:
+        results.extend(Benchmark(size, repeat, seed).run(log))
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "sizes": sizes,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def compare(base: dict, new: dict, threshold: float=THRESHOLD) -> List[dict]:
+    """
+    Сравнить два прогона по лучшему времени каждого замера
+    :param base: прежний прогон (результат run_benchmarks)
+    :param new: новый прогон
+    :param threshold: замедление в долях, с которого замер считается регрессией
+    :return: замеры, которые есть в обоих прогонах: name, rows, base, new, ratio (new / base), regression
+    """
+    base_results = {(result["name"], result["rows"]): result for result in base["results"]}
+    rows = []
+    for result in new["results"]:
+        old = base_results.get((result["name"], result["rows"]))
+        if old is None:
+            continue
+        ratio = result["min"] / max(old["min"], 1e-9)
+        rows.append({
+            "name": result["name"],
+            "rows": result["rows"],
+            "base": old["min"],
+            "new": result["min"],
+            "ratio": ratio,
+            "regression": ratio > 1 + threshold,
+        })
+    return rows
+
+
+def main(argv: List[str] or None=None) -> int:
+    parser = argparse.ArgumentParser(description="Замеры производительности MemNRDB")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="размеры таблицы")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="повторов каждого замера")
+    parser.add_argument("--seed", type=int, default=0, help="seed генератора пользователей")
+    parser.add_argument("--output", help="файл для результата в JSON (по умолчанию -- stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"),
+                        help="сравнить два сохранённых прогона вместо замеров")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="замедление в долях, с которого --compare считает замер регрессией")
+    namespace = parser.parse_args(argv)
+
+    if namespace.compare:
+        with open(namespace.compare[0], "rt") as f:
+            base = json.load(f)
+        with open(namespace.compare[1], "rt") as f:
+            new = json.load(f)
+        rows = compare(base, new, namespace.threshold)
+        for row in rows:
+            print("{:>8} {:<24} {:9.3f} s -> {:9.3f} s  x{:.2f}{}".format(
+                row["rows"], row["name"], row["base"], row["new"], row["ratio"],
+                "  РЕГРЕССИЯ" if row["regression"] else ""))
+        return 1 if any(row["regression"] for row in rows) else 0
+
+    report = run_benchmarks(namespace.sizes, namespace.repeat, namespace.seed, log=sys.stderr)
+    if namespace.output:
+        with open(namespace.output, "wt") as f:
+            json.dump(report, f, indent=4, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=4, ensure_ascii=False)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,31 @@
+import bisect
+import bz2
 import copy
+import gzip
+import heapq
+import io
 import json
+import lzma
+import math
+import mmap
+import multiprocessing
+import operator
 import os
+import pickle
+import shutil
+import struct
+import sys
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from itertools import chain, compress, islice, repeat
 from typing import Dict, TypeVar, Iterable
 from typing import List
+from typing import Set
+from urllib.parse import quote
 
 class DBException(Exception):
     def __init__(self, msg):
@@ -52,9 +75,17 @@ class MemNRDBEncoder(json.JSONEncoder):
                     '__tables__': o.tables}
         if isinstance(o, Table):
             return {"__Table__": True,
-                    '__rows__': list(o.meta_data.values()),
+                    '__rows__': [o._encode_row(row) for _id, row in o._scan_items()],
                     '__convert__': o.convert,
-                    '__convert_exclude__': o.convert_exclude}
+                    '__convert_exclude__': o.convert_exclude,
+                    '__indexes__': o._index_settings(),
+                    '__columns__': o.columns,
+                    '__compact__': o.compact,
+                    '__intern__': o.intern,
+                    '__sketches__': o._sketch_settings(),
+                    '__strings__': o._strings}
+        if isinstance(o, Mapping):
+            return dict(o)
         return json.JSONEncoder.default(self, o)
 
 
@@ -68,16 +99,125 @@ def db_json_hook(dct):
             ))
         db = MemNRDB()
         for table_name, table_data in tables.items():
-            rows = table_data['__rows__']
-            convert_exclude = table_data['__convert_exclude__']
-            convert = table_data['__convert__']
-            table = db.init_table(table_name, convert=convert, convert_exclude=convert_exclude)
-            for row in rows:
-                table.insert(row)
+            db._defer_table(table_name, _json_table_loader(table_name, table_data))
         return db
     return dct
 
 
+def _open_codec(file_name: str, mode: str, codec: str or None):
+    """
+    Открыть файл снимка как есть (codec=None) или через потоковый кодек сжатия:
+    данные сжимаются и распаковываются по мере записи и чтения
+    :param mode: режим open ("wt", "rt", "rb", ...); текст -- в utf-8
+    :param codec: кодек из MemNRDB.CODECS или None
+    """
+    kwargs = {"encoding": "utf-8"} if "t" in mode else {}
+    if codec is None:
+        return open(file_name, mode, **kwargs)
+    if "r" not in mode:
+        kwargs["preset" if "lzma" == codec else "compresslevel"] = MemNRDB.CODEC_LEVEL
+    return MemNRDB.CODECS[codec](file_name, mode, **kwargs)
+
+
+def _jsonl_file_name(table_name: str, codec: str or None=None) -> str:
+    """ Имя файла таблицы в каталоге JSONL-снимка """
+    return quote(table_name, safe="") + MemNRDB.JSONL_SUFFIX + MemNRDB._codec_extension(codec)
+
+
+def _jsonl_table_codec(file_name: str) -> (bool, str or None):
+    """ Файл ли это таблицы JSONL-снимка и каким кодеком он сжат (по расширению) """
+    root, ext = os.path.splitext(file_name)
+    codec = MemNRDB.CODEC_EXTENSIONS.get(ext)
+    if codec is not None:
+        root, ext = os.path.splitext(root)
+    return MemNRDB.JSONL_SUFFIX == ext, codec
+
+
+def _read_jsonl_manifest(directory: str) -> dict or None:
+    """
+    Оглавление JSONL-снимка: {"version": ..., "tables": {имя таблицы: имя файла}}
+    :return: оглавление или None, если каталог -- не снимок MemNRDB
+    """
+    file_name = os.path.join(directory, MemNRDB.JSONL_MANIFEST)
+    if not os.path.isfile(file_name):
+        return None
+    with open(file_name, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MemNRDB.VERSION:
+        raise DBException("Версия БД не совместима. Ожадиается: {}; Получена: {}".format(
+            MemNRDB.VERSION, manifest.get("version")
+        ))
+    return manifest
+
+
+def _read_jsonl_header(file_name: str) -> dict:
+    """ Заголовок (первая строка) JSONL-файла таблицы """
+    with _open_codec(file_name, "rt", _jsonl_table_codec(file_name)[1]) as f:
+        header = json.loads(f.readline())
+    if header.get("version") != MemNRDB.VERSION:
+        raise DBException("Версия БД не совместима. Ожадиается: {}; Получена: {}".format(
+            MemNRDB.VERSION, header.get("version")
+        ))
+    return header
+
+
+def _jsonl_table_loader(file_name: str):
+    """
+    Отложенное создание таблицы из JSONL-файла: записи читаются по одной
+    и вставляются пачками по Table.JSONL_BATCH
+    """
+    def load() -> Table:
+        with _open_codec(file_name, "rt", _jsonl_table_codec(file_name)[1]) as f:
+            header = json.loads(f.readline())
+            table = Table(header["table"], **header["settings"])
+            batch = []
+            for line in f:
+                if line.strip():
+                    batch.append(json.loads(line))
+                if len(batch) >= table.JSONL_BATCH:
+                    table.insert_many(batch)
+                    batch = []
+            table.insert_many(batch)
+        table.index_count = max(table.index_count, header.get("index_count", 1))
+        return table
+    # файл, из которого таблица загружается: нетронутую таблицу можно не перезаписывать
+    load.file_name = file_name
+    return load
+
+
+def _json_table_loader(table_name: str, table_data: dict):
+    """ Отложенное создание таблицы из разобранного JSON-снимка """
+    def load() -> Table:
+        table = Table(table_name,
+                      convert=table_data['__convert__'],
+                      convert_exclude=table_data['__convert_exclude__'],
+                      indexes=table_data.get('__indexes__', []),
+                      columns=table_data.get('__columns__'),
+                      compact=table_data.get('__compact__', False),
+                      intern=table_data.get('__intern__'),
+                      sketches=table_data.get('__sketches__'))
+        rows = table_data['__rows__']
+        if table.intern:
+            table._load_pool(table_data.get('__strings__', []))
+            rows = [table._decode_row(row) for row in rows]
+        table.insert_many(rows)
+        return table
+    return load
+
+
+def _json_section_loader(data, table_name: str, start: int, stop: int):
+    """
+    Отложенное создание таблицы из её строки в JSON-снимке (см. MemNRDB._open_json):
+    разбирается только эта строка
+    :param data: содержимое снимка (mmap или bytes)
+    """
+    def load() -> Table:
+        return _json_table_loader(table_name, json.loads(data[start:stop]))()
+    # JSON таблицы в снимке: нетронутую таблицу можно записать как есть, не разбирая
+    load.section = (data, start, stop)
+    return load
+
+
 class MemNRDB:
     """
     Нереляционная база данных, работающая в памяти.
@@ -96,11 +236,84 @@ class MemNRDB:
     Сохранить БД в файл:
     >>> file_mdb.serialize('db.json')
 
+    Дописать в журнал только изменения с последнего сохранения:
+    >>> file_mdb.serialize('db.json', journal=True)
+
+    Журнал `db.json.journal` проигрывается поверх снимка при загрузке и
+    периодически вливается в снимок фоновым процессом (см. compact).
+
+    Бинарный снимок открывается через mmap почти мгновенно, записи
+    декодируются только при обращении к ним:
+    >>> file_mdb.serialize('db.mnrdb')
+    >>> mapped_mdb = MemNRDB.load('db.mnrdb')
+
+    Снимок по таблицам: каталог, в котором у каждой таблицы свой файл JSON Lines
+    (см. Table.export_jsonl), и оглавление JSONL_MANIFEST. Записи пишутся и читаются
+    по одной, а файл таблицы разбирается только при первом обращении к ней:
+    >>> file_mdb.serialize('db.jsonl')
+    >>> jsonl_mdb = MemNRDB.load('db.jsonl')
+
+    Снимок (кроме бинарного) можно сжать -- по расширению (.gz, .bz2, .xz) или явно;
+    load узнаёт сжатый снимок сам:
+    >>> file_mdb.serialize('db.json.gz')
+    >>> file_mdb.serialize('db.jsonl', codec='lzma')
+
+    Таблицы загруженной БД создаются при первом обращении к ним
+    (mdb['users'] или mdb.init_table('users')), остальные не разбираются вовсе:
+    >>> mapped_mdb.table_names()
+    ['table_name']
+
+    Результаты запросов (mdb.query(q).all()) кешируются до первого изменения таблицы
+    (через insert/update/ins_upd, Row или Table.touch -- запись, изменённую напрямую
+    как dict, нужно отметить через touch), хранятся последние QUERY_CACHE_SIZE; отключить кеш:
+    >>> mdb.query_cache_size = 0
+
+    Оценка памяти по таблицам и полям (см. Table.stats) и профиль запросов (см. QueryProfiler):
+    >>> stats = mdb.stats()
+    >>> profiler = mdb.profile()
     """
     VERSION = 0
 
+    JOURNAL_SUFFIX = ".journal"
+    # Журнал, который сейчас вливается в снимок
+    COMPACTING_SUFFIX = ".compacting"
+    # Журнал вливается в снимок, когда становится больше снимка во столько раз
+    JOURNAL_COMPACT_RATIO = 1.0
+
+    FORMATS = ("json", "binary", "jsonl")
+    # Формат снимка по расширению файла (по умолчанию -- json)
+    FORMAT_EXTENSIONS = {".mnrdb": "binary", ".jsonl": "jsonl"}
+    # Расширение файлов таблиц в каталоге JSONL-снимка
+    JSONL_SUFFIX = ".jsonl"
+    # Оглавление каталога JSONL-снимка: по нему каталог узнаётся как снимок, а при
+    # перезаписи удаляются только те файлы, которые снимок записал сам
+    JSONL_MANIFEST = "__MemNRDB__.json"
+    # Кодеки сжатия снимков; кодек выбирается по последнему расширению файла, а при загрузке --
+    # по первым байтам файла (у JSONL-снимка -- по расширениям файлов таблиц)
+    CODECS = {"gzip": gzip.open, "bz2": bz2.open, "lzma": lzma.open}
+    CODEC_EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "lzma"}
+    CODEC_MAGIC = {b"\x1f\x8b": "gzip", b"BZh": "bz2", b"\xfd7zXZ\x00": "lzma"}
+    # Уровень сжатия (compresslevel у gzip и bz2, preset у lzma): снимок пишется почти так же быстро,
+    # как несжатый; более высокие уровни сжимают ненамного лучше, но пишут в разы дольше
+    CODEC_LEVEL = 1
+    BINARY_MAGIC = b"MNRDBBIN"
+    # Конец первой строки JSON-снимка с оглавлением: дальше -- по строке на таблицу
+    JSON_TABLES_LINE = b'"__tables__": {\n'
+    # Сколько результатов запросов хранить в кеше (0 -- не кешировать)
+    QUERY_CACHE_SIZE = 256
+
     def __init__(self):
-        self.tables = {}  # type: Dict[str, Table]
+        self.tables = {}  # type: Dict[str, Table]  # уже созданные таблицы
+        # таблицы из снимка, которые ещё не создавались: имя -> (загрузчик, записи из журнала)
+        self._pending = {}  # type: Dict[str, tuple]
+        self._checkpoint_file = None  # снимок, относительно которого ведётся журнал
+        self._journaled_tables = set()  # type: Set[str]  # таблицы, уже описанные в снимке или журнале
+        self._compactor = None  # type: multiprocessing.Process
+        self._checkpointer = None  # type: Checkpoint  # фоновая запись снимка
+        self.query_cache_size = self.QUERY_CACHE_SIZE
+        # (таблица, каноническая форма запроса) -> (таблица, её версия, id записей); порядок -- LRU
+        self._query_cache = OrderedDict()  # type: Dict[tuple, tuple]
+        self.profiler = None  # type: QueryProfiler  # профиль запросов, если включён
 
     def __getitem__(self, table_name: str) -> 'Table':
         """
@@ -111,72 +324,2523 @@ class MemNRDB:
         try:
             return self.tables[table_name]
         except KeyError:
+            if table_name in self._pending:
+                return self._materialize(table_name)
             raise DBException("Не найдена таблица с именем {}".format(table_name))
 
+    def __contains__(self, table_name: str) -> bool:
+        return table_name in self.tables or table_name in self._pending
+
+    def table_names(self) -> List[str]:
+        """ Имена всех таблиц, в том числе ещё не загруженных """
+        return list(self.tables) + list(self._pending)
+
     def init_table(self, table_name: str, *args, **kwargs) -> 'Table':
         """
         Вернуть таблицу по имени. Если её нет -- создать
         :param table_name:
+        :param args, kwargs: параметры Table -- только для новой таблицы; у уже
+                             существующей (например, загруженной) они не меняются,
+                             пул строк ей можно включить через Table.intern_fields
         :return: таблица
         """
         if table_name in self.tables:
             t = self.tables[table_name]
+        elif table_name in self._pending:
+            t = self._materialize(table_name)
         else:
             t = Table(table_name, *args, **kwargs)
+            t._profiler = self.profiler
             self.tables[table_name] = t
         return t
 
+    def _defer_table(self, table_name: str, loader):
+        """
+        Зарегистрировать таблицу, которая будет создана при первом обращении
+        :param loader: функция без аргументов, возвращающая таблицу
+        """
+        self._pending[table_name] = (loader, [])
+
+    def _materialize(self, table_name: str) -> 'Table':
+        """ Создать отложенную таблицу и применить к ней записи из журнала """
+        loader, journal_rows = self._pending.pop(table_name)
+        table = loader()
+        for row in journal_rows:
+            table._put(row)
+        table._dirty.clear()
+        table._profiler = self.profiler
+        self.tables[table_name] = table
+        return table
+
+    def _materialize_all(self):
+        for table_name in list(self._pending):
+            self._materialize(table_name)
+
+    def query(self, query: 'Query'):
+        new_q = copy.copy(query)
+        new_q.db = self
+        return new_q
+
+    def _query_ids(self, query: 'Query', table: 'Table', workers: int=1) -> Iterable[int]:
+        """
+        id записей таблицы, прошедших фильтр. Результат запроса кешируется до первого
+        изменения таблицы; в кеш попадают только выполненные до конца запросы.
+        :param query: запрос
+        :param table: таблица
+        :param workers: число процессов для просмотра таблицы
+        :return: id записей
+        """
+        key = query._cache_key() if self.query_cache_size > 0 else None
+        if key is None:
+            yield from query.plan(table).ids(workers)
+            return
+        key = (table.name, key)
+        cache = self._query_cache
+        entry = cache.get(key)
+        if entry is not None and entry[0] is table and entry[1] == table.version:
+            cache.move_to_end(key)
+            if table._profiler is not None:
+                table._profiler._record(query, table)["cache_hits"] += 1
+            yield from entry[2]
+            return
+        version = table.version
+        ids = []
+        for _id in query.plan(table).ids(workers):
+            ids.append(_id)
+            yield _id
+        if table.version == version:
+            cache[key] = (table, version, ids)
+            cache.move_to_end(key)
+            while len(cache) > self.query_cache_size:
+                cache.popitem(last=False)
+
+    def clear_query_cache(self):
+        """ Очистить кеш результатов запросов """
+        self._query_cache.clear()
+
+    def create_view(self, name: str, query: 'Query', **aggregates) -> 'MaterializedView':
+        """
+        Создать материализованное представление в таблице запроса, см. Table.create_view
+        :param name: имя представления
+        :param query: запрос
+        :param aggregates: агрегаты по записям представления
+        :return: представление
+        """
+        return self[query.table_name].create_view(name, query, **aggregates)
+
+    def profile(self, enabled: bool=True) -> 'QueryProfiler' or None:
+        """
+        Включить или выключить профилирование запросов
+        :param enabled: включить (если профиль уже включён, он продолжает копиться)
+        :return: профиль; при выключении -- собранный до этого профиль (или None)
+        """
+        profiler = self.profiler
+        if enabled and profiler is None:
+            profiler = QueryProfiler()
+        self.profiler = profiler if enabled else None
+        for table in self.tables.values():
+            table._profiler = self.profiler
+        return profiler
+
+    def stats(self, sample: int or None=None) -> dict:
+        """
+        Оценка памяти БД
+        :param sample: сколько записей каждой таблицы просмотреть, см. Table.stats
+        :return: rows, bytes -- всего; tables -- имя -> Table.stats();
+          pending -- имена ещё не загруженных таблиц (памяти под записи они не занимают)
+        """
+        tables = {name: table.stats(sample) for name, table in self.tables.items()}
+        return {
+            "rows": sum(stats["rows"] for stats in tables.values()),
+            "bytes": sum(stats["bytes"] for stats in tables.values()),
+            "tables": tables,
+            "pending": list(self._pending),
+        }
+
+    def __str__(self):
+        return "<MemNRDB>, {} tables".format(len(self.tables) + len(self._pending))
+
+    def serialize(self, file_name: str, pretty: bool=False, journal: bool=False, fmt: str or None=None,
+                  codec: str or None=None):
+        """
+        Загружает БД в файл
+        :param file_name: Имя файла БД
+        :param pretty: красивый вывод в файл (такой JSON-снимок при загрузке разбирается целиком)
+        :param journal: дописать в журнал только изменённые с прошлого сохранения записи
+          (если снимка ещё нет или он другой, будет записан полный снимок; журнал не сжимается)
+        :param fmt: формат снимка: "json", "binary" или "jsonl" -- каталог с файлом на каждую
+          таблицу (по умолчанию -- по расширению файла; существующий каталог -- только
+          если это уже JSONL-снимок)
+        :param codec: сжатие снимка: "gzip", "bz2" или "lzma" (по умолчанию -- по расширению файла);
+          бинарный снимок не сжимается
+        :return:
+        """
+        if journal and self._checkpoint_file == file_name:
+            self._append_journal(file_name)
+            try:
+                journal_size = os.path.getsize(file_name + self.JOURNAL_SUFFIX)
+                snapshot_size = _snapshot_size(file_name)
+            except OSError:
+                # снимок как раз переписывается фоновым сжатием
+                return
+            # пока снимок пишется в фоне, журнал только дописывается
+            if journal_size > self.JOURNAL_COMPACT_RATIO * snapshot_size and not self._checkpoint_running():
+                self.compact(file_name)
+            return
+
+        self.wait_checkpoint()
+        self.wait_compaction()
+        self._write_snapshot(file_name, pretty, fmt, codec)
+        for suffix in (self.JOURNAL_SUFFIX, self.JOURNAL_SUFFIX + self.COMPACTING_SUFFIX):
+            if os.path.exists(file_name + suffix):
+                os.remove(file_name + suffix)
+        self._checkpoint_file = file_name
+        self._journaled_tables = set(self.table_names())
+        for table in self.tables.values():
+            table._dirty.clear()
+
+    def checkpoint_async(self, file_name: str, pretty: bool=False, fmt: str or None=None,
+                         codec: str or None=None) -> 'Checkpoint':
+        """
+        Записать полный снимок в дочернем процессе (fork), не останавливая работу с БД:
+        процесс видит память на момент запуска (copy-on-write) и пишет снимок
+        через ту же замену с `.old`, что и serialize.
+        Все изменения до запуска сначала дописываются в журнал, а журнал
+        откладывается (как при compact) и удаляется, только когда снимок записан,
+        поэтому при падении на любом шаге load восстановит все данные.
+        Последующие serialize(journal=True) пишут в новый журнал поверх этого снимка.
+        :param file_name: имя файла БД
+        :param pretty: красивый вывод в файл
+        :param fmt: формат снимка, см. serialize
+        :param codec: сжатие снимка, см. serialize
+        :return: фоновая запись (wait() вернёт статистику)
+        """
+        self.wait_checkpoint()
+        self.wait_compaction()
+        self._check_codec(self._snapshot_format(file_name, fmt), self._snapshot_codec(file_name, codec))
+        self._materialize_all()
+        journal_name = file_name + self.JOURNAL_SUFFIX
+        compacting_name = journal_name + self.COMPACTING_SUFFIX
+        if self._checkpoint_file == file_name:
+            self._append_journal(file_name)
+        if os.path.exists(journal_name):
+            if os.path.exists(compacting_name):
+                with open(journal_name, "rb") as src, open(compacting_name, "ab") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(journal_name)
+            else:
+                os.rename(journal_name, compacting_name)
+
+        if "fork" not in multiprocessing.get_all_start_methods():
+            start = time.time()
+            self.serialize(file_name, pretty, fmt=fmt, codec=codec)
+            return Checkpoint(file_name, stats=_checkpoint_stats(self, file_name, time.time() - start))
+
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_write_checkpoint, args=(self, file_name, pretty, fmt, codec, sender))
+        tables = list(self.tables.values())
+        # fork не должен застать запись на середине изменения
+        for table in tables:
+            table._write_lock.acquire()
+        try:
+            process.start()
+            for table in tables:
+                table._dirty = set()
+        finally:
+            for table in tables:
+                table._write_lock.release()
+        sender.close()
+        self._checkpoint_file = file_name
+        self._journaled_tables = set(self.table_names())
+        self._checkpointer = Checkpoint(file_name, process, receiver)
+        return self._checkpointer
+
+    def _checkpoint_running(self) -> bool:
+        return self._checkpointer is not None and not self._checkpointer.done()
+
+    def wait_checkpoint(self) -> dict or None:
+        """
+        Дождаться окончания фоновой записи снимка
+        :return: её статистика (см. Checkpoint.wait) или None, если записи не было
+        """
+        if self._checkpointer is None:
+            return None
+        checkpointer, self._checkpointer = self._checkpointer, None
+        return checkpointer.wait()
+
+    @classmethod
+    def _snapshot_format(cls, file_name: str, fmt: str or None) -> str:
+        """ Формат, в котором будет записан снимок """
+        if fmt is None:
+            root, ext = os.path.splitext(file_name)
+            if ext in cls.CODEC_EXTENSIONS:
+                ext = os.path.splitext(root)[1]
+            fmt = cls.FORMAT_EXTENSIONS.get(ext, "json")
+            if os.path.isdir(file_name) and "jsonl" != fmt:
+                if _read_jsonl_manifest(file_name) is None:
+                    raise DBException("Каталог `{}` -- не снимок MemNRDB (нет {}): укажите формат явно".format(
+                        file_name, cls.JSONL_MANIFEST))
+                return "jsonl"
+            return fmt
+        if fmt not in cls.FORMATS:
+            raise DBException("Неизвестный формат снимка `{}`".format(fmt))
+        return fmt
+
+    @classmethod
+    def _snapshot_codec(cls, file_name: str, codec: str or None) -> str or None:
+        """ Кодек, которым будет сжат снимок (None -- без сжатия) """
+        if codec is None:
+            return cls.CODEC_EXTENSIONS.get(os.path.splitext(file_name)[1])
+        if codec not in cls.CODECS:
+            raise DBException("Неизвестный кодек сжатия `{}`".format(codec))
+        return codec
+
+    @staticmethod
+    def _check_codec(fmt: str, codec: str or None):
+        if codec is not None and "binary" == fmt:
+            raise DBException("Бинарный снимок открывается через mmap и не может быть сжат")
+
+    @classmethod
+    def _codec_extension(cls, codec: str or None) -> str:
+        """ Расширение файла, сжатого кодеком ("" -- без сжатия) """
+        for ext, ext_codec in cls.CODEC_EXTENSIONS.items():
+            if ext_codec == codec:
+                return ext
+        return ""
+
+    @classmethod
+    def _detect_codec(cls, file_name: str) -> str or None:
+        """ Кодек уже записанного снимка """
+        if os.path.isdir(file_name):
+            manifest = _read_jsonl_manifest(file_name)
+            for name in (manifest or {}).get("tables", {}).values():
+                return _jsonl_table_codec(name)[1]
+            return None
+        with open(file_name, "rb") as f:
+            head = f.read(8)
+        for magic, codec in cls.CODEC_MAGIC.items():
+            if head.startswith(magic):
+                return codec
+        return None
+
+    @classmethod
+    def _detect_format(cls, file_name: str) -> str:
+        """ Формат уже записанного снимка """
+        if os.path.isdir(file_name):
+            if _read_jsonl_manifest(file_name) is None:
+                raise DBException("Каталог `{}` -- не снимок MemNRDB (нет {})".format(file_name, cls.JSONL_MANIFEST))
+            return "jsonl"
+        if cls._detect_codec(file_name) is not None:
+            # сжатым бывает только JSON
+            return "json"
+        with open(file_name, "rb") as f:
+            magic = f.read(len(cls.BINARY_MAGIC))
+        return "binary" if magic == cls.BINARY_MAGIC else "json"
+
+    def _write_snapshot(self, file_name: str, pretty: bool=False, fmt: str or None=None, codec: str or None=None):
+        """ Записать полный снимок БД в файл """
+        fmt = self._snapshot_format(file_name, fmt)
+        codec = self._snapshot_codec(file_name, codec)
+        self._check_codec(fmt, codec)
+        if "jsonl" == fmt:
+            self._write_jsonl(file_name, codec)
+            return
+        if "binary" == fmt:
+            self._materialize_all()
+            if os.path.exists(file_name):
+                os.rename(file_name, file_name + ".old")
+            self._write_binary(file_name)
+            if os.path.exists(file_name + ".old"):
+                os.remove(file_name + ".old")
+            return
+        kwargs = {
+            "cls": MemNRDBEncoder,
+            "ensure_ascii": False
+        }
+        if pretty:
+            kwargs.update({
+                "sort_keys": True,
+                "indent": 4
+            })
+        if os.path.exists(file_name):
+            os.rename(file_name, file_name + ".old")
+        # json.dump пишет кусками, так что сжатие идёт потоком
+        with _open_codec(file_name, "wt", codec) as f:
+            if pretty:
+                self._materialize_all()
+                json.dump(self, f, **kwargs)
+            else:
+                self._write_json(f)
+        if os.path.exists(file_name + ".old"):
+            os.remove(file_name + ".old")
+
+    def _write_json(self, f):
+        """
+        Записать JSON-снимок построчно: первая строка -- заголовок с оглавлением (`__layout__`),
+        дальше по строке на таблицу. Это обычный JSON-документ, но при загрузке каждая таблица
+        разбирается отдельно (см. _open_json). Таблицы, которые ещё не загружались и не менялись,
+        переписываются из прежнего снимка как есть
+        """
+        names = self.table_names()
+        header = json.dumps({'__MemNRDB__': True,
+                             '__version__': self.VERSION,
+                             '__layout__': names,
+                             '__tables__': {}}, ensure_ascii=False)
+        f.write(header[:-2] + "\n")
+        for i, name in enumerate(names):
+            f.write(json.dumps(name, ensure_ascii=False) + ": ")
+            loader, journal_rows = self._pending.get(name, (None, None))
+            section = getattr(loader, "section", None)
+            if section is not None and not journal_rows:
+                data, start, stop = section
+                f.write(data[start:stop].decode("utf-8"))
+            else:
+                json.dump(self[name], f, cls=MemNRDBEncoder, ensure_ascii=False)
+            f.write(",\n" if i + 1 < len(names) else "\n")
+        f.write("}}\n")
+
+    def _write_jsonl(self, directory: str, codec: str or None=None):
+        """
+        Записать JSONL-снимок: каталог с файлом на каждую таблицу (сжатым codec). Таблицы,
+        которые ещё не загружались и не менялись, не разбираются: их файлы копируются как есть
+        (или остаются на месте, если снимок пишется туда же, откуда загружен).
+        Файлы таблиц, которых больше нет в БД, удаляются -- но только те, что перечислены
+        в прежнем оглавлении: чужие файлы в каталоге не трогаются.
+        """
+        os.makedirs(directory, exist_ok=True)
+        old_files = set(((_read_jsonl_manifest(directory) or {}).get("tables") or {}).values())
+        files = {}  # type: Dict[str, str]  # таблица -> имя файла
+        for name in self.table_names():
+            file_name = os.path.join(directory, _jsonl_file_name(name, codec))
+            files[name] = os.path.basename(file_name)
+            loader, journal_rows = self._pending.get(name, (None, None))
+            source = getattr(loader, "file_name", None)
+            if source is not None and not journal_rows and _jsonl_table_codec(source)[1] == codec:
+                if not os.path.exists(file_name) or not os.path.samefile(source, file_name):
+                    shutil.copyfile(source, file_name + ".tmp")
+                    os.replace(file_name + ".tmp", file_name)
+                continue
+            self[name].export_jsonl(file_name)
+        manifest_name = os.path.join(directory, self.JSONL_MANIFEST)
+        with open(manifest_name + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "tables": files}, f, ensure_ascii=False)
+        os.replace(manifest_name + ".tmp", manifest_name)
+        for file_name in old_files - set(files.values()):
+            file_name = os.path.join(directory, file_name)
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    @classmethod
+    def _open_jsonl(cls, directory: str) -> 'MemNRDB':
+        """ Открыть JSONL-снимок: читаются только заголовки файлов, таблицы загружаются при обращении """
+        manifest = _read_jsonl_manifest(directory)
+        if manifest is None:
+            raise DBException("Каталог `{}` -- не снимок MemNRDB (нет {})".format(directory, cls.JSONL_MANIFEST))
+        db = cls()
+        for name, file_name in manifest["tables"].items():
+            file_name = os.path.join(directory, file_name)
+            _read_jsonl_header(file_name)
+            db._defer_table(name, _jsonl_table_loader(file_name))
+        return db
+
+    def _append_journal(self, file_name: str):
+        """
+        Дописать в журнал описания новых таблиц и записи, изменённые с прошлого сохранения.
+        Каждая строка журнала -- отдельный JSON: {"table": ..., "settings": ...} или {"table": ..., "row": ...}
+        """
+        with open(file_name + self.JOURNAL_SUFFIX, "at", encoding="utf-8") as f:
+            for name, table in self.tables.items():
+                if name not in self._journaled_tables:
+                    f.write(json.dumps({"table": name, "settings": table._settings()}, ensure_ascii=False))
+                    f.write("\n")
+                    self._journaled_tables.add(name)
+                meta_data = table.meta_data
+                for _id in table._dirty:
+                    f.write(json.dumps({"table": name, "row": meta_data[_id]},
+                                       cls=MemNRDBEncoder, ensure_ascii=False))
+                    f.write("\n")
+                table._dirty.clear()
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replay_journal(self, journal_name: str):
+        """ Применить записи журнала к БД """
+        with open(journal_name, "rb") as f:
+            while True:
+                good = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # недописанная последняя строка после падения: отрезаем её,
+                    # чтобы следующие записи не склеились с ней
+                    f.close()
+                    os.truncate(journal_name, good)
+                    break
+                table_name = record["table"]
+                if "settings" in record:
+                    if table_name not in self:
+                        self.init_table(table_name, **record["settings"])
+                elif table_name in self._pending:
+                    self._pending[table_name][1].append(record["row"])
+                else:
+                    self[table_name]._put(record["row"])
+
+    def compact(self, file_name: str, background: bool=True) -> multiprocessing.Process or None:
+        """
+        Влить журнал в снимок. Текущий журнал переименовывается, дальнейшие изменения
+        пишутся в новый, а снимок пересобирается из файлов (без обращения к памяти
+        этого процесса) -- по умолчанию в отдельном процессе.
+        :param file_name: имя файла БД
+        :param background: выполнять в фоновом процессе
+        :return: фоновый процесс или None
+        """
+        self.wait_checkpoint()
+        journal_name = file_name + self.JOURNAL_SUFFIX
+        compacting_name = journal_name + self.COMPACTING_SUFFIX
+        if self._compactor is not None:
+            if self._compactor.is_alive():
+                return None
+            self._compactor.join()
+            self._compactor = None
+        # если отложенный журнал остался от прерванного сжатия, сначала вливается он
+        if not os.path.exists(compacting_name):
+            if not os.path.exists(journal_name):
+                return None
+            os.rename(journal_name, compacting_name)
+        if not background:
+            _compact_journal(file_name)
+            return None
+        self._compactor = multiprocessing.Process(target=_compact_journal, args=(file_name,))
+        self._compactor.start()
+        return self._compactor
+
+    def wait_compaction(self):
+        """ Дождаться окончания фонового сжатия журнала """
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    def _write_binary(self, file_name: str):
+        """
+        Записать бинарный снимок:
+          MAGIC, смещение заголовка (uint64),
+          для каждой таблицы: данные (записи, сериализованные pickle, подряд;
+            строки из пула таблицы записываются номерами -- persistent id,
+            кортежи и множества -- списками, как в JSON),
+            отсортированные id (int64) и смещения записей в данных (int64, n + 1 штука),
+          заголовок -- JSON с параметрами таблиц и положением их секций.
+        Числа записываются в порядке байт текущей машины.
+        """
+        with open(file_name, "wb") as f:
+            f.write(self.BINARY_MAGIC)
+            f.write(struct.pack("<Q", 0))
+            tables = {}
+            for name, table in self.tables.items():
+                ids = array('q', sorted(table.meta_data))
+                offsets = array('q', [0])
+                data_pos = f.tell()
+                size = 0
+                meta_data = table.meta_data
+                dumps = _row_dumps(table._codes)
+                for _id in ids:
+                    blob = meta_data.raw(_id) if isinstance(meta_data, MappedRows) else None
+                    if blob is None:
+                        blob = dumps(dict(meta_data[_id]))
+                    f.write(blob)
+                    size += len(blob)
+                    offsets.append(size)
+                f.write(b"\0" * (-f.tell() % 8))
+                ids_pos = f.tell()
+                ids.tofile(f)
+                offsets_pos = f.tell()
+                offsets.tofile(f)
+                tables[name] = {
+                    "settings": table._settings(),
+                    "strings": table._strings,
+                    "index_count": table.index_count,
+                    "count": len(ids),
+                    "data": data_pos,
+                    "ids": ids_pos,
+                    "offsets": offsets_pos,
+                }
+            header_pos = f.tell()
+            f.write(json.dumps({"version": self.VERSION, "tables": tables}, ensure_ascii=False).encode("utf-8"))
+            f.seek(len(self.BINARY_MAGIC))
+            f.write(struct.pack("<Q", header_pos))
+
+    @classmethod
+    def _open_binary(cls, file_name: str) -> 'MemNRDB':
+        """ Открыть бинарный снимок через mmap (записи декодируются при обращении) """
+        with open(file_name, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        header_pos = struct.unpack_from("<Q", mapped, len(cls.BINARY_MAGIC))[0]
+        header = json.loads(bytes(view[header_pos:]).decode("utf-8"))
+        if header["version"] != cls.VERSION:
+            raise DBException("Версия БД не совместима. Ожадиается: {}; Получена: {}".format(
+                cls.VERSION, header["version"]
+            ))
+        db = cls()
+        for name, info in header["tables"].items():
+            db._defer_table(name, _binary_table_loader(view, name, info))
+        return db
+
+    @classmethod
+    def _open_json(cls, file_name: str, codec: str or None) -> 'MemNRDB' or None:
+        """
+        Открыть JSON-снимок, записанный построчно (см. _write_json): сразу разбирается только
+        оглавление, каждая таблица -- при первом обращении. Несжатый снимок открывается через mmap.
+        :return: БД или None, если снимок записан не построчно
+        """
+        if codec is None:
+            with open(file_name, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with _open_codec(file_name, "rb", codec) as f:
+                data = f.read()
+        pos = data.find(b"\n") + 1
+        header = data[:pos]
+        if not header.endswith(cls.JSON_TABLES_LINE):
+            return None
+        header = json.loads(header[:-1] + b"}}")
+        if '__layout__' not in header:
+            return None
+        if header['__version__'] != cls.VERSION:
+            raise DBException("Версия БД не совместима. Ожадиается: {}; Получена: {}".format(
+                cls.VERSION, header['__version__']
+            ))
+        db = cls()
+        for name in header['__layout__']:
+            end = data.find(b"\n", pos)
+            # строка таблицы: `"имя": {...},`
+            start = pos + len(json.dumps(name, ensure_ascii=False).encode("utf-8")) + 2
+            stop = end - 1 if data[end - 1:end] == b"," else end
+            db._defer_table(name, _json_section_loader(data, name, start, stop))
+            pos = end + 1
+        return db
+
+    @classmethod
+    def _load_snapshot(cls, file_name: str) -> 'MemNRDB':
+        """ Загрузить снимок без журнала """
+        fmt = cls._detect_format(file_name)
+        if "binary" == fmt:
+            return cls._open_binary(file_name)
+        if "jsonl" == fmt:
+            return cls._open_jsonl(file_name)
+        codec = cls._detect_codec(file_name)
+        db = cls._open_json(file_name, codec)
+        if db is not None:
+            return db
+        # снимок с отступами (pretty) или старый однострочный -- разбирается целиком
+        with _open_codec(file_name, "rt", codec) as f:
+            db = json.load(f, object_hook=db_json_hook)
+        if isinstance(db, MemNRDB):
+            return db
+        else:
+            raise DBException("Не удалось загрузить базу из файла.")
+
+    @classmethod
+    def load(cls, file_name: str) -> 'MemNRDB':
+        """
+        Загрузить бд из файла (вместе с журналом, если он есть)
+        :param file_name: имя файла
+        :return:
+        """
+        db = cls._load_snapshot(file_name)
+        journal_name = file_name + cls.JOURNAL_SUFFIX
+        for name in (journal_name + cls.COMPACTING_SUFFIX, journal_name):
+            if os.path.exists(name):
+                db._replay_journal(name)
+        db._checkpoint_file = file_name
+        db._journaled_tables = set(db.table_names())
+        for table in db.tables.values():
+            table._dirty.clear()
+        return db
+
+
+class Checkpoint:
+    """
+    Фоновая запись снимка, запущенная MemNRDB.checkpoint_async.
+
+    >>> db = MemNRDB()
+    >>> checkpoint = db.checkpoint_async('db.json')
+    >>> stats = checkpoint.wait()
+    >>> sorted(stats)
+    ['bytes', 'bytes_per_sec', 'rows', 'rows_per_sec', 'seconds']
+    """
+    def __init__(self, file_name: str, process: multiprocessing.Process or None=None,
+                 receiver: object=None, stats: dict or None=None):
+        self.file_name = file_name
+        self._process = process
+        self._receiver = receiver  # конец канала, по которому дочерний процесс пришлёт статистику
+        self.stats = stats
+
+    def done(self) -> bool:
+        """ Закончилась ли запись (успешно или нет) """
+        return self.stats is not None or self._receiver.poll()
+
+    def wait(self) -> dict:
+        """
+        Дождаться окончания записи
+        :return: статистика: rows, bytes, seconds, rows_per_sec, bytes_per_sec
+        """
+        if self.stats is None:
+            try:
+                result = self._receiver.recv()
+            except EOFError:
+                result = "процесс завершился с кодом {}".format(self._process.exitcode)
+            self._process.join()
+            self._receiver.close()
+            if not isinstance(result, dict):
+                raise DBException("Не удалось записать снимок `{}`: {}".format(self.file_name, result))
+            self.stats = result
+        return self.stats
+
+
+def _checkpoint_stats(db: MemNRDB, file_name: str, seconds: float) -> dict:
+    """ Статистика записи снимка """
+    rows = sum(len(table) for table in db.tables.values())
+    size = _snapshot_size(file_name)
+    seconds = max(seconds, 1e-9)
+    return {
+        "rows": rows,
+        "bytes": size,
+        "seconds": seconds,
+        "rows_per_sec": rows / seconds,
+        "bytes_per_sec": size / seconds,
+    }
+
+
+def _snapshot_size(file_name: str) -> int:
+    """ Размер снимка в байтах (у JSONL-снимка -- сумма его файлов в каталоге) """
+    if os.path.isdir(file_name):
+        manifest = _read_jsonl_manifest(file_name) or {}
+        return sum(os.path.getsize(os.path.join(file_name, name))
+                   for name in list(manifest.get("tables", {}).values()) + [MemNRDB.JSONL_MANIFEST]
+                   if os.path.exists(os.path.join(file_name, name)))
+    return os.path.getsize(file_name)
+
+
+def _write_checkpoint(db: MemNRDB, file_name: str, pretty: bool, fmt: str or None, codec: str or None,
+                      sender: object):
+    """ Записать снимок в дочернем процессе и отправить родителю статистику (или ошибку) """
+    start = time.time()
+    # fork скопировал блокировки таблиц захваченными (см. checkpoint_async), а в этом
+    # процессе писателей нет -- чтение записей должно их брать свободно
+    for table in db.tables.values():
+        table._write_lock = threading.Lock()
+    try:
+        db._write_snapshot(file_name, pretty, fmt, codec)
+        # отложенный журнал уже целиком в снимке
+        compacting_name = file_name + MemNRDB.JOURNAL_SUFFIX + MemNRDB.COMPACTING_SUFFIX
+        if os.path.exists(compacting_name):
+            os.remove(compacting_name)
+        sender.send(_checkpoint_stats(db, file_name, time.time() - start))
+    except Exception as e:
+        sender.send("{}: {}".format(type(e).__name__, e))
+    finally:
+        sender.close()
+
+
+class ShardedMemNRDB:
+    """
+    БД, таблицы которой разбиты по хешу id на shards частей (шардов). Каждый шард --
+    обычная MemNRDB в своём процессе и своём файле, поэтому память и ядра
+    складываются, а файл шарда можно загрузить и опрашивать отдельно (MemNRDB.load).
+
+    Записи направляются в шард hash(id) % shards; новые id выдаются здесь же, так что
+    они уникальны во всей таблице. Запросы (all, limit, order_by, select, count, agg,
+    group_by) рассылаются всем шардам сразу и выполняются параллельно, а результаты
+    сливаются: упорядоченные -- слиянием отсортированных частей, агрегаты -- из частичных
+    агрегатов шардов. Без order_by записи идут по шардам, а не в порядке вставки;
+    с order_by записи без поля сортировки идут в конце по возрастанию id.
+
+    Записи, которые возвращает БД, -- копии: менять их нужно через update/ins_upd.
+
+    >>> sdb = ShardedMemNRDB(shards=2)
+    >>> users = sdb.init_table('users', indexes=['university'])
+    >>> rows = users.insert_many([{'university': 1, 'sex': 1}, {'university': 2}, {'university': 1}])
+    >>> [row['id'] for row in rows]
+    [1, 2, 3]
+    >>> U = Query('users')
+    >>> list(sdb.query((U.university == 1).order_by('id', desc=True).select('id', 'sex')).all())
+    [(3, None), (1, 1)]
+    >>> sdb.query(U).group_by('university').agg(users='count')
+    {2: {'users': 1}, 1: {'users': 2}}
+
+    Сохранить: в db.json -- список шардов, сами шарды -- в db.0.json, db.1.json и т.д.
+    (формат и журнал -- как у MemNRDB.serialize):
+    >>> sdb.serialize('db.json', journal=True) # doctest: +SKIP
+    >>> sdb = ShardedMemNRDB.load('db.json') # doctest: +SKIP
+
+    >>> sdb.close()
+    """
+    VERSION = 0
+
+    def __init__(self, shards: int or None=None):
+        """
+        :param shards: число шардов (по умолчанию -- число ядер)
+        """
+        shards = shards or os.cpu_count() or 1
+        self._start([None] * shards)
+
+    def _start(self, files: List[str or None]):
+        """ Запустить процессы шардов, загрузив их из файлов (None -- пустой шард) """
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        self.shards = len(files)
+        self._tables = {}  # type: Dict[str, ShardedTable]
+        self._conns = []
+        self._processes = []
+        for file_name in files:
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_worker, args=(child_conn, file_name), daemon=True)
+            process.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+        # шарды загружаются параллельно и в ответ присылают имена своих таблиц
+        names = self._call_many({shard: None for shard in range(self.shards)})
+        self._table_names = []  # type: List[str]
+        for shard_names in names.values():
+            for name in shard_names:
+                if name not in self._table_names:
+                    self._table_names.append(name)
+
+    @staticmethod
+    def _shard_file(file_name: str, shard: int) -> str:
+        """ Файл шарда: db.json -> db.0.json, db.json.gz -> db.0.json.gz """
+        root, ext = os.path.splitext(file_name)
+        if ext in MemNRDB.CODEC_EXTENSIONS:
+            root, inner = os.path.splitext(root)
+            ext = inner + ext
+        return "{}.{}{}".format(root, shard, ext)
+
+    def _shard_of(self, _id: int) -> int:
+        return hash(_id) % self.shards
+
+    def _recv(self, shard: int) -> object:
+        status, result = self._conns[shard].recv()
+        if "error" == status:
+            raise DBException("Шард {}: {}".format(shard, result))
+        return result
+
+    def _call(self, shard: int, method: str, *args) -> object:
+        """ Выполнить метод _Shard в шарде и вернуть результат """
+        self._conns[shard].send((method, args))
+        return self._recv(shard)
+
+    def _call_many(self, calls: Dict[int, tuple or None]) -> Dict[int, object]:
+        """
+        Выполнить методы в нескольких шардах параллельно
+        :param calls: шард -> (метод, аргументы); None -- только дождаться ответа шарда
+        :return: шард -> результат
+        """
+        for shard, call in calls.items():
+            if call is not None:
+                self._conns[shard].send(call)
+        results = {}
+        error = None
+        # ответы читаются у всех шардов, даже если кто-то ответил ошибкой
+        for shard in calls:
+            try:
+                results[shard] = self._recv(shard)
+            except DBException as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def _call_all(self, method: str, *args) -> List[object]:
+        """ Выполнить метод во всех шардах параллельно """
+        return list(self._call_many({shard: (method, args) for shard in range(self.shards)}).values())
+
+    def __getitem__(self, table_name: str) -> 'ShardedTable':
+        try:
+            return self._tables[table_name]
+        except KeyError:
+            if table_name not in self._table_names:
+                raise DBException("Не найдена таблица с именем {}".format(table_name))
+        table = ShardedTable(self, table_name, self._call(0, "settings", table_name))
+        self._tables[table_name] = table
+        return table
+
+    def __contains__(self, table_name: str) -> bool:
+        return table_name in self._table_names
+
+    def table_names(self) -> List[str]:
+        return list(self._table_names)
+
+    def init_table(self, table_name: str, **kwargs) -> 'ShardedTable':
+        """
+        Вернуть таблицу по имени. Если её нет -- создать во всех шардах
+        :param table_name:
+        :param kwargs: параметры таблицы, см. Table
+        :return: таблица
+        """
+        if table_name not in self._table_names:
+            self._call_all("init_table", table_name, kwargs)
+            self._table_names.append(table_name)
+        return self[table_name]
+
     def query(self, query: 'Query'):
         new_q = copy.copy(query)
         new_q.db = self
         return new_q
 
+    def _query_rows(self, query: 'Query', count: int or None, to_class: bool or 'Row') -> Iterable[object]:
+        """ Выполнить запрос во всех шардах и слить результаты (count первых, если задан) """
+        if query._select is not None and to_class:
+            raise DBException("Проекцию нельзя преобразовать в класс записи")
+        self[query.table_name]
+        parts = self._call_all("query", copy.copy(query), count)
+        if query._order is None:
+            items = chain.from_iterable(parts)
+        else:
+            # шард отдаёт пары (ключ сортировки, запись); записи без ключа (ключ -- их id)
+            # идут в конце и сливаются по id
+            ordered = [[item for item in part if type(item[0]) is tuple] for part in parts]
+            rest = [[item for item in part if type(item[0]) is not tuple] for part in parts]
+            merged = heapq.merge(*ordered, key=operator.itemgetter(0), reverse=query._order[1])
+            items = (item for key, item in chain(merged, heapq.merge(*rest, key=operator.itemgetter(0))))
+        if count is not None:
+            items = islice(items, count)
+        if query._select is not None:
+            yield from items
+            return
+        for row in items:
+            yield _apply_class(row, to_class)
+
+    def _aggregate(self, aggregation: 'Aggregation', specs: List[tuple]) -> dict:
+        """ Посчитать частичные агрегаты в шардах и объединить их """
+        partial = {}
+        for name, func, path in specs:
+            if "avg" == func:
+                # среднее собирается из сумм и количеств шардов
+                partial[name] = ("sum",) + tuple(path)
+                partial[name + "\0count"] = ("count",) + tuple(path)
+            else:
+                partial[name] = (func,) + tuple(path)
+        self[aggregation.query.table_name]
+        parts = self._call_all("agg", copy.copy(aggregation.query), aggregation.group_path, partial)
+        if not aggregation.group_path:
+            return self._merge_aggregates(specs, parts)
+        groups = {}  # type: Dict[object, List[dict]]
+        for part in parts:
+            for key, values in part.items():
+                groups.setdefault(key, []).append(values)
+        return {key: self._merge_aggregates(specs, values) for key, values in groups.items()}
+
+    @staticmethod
+    def _merge_aggregates(specs: List[tuple], parts: List[dict]) -> dict:
+        """ Агрегаты группы по частичным агрегатам шардов """
+        result = {}
+        for name, func, path in specs:
+            values = [part[name] for part in parts]
+            if "avg" == func:
+                count = sum(part[name + "\0count"] for part in parts)
+                result[name] = sum(values) / count if count else None
+            elif "count" == func or "sum" == func:
+                result[name] = sum(values)
+            else:
+                values = [value for value in values if value is not None]
+                result[name] = (min if "min" == func else max)(values) if values else None
+        return result
+
+    def clear_query_cache(self):
+        """ Очистить кеш результатов запросов во всех шардах """
+        self._call_all("clear_query_cache")
+
+    def serialize(self, file_name: str, pretty: bool=False, journal: bool=False, fmt: str or None=None,
+                  codec: str or None=None):
+        """
+        Сохранить все шарды (параллельно) и список шардов в file_name
+        :param file_name: имя файла со списком шардов; шарды пишутся рядом, см. _shard_file
+        :param pretty: красивый вывод в файл
+        :param journal: дописать в журналы шардов только изменения, см. MemNRDB.serialize
+        :param fmt: формат снимков шардов: "json" или "binary" (по умолчанию -- по расширению файла)
+        :param codec: сжатие снимков шардов и списка шардов, см. MemNRDB.serialize
+        """
+        codec = MemNRDB._snapshot_codec(file_name, codec)
+        files = [self._shard_file(file_name, shard) for shard in range(self.shards)]
+        self._call_many({shard: ("serialize", (files[shard], pretty, journal, fmt, codec))
+                         for shard in range(self.shards)})
+        with _open_codec(file_name, "wt", codec) as f:
+            json.dump({"__ShardedMemNRDB__": True,
+                       "__version__": self.VERSION,
+                       "__shards__": [os.path.basename(name) for name in files]}, f)
+
+    @classmethod
+    def load(cls, file_name: str) -> 'ShardedMemNRDB':
+        """
+        Загрузить БД: каждый шард загружает свой файл (вместе с журналом) в своём процессе
+        :param file_name: имя файла со списком шардов
+        :return:
+        """
+        with _open_codec(file_name, "rt", MemNRDB._detect_codec(file_name)) as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict) or "__ShardedMemNRDB__" not in manifest:
+            raise DBException("В файле `{}` нет списка шардов".format(file_name))
+        if manifest["__version__"] != cls.VERSION:
+            raise DBException("Версия БД не совместима. Ожадиается: {}; Получена: {}".format(
+                cls.VERSION, manifest["__version__"]
+            ))
+        directory = os.path.dirname(file_name)
+        db = cls.__new__(cls)
+        db._start([os.path.join(directory, name) for name in manifest["__shards__"]])
+        return db
+
+    def close(self):
+        """ Остановить процессы шардов (несохранённые изменения теряются) """
+        for conn in self._conns:
+            try:
+                conn.send(("close", ()))
+            except OSError:
+                pass
+        for conn, process in zip(self._conns, self._processes):
+            process.join()
+            conn.close()
+        self._conns = []
+        self._processes = []
+
+    def __enter__(self) -> 'ShardedMemNRDB':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def __str__(self):
-        return "<MemNRDB>, {} tables".format(len(self.tables))
+        return "<ShardedMemNRDB>, {} shards, {} tables".format(self.shards, len(self._table_names))
+
+
+class ShardedTable:
+    """
+    Таблица ShardedMemNRDB: направляет записи в шарды по id.
+    Повторяет интерфейс Table для записи и чтения по id; запросы -- через ShardedMemNRDB.query.
+    """
+    def __init__(self, db: ShardedMemNRDB, name: str, settings: dict):
+        self.db = db
+        self.name = name
+        self.convert = settings["convert"]
+        self.convert_exclude = settings["convert_exclude"]
+        self._next_id = None  # следующий свободный id (узнаётся у шардов при первой выдаче)
+
+    def _row_id(self, row: dict, operation: str) -> int:
+        """ id записи, сконвертированный так же, как это сделает таблица шарда """
+        _id = row['id']
+        if isinstance(_id, str) and self.convert and "id" not in self.convert_exclude:
+            _id = row['id'] = _convert_str(_id)
+        if not isinstance(_id, int):
+            raise DBIndexError(self, operation, "поле id должен быть числом, а не `{}` ({})".format(_id, type(_id)))
+        if self._next_id is not None and _id >= self._next_id:
+            self._next_id = _id + 1
+        return _id
+
+    def _new_id(self) -> int:
+        if self._next_id is None:
+            self._next_id = max(self.db._call_all("max_id", self.name)) + 1
+        _id = self._next_id
+        self._next_id += 1
+        return _id
+
+    def _check_rows(self, rows: List[dict], operation: str):
+        for row in rows:
+            if not isinstance(row, dict):
+                raise DBTypeError(self, operation, 'row', row, dict)
+
+    def _dispatch(self, method: str, rows: List[dict]) -> List[dict]:
+        """ Разослать записи с id по шардам одной пачкой на шард и вернуть ответы в исходном порядке """
+        batches = {}  # type: Dict[int, List[dict]]
+        positions = {}  # type: Dict[int, List[int]]
+        for pos, row in enumerate(rows):
+            shard = self.db._shard_of(row['id'])
+            batches.setdefault(shard, []).append(row)
+            positions.setdefault(shard, []).append(pos)
+        results = self.db._call_many({shard: (method, (self.name, batch)) for shard, batch in batches.items()})
+        stored = [None] * len(rows)
+        for shard, shard_rows in results.items():
+            for pos, row in zip(positions[shard], shard_rows):
+                stored[pos] = row
+        return stored
+
+    def insert(self, row: dict) -> dict:
+        """
+        Вставить уникальную запись, см. Table.insert
+        :param row: запись
+        :return: запись из БД (копия)
+        """
+        return self.insert_many([row])[0]
+
+    def insert_many(self, rows: Iterable[dict]) -> List[dict]:
+        """
+        Вставить пачку уникальных записей, см. Table.insert_many.
+        Заданные id проверяются во всех шардах до вставки, поэтому при ошибке таблица не меняется
+        :param rows: записи
+        :return: записи из БД (копии)
+        """
+        rows = list(rows)
+        self._check_rows(rows, "insert_many")
+        reserved = set()
+        for row in rows:
+            if "id" in row:
+                _id = self._row_id(row, "insert_many")
+                if _id in reserved:
+                    raise DBIndexError(self, 'insert_many', "id {} встречается в пачке дважды".format(_id))
+                reserved.add(_id)
+        if reserved:
+            batches = {}  # type: Dict[int, List[int]]
+            for _id in reserved:
+                batches.setdefault(self.db._shard_of(_id), []).append(_id)
+            found = self.db._call_many({shard: ("existing", (self.name, ids)) for shard, ids in batches.items()})
+            for ids in found.values():
+                if ids:
+                    raise DBIndexError(self, 'insert_many', "Запись с данным id ({}) уже есть в таблице".format(ids[0]))
+        for row in rows:
+            if "id" not in row:
+                _id = self._new_id()
+                while _id in reserved:
+                    _id = self._new_id()
+                row["id"] = _id
+        return self._dispatch("insert_many", rows)
+
+    def ins_upd(self, row: dict) -> dict:
+        """
+        Создать или обновить запись, см. Table.ins_upd
+        :param row: запись
+        :return: запись из БД (копия)
+        """
+        return self.upsert_many([row])[0]
+
+    def upsert_many(self, rows: Iterable[dict]) -> List[dict]:
+        """
+        Создать или обновить пачку записей, см. Table.upsert_many
+        :param rows: записи
+        :return: записи из БД (копии)
+        """
+        rows = list(rows)
+        self._check_rows(rows, "upsert_many")
+        for row in rows:
+            if "id" in row:
+                self._row_id(row, "upsert_many")
+        for row in rows:
+            if "id" not in row:
+                row["id"] = self._new_id()
+        return self._dispatch("upsert_many", rows)
+
+    def update(self, row: dict) -> dict:
+        """
+        Обновить существующую запись, см. Table.update
+        :param row: новая запись
+        :return: обновлённая запись из БД (копия)
+        """
+        if not isinstance(row, dict):
+            raise DBTypeError(self, "update", 'row', row, dict)
+        if 'id' not in row:
+            raise DBIndexError(self, 'update', "не найден id записи")
+        return self.db._call(self.db._shard_of(row['id']), "update", self.name, row)
+
+    def get(self, _id: int, to_class: bool or 'Row'=False) -> dict or 'Row':
+        """
+        Вернуть запись по id
+        :param _id: id записи
+        :param to_class: обработка записи, см. Table.rows
+        :return: запись (копия)
+        """
+        return _apply_class(self.db._call(self.db._shard_of(_id), "get", self.name, _id), to_class)
+
+    def rows(self, to_class: bool or 'Row'=False) -> Iterable[dict or 'Row']:
+        """ Все записи таблицы, шард за шардом (копии) """
+        for shard in range(self.db.shards):
+            for row in self.db._call(shard, "rows", self.name):
+                yield _apply_class(row, to_class)
+
+    def create_index(self, field: str or tuple, kind: str="hash", multi: bool=False):
+        """ Создать индекс по полю во всех шардах, см. Table.create_index """
+        self.db._call_all("create_index", self.name, field, kind, multi)
+
+    def drop_index(self, field: str or tuple):
+        """ Удалить индекс по полю во всех шардах """
+        self.db._call_all("drop_index", self.name, field)
+
+    def __len__(self):
+        return sum(self.db._call_all("count", self.name))
+
+    def __str__(self):
+        return "<ShardedMemNRDB.Table:{}>, {} shards".format(self.name, self.db.shards)
+
+
+class _Shard:
+    """ Шард ShardedMemNRDB: MemNRDB в процессе шарда; методы вызываются координатором """
+    def __init__(self, file_name: str or None):
+        self.db = MemNRDB.load(file_name) if file_name is not None else MemNRDB()
+
+    def table_names(self) -> List[str]:
+        return self.db.table_names()
+
+    def init_table(self, name: str, kwargs: dict):
+        self.db.init_table(name, **kwargs)
+
+    def settings(self, name: str) -> dict:
+        return self.db[name]._settings()
+
+    def max_id(self, name: str) -> int:
+        return max(self.db[name].meta_data, default=0)
+
+    def existing(self, name: str, ids: List[int]) -> List[int]:
+        meta_data = self.db[name].meta_data
+        return [_id for _id in ids if _id in meta_data]
+
+    def insert_many(self, name: str, rows: List[dict]) -> List[dict]:
+        return [dict(row) for row in self.db[name].insert_many(rows)]
+
+    def upsert_many(self, name: str, rows: List[dict]) -> List[dict]:
+        return [dict(row) for row in self.db[name].upsert_many(rows)]
+
+    def update(self, name: str, row: dict) -> dict:
+        return dict(self.db[name].update(row))
+
+    def get(self, name: str, _id: int) -> dict:
+        return dict(self.db[name].get(_id))
+
+    def rows(self, name: str) -> List[dict]:
+        return [dict(row) for _id, row in self.db[name]._scan_items()]
+
+    def count(self, name: str) -> int:
+        return len(self.db[name])
+
+    def create_index(self, name: str, field: str or tuple, kind: str, multi: bool):
+        self.db[name].create_index(field, kind, multi)
+
+    def drop_index(self, name: str, field: str or tuple):
+        self.db[name].drop_index(field)
+
+    def query(self, query: 'Query', count: int or None) -> list:
+        """
+        Записи (или проекции), прошедшие фильтр; с order_by -- пары (ключ сортировки, запись),
+        где ключ записи без значения для сортировки -- её id
+        """
+        db = self.db
+        if query._order is None:
+            items = query.all(db) if count is None else query.limit(count, db)
+            if query._select is not None:
+                return list(items)
+            return [dict(row) for row in items]
+        table = db[query.table_name]
+        path = query._order[0]
+        project = query._projector() if query._select is not None else None
+        peek = table._peek
+        result = []
+        for _id in query._ordered_ids(db, table, count):
+            row = peek(_id)
+            cls = SortedIndex.order_class(_value_by_path(row, path))
+            key = _id if cls is None else (cls, _value_by_path(row, path), _id)
+            result.append((key, dict(row) if project is None else project(_id, row)))
+        return result
+
+    def agg(self, query: 'Query', group_path: List[object] or None, aggregates: dict) -> dict:
+        return Aggregation(query, group_path).agg(self.db, **aggregates)
+
+    def clear_query_cache(self):
+        self.db.clear_query_cache()
+
+    def serialize(self, file_name: str, pretty: bool, journal: bool, fmt: str or None, codec: str or None):
+        self.db.serialize(file_name, pretty, journal, fmt, codec)
+
+
+def _shard_worker(conn: object, file_name: str or None):
+    """ Процесс шарда: загрузить шард и выполнять присланные координатором методы """
+    try:
+        shard = _Shard(file_name)
+    except Exception as e:
+        conn.send(("error", "{}: {}".format(type(e).__name__, e)))
+        conn.close()
+        return
+    conn.send(("ok", shard.table_names()))
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:
+            break
+        if "close" == method:
+            break
+        try:
+            result = getattr(shard, method)(*args)
+        except Exception as e:
+            conn.send(("error", str(e) if isinstance(e, DBException) else "{}: {}".format(type(e).__name__, e)))
+        else:
+            conn.send(("ok", result))
+    conn.close()
+
+
+def _binary_table_loader(view: memoryview, table_name: str, info: dict):
+    """ Отложенное создание таблицы из секции бинарного снимка """
+    def load() -> Table:
+        table = Table(table_name, **info["settings"])
+        table._load_pool(info.get("strings", []))
+        count = info["count"]
+        ids = view[info["ids"]:info["ids"] + 8 * count].cast('q')
+        offsets = view[info["offsets"]:info["offsets"] + 8 * (count + 1)].cast('q')
+        data = view[info["data"]:info["data"] + offsets[count]]
+        rows = MappedRows(data, ids, offsets, table._strings)
+        if table.columns or table.compact:
+            # колоночные и компактные записи раскладываются по своему хранилищу сразу
+            for _id, row in rows.scan():
+                table._place(_id, row)
+        else:
+            table.meta_data = rows
+        table.index_count = info["index_count"]
+        return table
+    return load
+
+
+def _json_types(value: object) -> object:
+    """
+    Значение с теми же типами, что после JSON: кортежи и множества (в том числе
+    вложенные) становятся списками. Копируются только изменившиеся контейнеры
+    """
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, list):
+        items = value
+    elif isinstance(value, (tuple, set, frozenset)):
+        return [_json_types(item) for item in value]
+    else:
+        return value
+    # обычно в контейнере одни строки и числа -- он остаётся как есть
+    if _SCALAR_TYPES.issuperset(map(type, items)):
+        return value
+    is_dict = isinstance(value, dict)
+    result = value
+    for key, item in (value.items() if is_dict else enumerate(value)):
+        if item.__class__ in _SCALAR_TYPES:
+            continue
+        new = _json_types(item)
+        if new is not item:
+            if result is value:
+                result = dict(value) if is_dict else list(value)
+            result[key] = new
+    return result
+
+
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+
+
+class _RowPickler(pickle.Pickler):
+    """ Сериализатор записей бинарного снимка: объект, который не данные, -- ошибка уже при записи """
+    def reducer_override(self, obj: object):
+        # вызывается только для объектов, которые pickle не умеет записывать сам: не для dict, str, int...
+        raise DBException("Значение {!r} типа {} нельзя записать в снимок: в записях могут быть только данные".format(
+            obj, type(obj).__name__))
+
+
+class _RowUnpickler(pickle.Unpickler):
+    """
+    Распаковщик записей бинарного снимка. Записи -- только данные, поэтому
+    классы и функции не загружаются: иначе открытие чужого снимка могло бы
+    выполнить произвольный код
+    """
+    def find_class(self, module: str, name: str):
+        raise DBException("Запись в снимке ссылается на {}.{}: в снимке могут быть только данные".format(
+            module, name))
+
+
+def _row_dumps(codes: Dict[str, int] or None=None):
+    """
+    Сериализатор записей таблицы в бинарный снимок (один Pickler на всю таблицу)
+    :param codes: пул строк таблицы: строки из него записываются номерами
+    """
+    class Pickler(_RowPickler):
+        def persistent_id(self, obj):
+            return codes.get(obj) if type(obj) is str else None
+
+    buf = io.BytesIO()
+    pickler = Pickler(buf, pickle.HIGHEST_PROTOCOL) if codes else _RowPickler(buf, pickle.HIGHEST_PROTOCOL)
+
+    def dumps(row: dict) -> bytes:
+        buf.seek(0)
+        buf.truncate()
+        # каждая запись декодируется отдельно -- ссылок на предыдущие быть не должно
+        pickler.clear_memo()
+        pickler.dump(_json_types(row))
+        return buf.getvalue()
+    return dumps
+
+
+def _compact_journal(file_name: str):
+    """
+    Влить отложенный журнал (file_name.journal.compacting) в снимок file_name.
+    Записи журнала -- полные состояния строк, поэтому повторное вливание после
+    падения безопасно.
+    """
+    compacting_name = file_name + MemNRDB.JOURNAL_SUFFIX + MemNRDB.COMPACTING_SUFFIX
+    db = MemNRDB._load_snapshot(file_name)
+    db._replay_journal(compacting_name)
+    db._write_snapshot(file_name, fmt=MemNRDB._detect_format(file_name), codec=MemNRDB._detect_codec(file_name))
+    os.remove(compacting_name)
+
+
+def _convert_str(value: str) -> str or int or float:
+    """ Строка -> int или float (если в ней есть точка); если не получилось -- сама строка """
+    first = value[:1]
+    # быстрый отказ для обычного текста, чтобы не ловить исключение на каждом имени
+    if not first or not (first.isdigit() or first.isspace() or first in "+-."):
+        return value
+    try:
+        if "." in value:
+            return float(value)
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _apply_class(row: dict, to_class: bool or 'Row', table: 'Table' or None=None):
+    """
+    Обработать запись, см. Table.rows
+    :param table: таблица, в которой хранится сама запись: изменения через Row
+                  отмечаются в ней (Table.touch), чтобы кеш запросов их увидел
+    """
+    if to_class is False:
+        return row
+    elif to_class is True:
+        result = Row(row)
+    else:
+        result = to_class(row)
+    if table is not None and isinstance(result, Row):
+        object.__setattr__(result, "_table", table)
+    return result
+
+
+class Index:
+    """
+    Базовый класс индекса по полю таблицы.
+
+    Индекс, созданный для таблицы, строится лениво -- при первом чтении из него:
+    до этого изменения записей он игнорирует, а при построении сразу видит
+    актуальное состояние таблицы. Так загрузка БД не платит за индексы,
+    которые не понадобились.
+
+    Поле задаётся именем или кортежем -- путём к вложенному полю. Многозначный
+    индекс (multi) хранит не само значение, а каждый элемент поля-списка:
+    он отвечает на запросы Query.any().
+
+    Вложенное поле и поле-список легко изменить на месте (user.cost[...] = ...)
+    ещё до update, поэтому такие индексы помнят, с какими ключами добавлена
+    каждая запись, и убирают её по ним, а не по текущему содержимому записи.
+    """
+    kind = None
+
+    def __init__(self, field: str or tuple, multi: bool=False):
+        self.field = field  # поле или путь к нему (ключ индекса в Table.indexes)
+        self.path = list(field) if isinstance(field, tuple) else [field]
+        self.multi = multi  # индексируются элементы поля-списка
+        self._table = None  # type: Table  # таблица, по которой индекс ещё предстоит построить
+        # id -> ключи, с которыми запись попала во вложенный или многозначный индекс
+        self._keys = {} if multi or len(self.path) > 1 else None  # type: Dict[int, tuple]
+
+    @property
+    def name(self) -> str:
+        """ Имя индекса: путь через точку, у многозначного -- с `[]` в конце """
+        return ".".join(str(p) for p in self.path) + ("[]" if self.multi else "")
+
+    def value(self, row: dict) -> object or None:
+        """ Индексируемое значение записи (по тем же правилам, что и Query._get_val_by_path) """
+        if 1 == len(self.path):
+            return row.get(self.field)
+        value = row
+        for p in self.path:
+            try:
+                if p not in value:
+                    return None
+                value = value[p]
+            except (TypeError, LookupError):
+                return None
+        return value
+
+    def add_row(self, _id: int, row: dict):
+        """ Добавить запись в индекс """
+        if self._table is not None:
+            return
+        value = self.value(row)
+        keys = tuple(_elements(value)) if self.multi else (value,)
+        if self._keys is not None:
+            self._keys[_id] = keys
+        for key in keys:
+            self.add(_id, key)
+
+    def remove_row(self, _id: int, row: dict):
+        """
+        Убрать запись из индекса
+        :param _id: id записи
+        :param row: запись в том виде, в котором её добавляли (вложенному и
+                    многозначному индексу не нужна: ключи он запомнил сам)
+        """
+        if self._table is not None:
+            return
+        if self._keys is not None:
+            keys = self._keys.pop(_id, ())
+        else:
+            keys = (self.value(row),)
+        for key in keys:
+            self.remove(_id, key)
+
+    def defer(self, table: 'Table'):
+        """ Отложить построение индекса по таблице до первого чтения """
+        self.clear()
+        if self._keys is not None:
+            self._keys = {}
+        self._table = table
+
+    @property
+    def built(self) -> bool:
+        return self._table is None
+
+    def _ensure(self):
+        """ Построить отложенный индекс """
+        table = self._table
+        if table is not None:
+            self._table = None
+            for _id, row in table._scan_items():
+                self.add_row(_id, row)
+
+    def add(self, _id: int, value: object):
+        raise NotImplementedError()
+
+    def remove(self, _id: int, value: object):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self) -> dict:
+        """ Размер индекса; ещё не построенный индекс не строится и памяти не занимает """
+        return {"kind": self.kind, "built": self.built, "entries": 0, "bytes": 0}
+
+
+class HashIndex(Index):
+    """
+    Хеш-индекс по полю таблицы: значение поля -> множество id записей.
+    Отвечает только на запросы на равенство.
+
+    Записи, в которых поля нет (или оно None), а также записи с нехешируемым
+    значением (list, dict) в индекс не попадают: такие значения никогда не
+    равны хешируемому значению запроса.
+
+    >>> index = HashIndex('university')
+    >>> index.add(1, 671)
+    >>> index.add(2, 671)
+    >>> sorted(index.lookup(671))
+    [1, 2]
+    >>> index.remove(1, 671)
+    >>> sorted(index.lookup(671))
+    [2]
+    """
+    kind = "hash"
+
+    def __init__(self, field: str or tuple, multi: bool=False):
+        super().__init__(field, multi)
+        self.data = {}  # type: Dict[object, Set[int]]
+
+    @staticmethod
+    def hashable(value: object) -> bool:
+        """ Можно ли положить значение в индекс """
+        try:
+            hash(value)
+        except TypeError:
+            return False
+        return True
+
+    def add(self, _id: int, value: object):
+        """
+        Добавить запись в индекс
+        :param _id: id записи
+        :param value: значение индексируемого поля
+        """
+        if self._table is not None or value is None or not self.hashable(value):
+            return
+        ids = self.data.get(value)
+        if ids is None:
+            ids = self.data[value] = set()
+        ids.add(_id)
+
+    def remove(self, _id: int, value: object):
+        """
+        Убрать запись из индекса
+        :param _id: id записи
+        :param value: значение индексируемого поля, с которым запись была добавлена
+        """
+        if self._table is not None or value is None or not self.hashable(value):
+            return
+        ids = self.data.get(value)
+        if ids is not None:
+            ids.discard(_id)
+            if not ids:
+                del self.data[value]
+
+    def lookup(self, value: object) -> Set[int]:
+        """
+        Вернуть id записей, у которых поле равно value.
+        Возвращаемое множество принадлежит индексу, изменять его нельзя.
+        :param value: искомое значение (должно быть хешируемым)
+        :return: множество id
+        """
+        self._ensure()
+        return self.data.get(value, _EMPTY_IDS)
+
+    def counts(self) -> Dict[object, int]:
+        """ Число записей для каждого значения поля """
+        self._ensure()
+        return {value: len(ids) for value, ids in self.data.items()}
+
+    def candidates(self, method_name: str, value: object) -> Iterable[int] or None:
+        """
+        Вернуть id записей, которые могут пройти проверку `поле <method_name> value`,
+        или None, если индекс не умеет отвечать на такой запрос
+        """
+        if "__eq__" == method_name and self.hashable(value):
+            return self.lookup(value)
+        return None
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        """ Размер индекса: keys -- различных значений, entries -- записей """
+        stats = super().stats()
+        stats["keys"] = len(self.data)
+        stats["entries"] = sum(len(ids) for ids in self.data.values())
+        if self.built:
+            stats["bytes"] = sys.getsizeof(self.data) + sum(sys.getsizeof(ids) for ids in self.data.values())
+        return stats
+
+    def __len__(self):
+        """ Количество различных значений в индексе """
+        self._ensure()
+        return len(self.data)
+
+
+def _elements(value: object) -> List[object]:
+    """ Различные хешируемые элементы поля-списка (для многозначного индекса) """
+    if not isinstance(value, (list, tuple, set, frozenset)):
+        return []
+    seen = set()
+    items = []
+    for item in value:
+        try:
+            if item in seen:
+                continue
+            seen.add(item)
+        except TypeError:
+            continue
+        items.append(item)
+    return items
+
+
+_EMPTY_IDS = frozenset()  # type: Set[int]
+_ABSENT = object()  # в снимке: записи ещё не было
+_INF = float('inf')
+
+
+class SortedIndex(Index):
+    """
+    Упорядоченный индекс по полю таблицы: отсортированный массив (класс, значение, id),
+    поиск в котором делается бисекцией.
+
+    Отвечает на `==`, `<`, `<=`, `>`, `>=` и диапазоны за O(log n + k), а также
+    умеет отдавать id записей в порядке значений поля.
+    Числа и строки друг с другом не сравниваются, поэтому хранятся в разных
+    «классах» массива; остальные значения (списки, словари, NaN) в индекс не попадают.
+
+    Изменения копятся и вливаются в массив при первом чтении, чтобы массовая
+    вставка не превращалась в O(n) сдвигов на каждую запись.
+
+    >>> index = SortedIndex('graduation')
+    >>> for _id, year in enumerate([2014, 2016, 2015, 2017], 1):
+    ...     index.add(_id, year)
+    >>> index.range(2015, 2016)
+    [3, 2]
+    >>> index.candidates('__gt__', 2015)
+    [2, 4]
+    >>> list(index.ids(reverse=True))
+    [4, 2, 3, 1]
+    """
+    kind = "sorted"
+
+    # Через сколько накопленных изменений массив пересобирается целиком, а не вставками
+    REBUILD_THRESHOLD = 64
+
+    def __init__(self, field: str or tuple, multi: bool=False):
+        super().__init__(field, multi)
+        self.entries = []  # type: List[tuple]
+        self._delta = {}  # type: Dict[tuple, int]
+
+    @staticmethod
+    def order_class(value: object) -> int or None:
+        """ Класс значения в индексе: 0 -- числа, 1 -- строки, None -- не индексируется """
+        if isinstance(value, (int, float)):
+            return None if value != value else 0  # NaN ни с чем не сравнивается
+        if isinstance(value, str):
+            return 1
+        return None
+
+    def _change(self, _id: int, value: object, delta: int):
+        if self._table is not None:
+            return
+        cls = self.order_class(value)
+        if cls is None:
+            return
+        entry = (cls, value, _id)
+        count = self._delta.get(entry, 0) + delta
+        if delta < 0 and count < 0 and not self._stored(entry):
+            # такой пары в индексе нет: удаление не должно отменить ещё не влитое добавление
+            return
+        if count:
+            self._delta[entry] = count
+        else:
+            del self._delta[entry]
+
+    def _stored(self, entry: tuple) -> bool:
+        """ Есть ли entry в уже отсортированной части индекса """
+        pos = bisect.bisect_left(self.entries, entry)
+        return pos < len(self.entries) and self.entries[pos] == entry
+
+    def add(self, _id: int, value: object):
+        """
+        Добавить запись в индекс
+        :param _id: id записи
+        :param value: значение индексируемого поля
+        """
+        self._change(_id, value, 1)
+
+    def remove(self, _id: int, value: object):
+        """
+        Убрать запись из индекса
+        :param _id: id записи
+        :param value: значение индексируемого поля, с которым запись была добавлена
+        """
+        self._change(_id, value, -1)
+
+    def _flush(self):
+        """ Влить накопленные изменения в отсортированный массив """
+        self._ensure()
+        if not self._delta:
+            return
+        entries = self.entries
+        if len(self._delta) <= self.REBUILD_THRESHOLD:
+            for entry, count in self._delta.items():
+                if count > 0:
+                    bisect.insort(entries, entry)
+                else:
+                    pos = bisect.bisect_left(entries, entry)
+                    if pos < len(entries) and entries[pos] == entry:
+                        del entries[pos]
+        else:
+            removed = {entry for entry, count in self._delta.items() if count < 0}
+            if removed:
+                entries = [entry for entry in entries if entry not in removed]
+            entries.extend(entry for entry, count in self._delta.items() if count > 0)
+            # timsort сливает два уже упорядоченных куска за линейное время
+            entries.sort()
+            self.entries = entries
+        self._delta.clear()
+
+    def _bounds(self, cls: int, lo: object, hi: object, lo_inclusive: bool, hi_inclusive: bool) -> (int, int):
+        """ Границы среза entries для значений класса cls из диапазона [lo, hi] """
+        entries = self.entries
+        if lo is None:
+            start = bisect.bisect_left(entries, (cls,))
+        elif lo_inclusive:
+            start = bisect.bisect_left(entries, (cls, lo))
+        else:
+            start = bisect.bisect_right(entries, (cls, lo, _INF))
+        if hi is None:
+            end = bisect.bisect_left(entries, (cls + 1,))
+        elif hi_inclusive:
+            end = bisect.bisect_right(entries, (cls, hi, _INF))
+        else:
+            end = bisect.bisect_left(entries, (cls, hi))
+        return start, max(start, end)
+
+    def range(self, lo: object=None, hi: object=None,
+              lo_inclusive: bool=True, hi_inclusive: bool=True) -> List[int]:
+        """
+        Вернуть id записей со значением поля в диапазоне от lo до hi (в порядке значений).
+        None вместо границы -- диапазон не ограничен с этой стороны.
+        Границы должны быть одного класса (обе числа или обе строки).
+        В многозначном индексе запись выдаётся один раз, даже если в диапазон попали несколько её элементов.
+        :return: список id
+        """
+        cls = self.order_class(lo if lo is not None else hi)
+        if cls is None or (hi is not None and self.order_class(hi) != cls):
+            raise DBException("Границы диапазона `{}`, `{}` нельзя искать в индексе".format(lo, hi))
+        self._flush()
+        start, end = self._bounds(cls, lo, hi, lo_inclusive, hi_inclusive)
+        ids = [entry[2] for entry in self.entries[start:end]]
+        return list(dict.fromkeys(ids)) if self.multi else ids
+
+    def candidates(self, method_name: str, value: object) -> Iterable[int] or None:
+        """
+        Вернуть id записей, которые могут пройти проверку `поле <method_name> value`,
+        или None, если индекс не умеет отвечать на такой запрос
+        """
+        if self.order_class(value) is None:
+            return None
+        if "__eq__" == method_name:
+            return self.range(value, value)
+        if "__lt__" == method_name:
+            return self.range(hi=value, hi_inclusive=False)
+        if "__le__" == method_name:
+            return self.range(hi=value)
+        if "__gt__" == method_name:
+            return self.range(lo=value, lo_inclusive=False)
+        if "__ge__" == method_name:
+            return self.range(lo=value)
+        return None
+
+    def ids(self, reverse: bool=False) -> Iterable[int]:
+        """
+        id всех проиндексированных записей в порядке значений поля
+        (сначала числа, потом строки)
+        :param reverse: в обратном порядке
+        """
+        self._flush()
+        entries = reversed(self.entries) if reverse else iter(self.entries)
+        for entry in entries:
+            yield entry[2]
+
+    def clear(self):
+        self.entries = []
+        self._delta.clear()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        if self.built:
+            self._flush()
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = sys.getsizeof(self.entries) + len(self.entries) * sys.getsizeof((0, 0, 0))
+        return stats
+
+    def __len__(self):
+        """ Количество записей в индексе """
+        self._flush()
+        return len(self.entries)
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(value: object) -> int:
+    """
+    64-битный хеш значения для сводок. hash() целого числа -- само число,
+    поэтому биты перемешиваются (финализатор splitmix64)
+    """
+    h = hash(value) & _MASK64
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return h ^ (h >> 31)
+
+
+class Sketch(Index):
+    """
+    Базовый класс приближённой сводки по полю таблицы: память постоянна и не
+    зависит от числа записей. Путь к полю и ленивое построение -- как у индекса;
+    многозначная сводка (multi) учитывает каждый элемент поля-списка, а у
+    поля-словаря -- каждый его ключ. Нехешируемые значения и None не учитываются.
+
+    Сводка, из которой значения вычитаются, по вложенному или многозначному полю,
+    как и индекс, помнит учтённые значения каждой записи: поле могли изменить
+    на месте до update, и вычитать по текущей записи нельзя.
+    """
+
+    def items(self, row: dict) -> List[object]:
+        """ Значения записи, которые учитывает сводка """
+        value = self.value(row)
+        if not self.multi:
+            return [value]
+        return _elements(list(value) if isinstance(value, dict) else value)
+
+    def add_row(self, _id: int, row: dict):
+        if self._table is not None:
+            return
+        items = [item for item in self.items(row) if item is not None and HashIndex.hashable(item)]
+        if self._keys is not None:
+            self._keys[_id] = tuple(items)
+        for item in items:
+            self.add(_id, item)
+
+    def remove_row(self, _id: int, row: dict):
+        if self._table is not None:
+            return
+        if self._keys is not None:
+            items = self._keys.pop(_id, ())
+        else:
+            items = [item for item in self.items(row) if item is not None and HashIndex.hashable(item)]
+        for item in items:
+            self.remove(_id, item)
+
+
+class HyperLogLog(Sketch):
+    """
+    Оценка числа различных значений поля (HyperLogLog): 2 ** PRECISION регистров
+    по байту, стандартная ошибка -- около 1.04 / sqrt(2 ** PRECISION) (1.6%).
+    Удалить значение из сводки нельзя, поэтому после update в оценку входят все
+    значения, встречавшиеся с момента её построения.
+
+    >>> hll = HyperLogLog('city')
+    >>> for i in range(1000):
+    ...     hll.add(i, i % 100)
+    >>> 95 <= hll.count() <= 105
+    True
+    """
+    kind = "hll"
+
+    PRECISION = 12
+
+    def __init__(self, field: str or tuple, multi: bool=False):
+        super().__init__(field, multi)
+        self._keys = None  # значения из сводки не вычитаются -- помнить их незачем
+        self.registers = bytearray(1 << self.PRECISION)
+
+    def add(self, _id: int, value: object):
+        """
+        Учесть значение
+        :param _id: id записи (не используется)
+        :param value: хешируемое значение поля
+        """
+        h = _hash64(value)
+        bits = 64 - self.PRECISION
+        register = h >> bits
+        # номер первой единицы в оставшихся битах
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def remove(self, _id: int, value: object):
+        pass
+
+    def count(self) -> int:
+        """ Оценка числа различных значений """
+        self._ensure()
+        registers = self.registers
+        m = len(registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in registers)
+        zeros = registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            # на малых числах точнее линейный подсчёт по пустым регистрам
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def clear(self):
+        self.registers = bytearray(1 << self.PRECISION)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        if self.built:
+            stats["entries"] = len(self.registers)
+            stats["bytes"] = sys.getsizeof(self.registers)
+        return stats
+
+
+class CountMinSketch(Sketch):
+    """
+    Частоты значений поля (count-min sketch): DEPTH строк по WIDTH счётчиков.
+    Оценка частоты не меньше настоящей и превышает её не больше чем на
+    e / WIDTH от числа учтённых значений (с вероятностью 1 - e ** -DEPTH).
+    Самые частые значения (heavy hitters) выбираются из TOP кандидатов, которые
+    обновляются при каждом добавлении. При update старое значение вычитается.
+
+    >>> cms = CountMinSketch('cost', multi=True)
+    >>> for i in range(100):
+    ...     cms.add_row(i, {'cost': {'group_a': 1, 'group_b' if i % 4 else 'group_c': 2}})
+    >>> cms.heavy_hitters(2)
+    [('group_a', 100), ('group_b', 75)]
+    """
+    kind = "cms"
+
+    WIDTH = 2048
+    DEPTH = 4
+    TOP = 32
+
+    def __init__(self, field: str or tuple, multi: bool=False):
+        super().__init__(field, multi)
+        self.counters = []  # type: List[array]
+        self.total = 0  # сколько значений учтено
+        self.top = {}  # type: Dict[object, int]  # кандидаты в самые частые -> оценка частоты
+        self._floor = 0  # оценка самого редкого кандидата (может быть занижена)
+        self.clear()
+
+    def _cells(self, value: object) -> List[int]:
+        """ Номер счётчика значения в каждой строке (двойное хеширование) """
+        h = _hash64(value)
+        low, high = h & 0xffffffff, (h >> 32) | 1
+        width = self.WIDTH
+        return [(low + i * high) % width for i in range(self.DEPTH)]
+
+    def _change(self, value: object, delta: int) -> int:
+        """ Изменить счётчики значения и вернуть новую оценку его частоты """
+        estimate = None
+        for counters, cell in zip(self.counters, self._cells(value)):
+            counters[cell] += delta
+            if estimate is None or counters[cell] < estimate:
+                estimate = counters[cell]
+        self.total += delta
+        return estimate
+
+    def add(self, _id: int, value: object):
+        """
+        Учесть значение
+        :param _id: id записи (не используется)
+        :param value: хешируемое значение поля
+        """
+        estimate = self._change(value, 1)
+        top = self.top
+        if value in top or len(top) < self.TOP:
+            top[value] = estimate
+        elif estimate > self._floor:
+            weakest = min(top, key=top.get)
+            if top[weakest] < estimate:
+                del top[weakest]
+                top[value] = estimate
+            self._floor = min(top.values())
+
+    def remove(self, _id: int, value: object):
+        """
+        Вычесть значение, учтённое раньше
+        :param _id: id записи (не используется)
+        :param value: значение поля, с которым запись была учтена
+        """
+        estimate = self._change(value, -1)
+        if value in self.top:
+            self.top[value] = estimate
+            self._floor = min(self._floor, estimate)
+
+    def estimate(self, value: object) -> int:
+        """ Оценка частоты значения (не меньше настоящей) """
+        self._ensure()
+        if value is None or not HashIndex.hashable(value):
+            return 0
+        return min(counters[cell] for counters, cell in zip(self.counters, self._cells(value)))
+
+    def heavy_hitters(self, k: int=10) -> List[tuple]:
+        """
+        Самые частые значения
+        :param k: сколько значений вернуть (не больше TOP)
+        :return: пары (значение, оценка частоты) по убыванию частоты
+        """
+        self._ensure()
+        hitters = [(value, self.estimate(value)) for value in self.top]
+        hitters.sort(key=lambda item: -item[1])
+        return [item for item in hitters[:k] if item[1] > 0]
+
+    def clear(self):
+        self.counters = [array('q', bytes(8 * self.WIDTH)) for _ in range(self.DEPTH)]
+        self.total = 0
+        self.top = {}
+        self._floor = 0
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        if self.built:
+            stats["entries"] = self.WIDTH * self.DEPTH
+            stats["bytes"] = sum(sys.getsizeof(counters) for counters in self.counters) + sys.getsizeof(self.top)
+        return stats
+
+
+class MappedRows(Mapping):
+    """
+    Записи таблицы из бинарного снимка, отображённого в память через mmap.
+
+    Запись декодируется при первом обращении и дальше живёт в памяти как
+    обычный dict (поэтому изменения через update не теряются); новые и
+    заменённые записи хранятся только в памяти. Нетронутые записи занимают
+    лишь страницы файла в page cache, общие для всех процессов, открывших снимок.
+    Записи перебираются в порядке возрастания id, затем -- добавленные после загрузки.
+    Записи распаковываются без загрузки классов (см. _RowUnpickler).
+    """
+    def __init__(self, data: memoryview, ids: memoryview, offsets: memoryview, strings: List[str] or None=None):
+        self._data = data  # записи подряд
+        self._ids = ids  # отсортированные id записей в снимке
+        self._offsets = offsets  # смещения записей в _data
+        self._rows = {}  # type: Dict[int, dict]  # декодированные, новые и заменённые записи
+        self._new = {}  # type: Dict[int, None]  # id записей, которых нет в снимке (в порядке добавления)
+        self._strings = strings  # пул строк таблицы: persistent id -> строка
+
+    def _find(self, _id: int) -> int:
+        """ Позиция записи в снимке или -1 """
+        if not isinstance(_id, int):
+            return -1
+        ids = self._ids
+        pos = bisect.bisect_left(ids, _id)
+        if pos < len(ids) and ids[pos] == _id:
+            return pos
+        return -1
+
+    def _decode(self, pos: int) -> dict:
+        blob = self._data[self._offsets[pos]:self._offsets[pos + 1]]
+        unpickler = _RowUnpickler(io.BytesIO(blob))
+        if self._strings:
+            unpickler.persistent_load = self._strings.__getitem__
+        return unpickler.load()
+
+    def raw(self, _id: int) -> bytes or None:
+        """ Закодированная запись из снимка, если её ещё не декодировали (иначе None) """
+        if _id in self._rows:
+            return None
+        pos = self._find(_id)
+        if pos < 0:
+            return None
+        return bytes(self._data[self._offsets[pos]:self._offsets[pos + 1]])
+
+    @property
+    def decoded(self) -> int:
+        """ Сколько записей уже лежит в памяти """
+        return len(self._rows)
+
+    def __getitem__(self, _id: int) -> dict:
+        row = self._rows.get(_id)
+        if row is None:
+            pos = self._find(_id)
+            if pos < 0:
+                raise KeyError(_id)
+            row = self._rows[_id] = self._decode(pos)
+        return row
+
+    def __setitem__(self, _id: int, row: dict):
+        if _id not in self._rows and self._find(_id) < 0:
+            self._new[_id] = None
+        self._rows[_id] = row
+
+    def __contains__(self, _id: object) -> bool:
+        return _id in self._rows or self._find(_id) >= 0
+
+    def __iter__(self) -> Iterable[int]:
+        yield from self._ids
+        yield from list(self._new)
+
+    def __len__(self):
+        return len(self._ids) + len(self._new)
+
+    def peek(self, _id: int) -> dict:
+        """ Запись для чтения без сохранения декодированной записи в памяти """
+        row = self._rows.get(_id)
+        if row is None:
+            pos = self._find(_id)
+            if pos < 0:
+                raise KeyError(_id)
+            row = self._decode(pos)
+        return row
+
+    def scan(self) -> Iterable[tuple]:
+        """ Пары (id, запись) без сохранения декодированных записей в памяти """
+        rows = self._rows
+        for pos, _id in enumerate(self._ids):
+            row = rows.get(_id)
+            yield _id, (row if row is not None else self._decode(pos))
+        # копия: другой поток может в это время вставлять записи
+        for _id in list(self._new):
+            yield _id, rows[_id]
+
+
+class ColumnarRows(Mapping):
+    """
+    Колоночное хранилище записей таблицы.
+
+    Объявленные скалярные поля хранятся в типизированных массивах array
+    (по позиции записи) с флагами наличия значения, остальные поля -- в
+    небольшом dict на запись. Значения, которые не подходят колонке по типу
+    (строка, bool, float в целочисленной колонке, переполнение), тоже уходят в
+    dict, поэтому читаются ровно такими, какими были записаны.
+    Запись выдаётся как ColumnarRow -- изменяемое представление с интерфейсом dict.
+
+    >>> rows = ColumnarRows({'sex': 'b', 'university': 'q'})
+    >>> rows[1] = {'id': 1, 'sex': 1, 'university': 671, 'first_name': 'Иван'}
+    >>> rows[2] = {'id': 2, 'sex': True}
+    >>> rows[1]['university'], rows[1]['first_name'], rows[2]['sex']
+    (671, 'Иван', True)
+    >>> rows.column_candidates('university', '__eq__', 671)
+    [1]
+    """
+    INT_TYPECODES = "bBhHiIlLqQ"
+    FLOAT_TYPECODES = "d"
+
+    _OPERATORS = {
+        "__eq__": operator.eq,
+        "__ne__": operator.ne,
+        "__lt__": operator.lt,
+        "__le__": operator.le,
+        "__gt__": operator.gt,
+        "__ge__": operator.ge,
+    }
+
+    def __init__(self, columns: Dict[str, str]):
+        if "id" in columns:
+            raise DBException("Поле id не может быть колонкой")
+        self._types = {}  # type: Dict[str, type]
+        self._columns = {}  # type: Dict[str, tuple]  # поле -> (значения, флаги наличия)
+        for field, typecode in columns.items():
+            if typecode in self.INT_TYPECODES:
+                self._types[field] = int
+            elif typecode in self.FLOAT_TYPECODES:
+                self._types[field] = float
+            else:
+                raise DBException("Неподдерживаемый тип колонки `{}`: `{}`".format(field, typecode))
+            self._columns[field] = (array(typecode), bytearray())
+        self._ids = array('q')  # позиция -> id
+        self._pos = {}  # type: Dict[int, int]  # id -> позиция
+        self._rest = []  # type: List[dict or None]  # остальные поля записи
+        self._spill = {field: set() for field in columns}  # type: Dict[str, Set[int]]  # id со значением вне колонки
+
+    def _get(self, pos: int, key: object) -> object:
+        if "id" == key:
+            return self._ids[pos]
+        column = self._columns.get(key)
+        if column is not None and column[1][pos]:
+            return column[0][pos]
+        rest = self._rest[pos]
+        if rest is None:
+            raise KeyError(key)
+        return rest[key]
+
+    def _set(self, pos: int, key: object, value: object):
+        if "id" == key:
+            if value != self._ids[pos]:
+                raise DBException("Нельзя менять id записи ({} -> {})".format(self._ids[pos], value))
+            return
+        column = self._columns.get(key)
+        rest = self._rest[pos]
+        if column is not None:
+            values, present = column
+            if type(value) is self._types[key]:
+                try:
+                    values[pos] = value
+                except OverflowError:
+                    pass
+                else:
+                    present[pos] = 1
+                    if rest is not None and key in rest:
+                        del rest[key]
+                        self._spill[key].discard(self._ids[pos])
+                    return
+            present[pos] = 0
+            self._spill[key].add(self._ids[pos])
+        if rest is None:
+            rest = self._rest[pos] = {}
+        rest[key] = value
+
+    def _del(self, pos: int, key: object):
+        if "id" == key:
+            raise DBException("Нельзя удалить id записи")
+        column = self._columns.get(key)
+        if column is not None and column[1][pos]:
+            column[1][pos] = 0
+            return
+        rest = self._rest[pos]
+        if rest is None:
+            raise KeyError(key)
+        del rest[key]
+        if column is not None:
+            self._spill[key].discard(self._ids[pos])
+
+    def _keys(self, pos: int) -> Iterable[object]:
+        yield "id"
+        for field, (values, present) in self._columns.items():
+            if present[pos]:
+                yield field
+        rest = self._rest[pos]
+        if rest is not None:
+            yield from rest
+
+    def _len(self, pos: int) -> int:
+        rest = self._rest[pos]
+        return 1 + sum(present[pos] for values, present in self._columns.values()) + (len(rest) if rest else 0)
+
+    def __getitem__(self, _id: int) -> 'ColumnarRow':
+        return ColumnarRow(self, self._pos[_id])
+
+    def __setitem__(self, _id: int, row: Mapping):
+        """ Положить запись целиком (заменяя прежнюю с тем же id) """
+        pos = self._pos.get(_id)
+        if pos is None:
+            pos = self._pos[_id] = len(self._ids)
+            self._ids.append(_id)
+            for values, present in self._columns.values():
+                values.append(0)
+                present.append(0)
+            self._rest.append(None)
+        else:
+            for field, (values, present) in self._columns.items():
+                present[pos] = 0
+                self._spill[field].discard(_id)
+            self._rest[pos] = None
+        for key, value in row.items():
+            self._set(pos, key, value)
+
+    def __contains__(self, _id: object) -> bool:
+        return _id in self._pos
+
+    def __iter__(self) -> Iterable[int]:
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def positions(self, ids: Iterable[int]) -> Iterable[int]:
+        """ Позиции записей с данными id """
+        return map(self._pos.__getitem__, ids)
+
+    def column_getter(self, field: str):
+        """ Функция (позиция, запись) -> значение поля (или None), читающая колонку без создания записи """
+        values, present = self._columns[field]
+        rest = self._rest
+
+        def get(pos: int, row: object=None) -> object or None:
+            if present[pos]:
+                return values[pos]
+            row_rest = rest[pos]
+            return None if row_rest is None else row_rest.get(field)
+        return get
+
+    def column_state(self, field: str, positions: List[int] or None=None, add: bool=True,
+                     order: bool=True) -> list or None:
+        """
+        Состояние агрегата по колонке (см. Aggregation._agg): [число значений, сумма, минимум,
+        максимум, None, None], посчитанное встроенными sum, min и max прямо по массиву
+        (или по записям на позициях positions).
+        None -- если у части записей значение поля лежит вне колонки
+        :param add: считать сумму
+        :param order: считать минимум и максимум
+        """
+        if self._spill[field]:
+            return None
+        values, present = self._columns[field]
+        if positions is not None:
+            values = list(compress(map(values.__getitem__, positions), map(present.__getitem__, positions)))
+        elif present.count(0):
+            values = list(compress(values, present))
+        if not values:
+            return [0, 0, None, None, None, None]
+        low, high = (min(values), max(values)) if order else (None, None)
+        return [len(values), sum(values) if add else 0, low, high, None, None]
+
+    def column_candidates(self, field: str, method_name: str, value: object) -> List[int] or None:
+        """
+        id записей, которые могут пройти проверку `поле <method_name> value`, найденные
+        просмотром массива колонки (значения вне колонки добавляются без проверки).
+        None -- если поле не колонка или сравнение нельзя сделать по массиву
+        """
+        column = self._columns.get(field)
+        op = self._OPERATORS.get(method_name)
+        if column is None or op is None or type(value) is not self._types[field]:
+            return None
+        values, present = column
+        result = list(compress(self._ids, map(operator.and_, present, map(op, values, repeat(value)))))
+        result.extend(self._spill[field])
+        return result
+
+
+class ColumnarRow(MutableMapping):
+    """ Запись колоночной таблицы: изменяемое представление с интерфейсом dict """
+    __slots__ = ("_rows", "_pos")
+
+    def __init__(self, rows: ColumnarRows, pos: int):
+        self._rows = rows
+        self._pos = pos
+
+    def __getitem__(self, key: object) -> object:
+        return self._rows._get(self._pos, key)
+
+    def __setitem__(self, key: object, value: object):
+        self._rows._set(self._pos, key, value)
+
+    def __delitem__(self, key: object):
+        self._rows._del(self._pos, key)
+
+    def __iter__(self) -> Iterable[object]:
+        return self._rows._keys(self._pos)
+
+    def __len__(self):
+        return self._rows._len(self._pos)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class RowShape:
+    """
+    Форма компактной записи: упорядоченный набор полей и номер ячейки каждого поля.
+    Формы общие для всех записей таблицы с одинаковым набором полей; переходы
+    при добавлении поля кешируются, как скрытые классы в JS-движках.
+    """
+    __slots__ = ("keys", "slots", "_registry", "_transitions")
+
+    def __init__(self, keys: tuple, registry: Dict[tuple, 'RowShape']):
+        self.keys = keys
+        self.slots = {key: i for i, key in enumerate(keys)}  # type: Dict[object, int]
+        self._registry = registry
+        self._transitions = {}  # type: Dict[object, RowShape]
+
+    @classmethod
+    def get(cls, registry: Dict[tuple, 'RowShape'], keys: tuple) -> 'RowShape':
+        """ Общая форма для набора полей """
+        shape = registry.get(keys)
+        if shape is None:
+            shape = registry[keys] = cls(keys, registry)
+        return shape
+
+    def with_key(self, key: object) -> 'RowShape':
+        """ Форма с добавленным в конец полем """
+        shape = self._transitions.get(key)
+        if shape is None:
+            shape = self._transitions[key] = self.get(self._registry, self.keys + (key,))
+        return shape
+
+    def without_key(self, key: object) -> 'RowShape':
+        """ Форма без поля """
+        return self.get(self._registry, tuple(k for k in self.keys if k != key))
+
+
+class CompactRow(MutableMapping):
+    """
+    Компактная запись: ссылка на общую форму и список значений в её порядке.
+    Ведёт себя как dict (кроме isinstance(row, dict)).
+
+    >>> shapes = {}
+    >>> a = CompactRow.from_mapping(shapes, {'id': 1, 'sex': 1})
+    >>> b = CompactRow.from_mapping(shapes, {'id': 2, 'sex': 0})
+    >>> a._shape is b._shape
+    True
+    >>> b['city'] = 'Новосибирск'
+    >>> dict(b)
+    {'id': 2, 'sex': 0, 'city': 'Новосибирск'}
+    """
+    __slots__ = ("_shape", "_values")
+
+    def __init__(self, shape: RowShape, values: list):
+        self._shape = shape
+        self._values = values
+
+    @classmethod
+    def from_mapping(cls, registry: Dict[tuple, RowShape], row: Mapping) -> 'CompactRow':
+        return cls(RowShape.get(registry, tuple(row)), list(row.values()))
+
+    def __getitem__(self, key: object) -> object:
+        return self._values[self._shape.slots[key]]
+
+    def get(self, key: object, default: object=None) -> object:
+        slot = self._shape.slots.get(key)
+        return default if slot is None else self._values[slot]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._shape.slots
+
+    def __setitem__(self, key: object, value: object):
+        slot = self._shape.slots.get(key)
+        if slot is None:
+            self._shape = self._shape.with_key(key)
+            self._values.append(value)
+        else:
+            self._values[slot] = value
+
+    def __delitem__(self, key: object):
+        slot = self._shape.slots[key]
+        self._shape = self._shape.without_key(key)
+        del self._values[slot]
+
+    def __iter__(self) -> Iterable[object]:
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def copy(self) -> 'CompactRow':
+        return CompactRow(self._shape, list(self._values))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class TableSnapshot:
+    """
+    Согласованный снимок таблицы на момент создания, для чтения из другого потока.
+
+    Читатели не блокируют писателей: снимок запоминает список id, а писатели перед
+    изменением записи отдают открытым снимкам её прежнее состояние (см. Table._preserve).
+    Чтение берёт текущую запись и, если её успели изменить, подменяет прежним
+    состоянием. Индексы и кеш запросов снимок не использует.
+
+    >>> users = Table("users")
+    >>> row = users.insert({'first_name': 'Иван', 'sex': 1})
+    >>> with users.snapshot() as snapshot:
+    ...     row = users.update({'id': 1, 'sex': 0})
+    ...     row = users.insert({'first_name': 'Пётр'})
+    ...     [dict(r) for r in snapshot.rows()]
+    [{'first_name': 'Иван', 'sex': 1, 'id': 1}]
+    """
+    def __init__(self, table: 'Table'):
+        self.table = table
+        self._before = {}  # type: Dict[int, dict]  # id -> запись на момент снимка (_ABSENT -- её не было)
+        # колоночные записи -- представления над массивами, их нужно копировать при чтении
+        self._materialize = isinstance(table.meta_data, ColumnarRows)
+        with table._write_lock:
+            table._snapshots.add(self)
+            self._ids = list(table.meta_data)
+
+    def _row(self, _id: int) -> dict or None:
+        """ Запись на момент снимка или None """
+        try:
+            row = self.table._peek(_id)
+        except KeyError:
+            row = None
+        if row is not None and self._materialize:
+            row = dict(row)
+        # прежнее состояние проверяется после чтения: писатель сохраняет его до изменения
+        before = self._before.get(_id)
+        if before is not None:
+            return None if before is _ABSENT else before
+        return row
 
-    def serialize(self, file_name: str, pretty: bool=False):
+    def rows(self, to_class: bool or 'Row'=False) -> Iterable[dict or 'Row']:
         """
-        Загружает БД в файл
-        :param file_name: Имя файла БД
-        :param pretty: красивый вывод в файл
-        :return:
+        Записи на момент снимка (изменять их нельзя)
+        :param to_class: обработка каждой записи, см. Table.rows
         """
-        kwargs = {
-            "cls": MemNRDBEncoder,
-            "ensure_ascii": False
-        }
-        if pretty:
-            kwargs.update({
-                "sort_keys": True,
-                "indent": 4
-            })
-        if os.path.exists(file_name):
-            os.rename(file_name, file_name + ".old")
-        json.dump(self, open(file_name, "wt"), **kwargs)
-        if os.path.exists(file_name + ".old"):
-            os.remove(file_name + ".old")
+        for _id in self._ids:
+            row = self._row(_id)
+            if row is not None:
+                yield _apply_class(row, to_class)
 
-    @classmethod
-    def load(cls, file_name: str) -> 'MemNRDB':
-        """
-        Загрузить бд из файла
-        :param file_name: имя файла
-        :return:
-        """
-        db = json.load(open(file_name, "rt"), object_hook=db_json_hook)
-        if isinstance(db, MemNRDB):
-            return db
-        else:
-            raise DBException("Не удалось загрузить базу из файла.")
+    def get(self, _id: int, to_class: bool or 'Row'=False) -> dict or 'Row':
+        """ Запись по id на момент снимка """
+        row = self._row(_id)
+        if row is None:
+            raise DBIndexError(self.table, 'get', "Элемента с таким id ({}) не найдено".format(_id))
+        return _apply_class(row, to_class)
 
+    def query(self, query: 'Query', to_class: bool or 'Row'=False) -> Iterable[dict or 'Row']:
+        """ Записи снимка, прошедшие фильтр """
+        for row in self.rows():
+            if query._check(row):
+                yield _apply_class(row, to_class)
 
-def _apply_class(row: dict, to_class: bool or 'Row'):
-    if to_class is False:
-        return row
-    elif to_class is True:
-        return Row(row)
-    else:
-        return to_class(row)
+    def close(self):
+        """ Закрыть снимок: писатели перестают сохранять для него прежние состояния """
+        with self.table._write_lock:
+            self.table._snapshots.discard(self)
+        self._before = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __enter__(self) -> 'TableSnapshot':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class Table:
@@ -222,13 +2886,297 @@ class Table:
     >>> row6 = t.ins_upd({'id': 6, 'val': 'val'})
     >>> row6['id']
     6
+
+    По полям можно построить индексы, тогда запросы на равенство по ним
+    не будут просматривать всю таблицу:
+    >>> users = Table("users", indexes=['university'])
+    >>> index = users.create_index('faculty')
+
+    Упорядоченный индекс отвечает ещё и на сравнения `<`, `<=`, `>`, `>=`:
+    >>> users = Table("users", indexes={'university': 'hash', 'graduation': 'sorted'})
+    >>> index = users.create_index('bdate', kind='sorted')
+
+    Индекс по вложенному полю задаётся путём, а многозначный индекс хранит
+    каждый элемент поля-списка и отвечает на запросы Query.any():
+    >>> index = users.create_index(('cost', 'group_nsu24'), kind='sorted')
+    >>> index = users.create_index('universities', multi=True)
+
+    Индексы поддерживаются только через insert/update/ins_upd: если менять
+    запись, полученную из таблицы, напрямую, индекс об этом не узнает.
+
+    Числовые поля можно хранить колонками (typecode модуля array) -- это в разы
+    меньше памяти, а сравнения по ним просматривают массив, а не записи:
+    >>> users = Table("users", columns={'sex': 'b', 'university': 'q', 'graduation': 'h'})
+
+    Компактные записи: записи с одинаковым набором полей делят одну «форму»
+    (поле -> номер ячейки) и хранят только список значений:
+    >>> users = Table("users", compact=True)
+
+    Строковые значения полей из intern хранятся в пуле таблицы (одинаковые строки --
+    один объект), в снимках записываются номерами, а запросы на равенство по ним
+    сравнивают объекты, а не строки (поэтому, как и индексируемые поля, их
+    нужно менять только через insert/update):
+    >>> users = Table("users", intern=['university_name', 'faculty_name', 'cost'])
+    >>> a = users.insert({'university_name': 'НГУ'})
+    >>> b = users.insert({'university_name': ''.join(['Н', 'ГУ'])})
+    >>> a['university_name'] is b['university_name']
+    True
+
+    Приближённые сводки по полям поддерживаются при insert/update и, как индексы,
+    строятся при первом обращении: "hll" -- число различных значений,
+    "cms" -- самые частые значения (у multi -- элементы списка или ключи словаря):
+    >>> people = Table("people", sketches={'city': 'hll'})
+    >>> sketch = people.create_sketch('cost', kind='cms', multi=True)
+    >>> rows = people.insert_many([{'city': 'Новосибирск', 'cost': {'group_a': 1}}, {'city': 'Томск'}])
+    >>> people.distinct('city')
+    2
+    >>> people.heavy_hitters('cost')
+    [('group_a', 1)]
+
+    Материализованные представления (результат запроса и агрегаты по нему)
+    поддерживаются таблицей при каждой записи, см. MaterializedView:
+    >>> view = people.create_view('tomsk', Query('people').city == 'Томск', cities=('count', 'city'))
+    >>> view.ids(), view.agg()
+    ([2], {'cities': 1})
+
+    Сколько памяти занимают записи, поля и индексы:
+    >>> stats = users.stats()
+    >>> stats['rows'], stats['fields']['university_name']['rows']
+    (2, 2)
     """
-    def __init__(self, name: str, convert: bool = True, convert_exclude: list or None=None):
+    INDEX_TYPES = {
+        HashIndex.kind: HashIndex,
+        SortedIndex.kind: SortedIndex,
+    }
+    SKETCH_TYPES = {
+        HyperLogLog.kind: HyperLogLog,
+        CountMinSketch.kind: CountMinSketch,
+    }
+    # Сколько записей просматривает stats() для оценки размеров полей
+    STATS_SAMPLE = 1000
+    # По сколько записей вставляется таблица при загрузке из JSONL-файла
+    JSONL_BATCH = 1000
+
+    def __init__(self, name: str, convert: bool = True, convert_exclude: list or None=None,
+                 indexes: list or dict or None=None, columns: Dict[str, str] or None=None,
+                 compact: bool=False, intern: list or None=None, sketches: list or dict or None=None):
         self.name = name
         self.convert = convert  # Конвертировать ли переменные в числа автоматически
         self.convert_exclude = convert_exclude or []
         self.index_count = 1
-        self.meta_data = {}  # type: Dict[int, dict]
+        self.columns = columns or {}  # поле -> typecode колонки
+        self.compact = compact  # хранить записи как CompactRow с общими формами
+        self._shapes = {}  # type: Dict[tuple, RowShape]
+        self.intern = list(intern or [])  # поля, строковые значения которых хранятся в пуле
+        self._codes = {}  # type: Dict[str, int]  # пул строк: строка -> номер
+        self._strings = []  # type: List[str]  # пул строк: номер -> строка
+        if self.columns and self.compact:
+            raise DBException("Таблица не может быть одновременно колоночной и компактной")
+        if self.columns:
+            self.meta_data = ColumnarRows(self.columns)  # type: Dict[int, dict]
+        else:
+            self.meta_data = {}  # type: Dict[int, dict]
+        self.indexes = {}  # type: Dict[str, Index]
+        self.sketches = {}  # type: Dict[tuple, Sketch]  # (поле, тип) -> сводка
+        self.views = {}  # type: Dict[str, MaterializedView]
+        self._dirty = set()  # type: Set[int]  # id записей, изменённых с последнего сохранения
+        self.version = 0  # счётчик изменений таблицы (для кеша запросов)
+        self._snapshots = weakref.WeakSet()  # открытые снимки таблицы
+        # изменение записи и сохранение её прежнего состояния для снимков -- одно целое
+        self._write_lock = threading.Lock()
+        self._profiler = None  # type: QueryProfiler  # профиль запросов БД, если он включён
+        if isinstance(indexes, dict):
+            for field, kind in indexes.items():
+                self.create_index(field, kind)
+        else:
+            for field in indexes or []:
+                if isinstance(field, dict):
+                    self.create_index(field["field"], field.get("kind", "hash"), field.get("multi", False))
+                else:
+                    self.create_index(field)
+        if isinstance(sketches, dict):
+            for field, kind in sketches.items():
+                self.create_sketch(field, kind)
+        else:
+            for sketch in sketches or []:
+                self.create_sketch(sketch["field"], sketch.get("kind", "hll"), sketch.get("multi", False))
+
+    @staticmethod
+    def _index_key(field: str or tuple or list) -> str or tuple:
+        """ Ключ индекса в indexes: имя поля или кортеж -- путь к вложенному полю """
+        if isinstance(field, (tuple, list)):
+            return field[0] if 1 == len(field) else tuple(field)
+        return field
+
+    def create_index(self, field: str or tuple, kind: str="hash", multi: bool=False) -> HashIndex or SortedIndex:
+        """
+        Создать индекс по полю (если его ещё нет). Сам индекс строится при первом обращении к нему.
+        :param field: название поля или кортеж -- путь к вложенному полю
+        :param kind: тип индекса: "hash" -- только равенство, "sorted" -- равенство и сравнения
+        :param multi: индексировать каждый элемент поля-списка (для запросов Query.any())
+        :return: индекс
+        """
+        field = self._index_key(field)
+        if field in self.indexes:
+            index = self.indexes[field]
+            if index.kind != kind or index.multi != multi:
+                raise DBIndexError(self, 'create_index', "По полю `{}` уже есть индекс `{}` типа `{}`".format(
+                    field, index.name, index.kind
+                ))
+            return index
+        try:
+            index = self.INDEX_TYPES[kind](field, multi)
+        except KeyError:
+            raise DBIndexError(self, 'create_index', "Неизвестный тип индекса `{}`".format(kind))
+        index.defer(self)
+        self.indexes[field] = index
+        return index
+
+    def drop_index(self, field: str or tuple):
+        """
+        Удалить индекс по полю
+        :param field: название поля или путь к нему
+        """
+        try:
+            del self.indexes[self._index_key(field)]
+        except KeyError:
+            raise DBIndexError(self, 'drop_index', "Индекса по полю `{}` нет".format(field))
+
+    def create_sketch(self, field: str or tuple, kind: str="hll", multi: bool=False) -> 'Sketch':
+        """
+        Создать приближённую сводку по полю (если её ещё нет). Сама сводка строится при первом обращении к ней.
+        :param field: название поля или кортеж -- путь к вложенному полю
+        :param kind: тип сводки: "hll" -- число различных значений (distinct),
+          "cms" -- частоты и самые частые значения (heavy_hitters)
+        :param multi: учитывать каждый элемент поля-списка (у словаря -- каждый ключ)
+        :return: сводка
+        """
+        key = (self._index_key(field), kind)
+        if key in self.sketches:
+            sketch = self.sketches[key]
+            if sketch.multi != multi:
+                raise DBIndexError(self, 'create_sketch', "По полю `{}` уже есть сводка `{}` типа `{}`".format(
+                    key[0], sketch.name, kind
+                ))
+            return sketch
+        try:
+            sketch = self.SKETCH_TYPES[kind](key[0], multi)
+        except KeyError:
+            raise DBIndexError(self, 'create_sketch', "Неизвестный тип сводки `{}`".format(kind))
+        sketch.defer(self)
+        self.sketches[key] = sketch
+        return sketch
+
+    def drop_sketch(self, field: str or tuple, kind: str="hll"):
+        """
+        Удалить сводку по полю
+        :param field: название поля или путь к нему
+        :param kind: тип сводки
+        """
+        try:
+            del self.sketches[(self._index_key(field), kind)]
+        except KeyError:
+            raise DBIndexError(self, 'drop_sketch', "Сводки `{}` по полю `{}` нет".format(kind, field))
+
+    def _sketch(self, field: str or tuple, kind: str, operation: str) -> 'Sketch':
+        try:
+            return self.sketches[(self._index_key(field), kind)]
+        except KeyError:
+            raise DBIndexError(self, operation, "Сводки `{}` по полю `{}` нет, см. create_sketch".format(kind, field))
+
+    def distinct(self, field: str or tuple) -> int:
+        """
+        Приближённое число различных значений поля (нужна сводка "hll")
+        :param field: название поля или путь к нему
+        :return: оценка
+        """
+        return self._sketch(field, "hll", 'distinct').count()
+
+    def heavy_hitters(self, field: str or tuple, k: int=10) -> List[tuple]:
+        """
+        Приближённо самые частые значения поля (нужна сводка "cms")
+        :param field: название поля или путь к нему
+        :param k: сколько значений вернуть
+        :return: пары (значение, оценка частоты) по убыванию частоты
+        """
+        return self._sketch(field, "cms", 'heavy_hitters').heavy_hitters(k)
+
+    def create_view(self, name: str, query: 'Query', **aggregates) -> 'MaterializedView':
+        """
+        Создать материализованное представление -- результат запроса, который таблица
+        поддерживает при каждой записи. Строится при первом чтении.
+        :param name: имя представления
+        :param query: запрос к этой таблице (order_by и select не учитываются)
+        :param aggregates: агрегаты по записям представления, как в Aggregation.agg
+        :return: представление
+        """
+        if query.table_name != self.name:
+            raise DBException("Запрос к таблице `{}` не подходит для таблицы `{}`".format(query.table_name, self.name))
+        if name in self.views:
+            raise DBException("Представление `{}` в таблице `{}` уже есть".format(name, self.name))
+        view = self.views[name] = MaterializedView(name, query, self, aggregates)
+        return view
+
+    def view(self, name: str) -> 'MaterializedView':
+        """
+        Вернуть представление по имени
+        :param name: имя представления
+        """
+        try:
+            return self.views[name]
+        except KeyError:
+            raise DBException("Представления `{}` в таблице `{}` нет".format(name, self.name))
+
+    def drop_view(self, name: str):
+        """ Удалить представление """
+        self.view(name)
+        del self.views[name]
+
+    def _changed_views(self, row: dict) -> List['MaterializedView']:
+        """ Построенные представления, которые зависят от полей row """
+        return [view for view in self.views.values() if view.built and not view.fields.isdisjoint(row)]
+
+    def _sketch_settings(self) -> list:
+        """ Сводки в виде параметра sketches конструктора (пригодном для JSON) """
+        return [{"field": sketch.path, "kind": sketch.kind, "multi": sketch.multi} for sketch in self.sketches.values()]
+
+    def _index_settings(self) -> dict or list:
+        """ Индексы в виде параметра indexes конструктора (пригодном для JSON) """
+        if all(isinstance(field, str) and not index.multi for field, index in self.indexes.items()):
+            return {field: index.kind for field, index in self.indexes.items()}
+        return [{"field": index.path, "kind": index.kind, "multi": index.multi} for index in self.indexes.values()]
+
+    def _settings(self) -> dict:
+        """ Параметры конструктора таблицы (без имени) """
+        return {
+            "convert": self.convert,
+            "convert_exclude": self.convert_exclude,
+            "indexes": self._index_settings(),
+            "columns": self.columns,
+            "compact": self.compact,
+            "intern": self.intern,
+            "sketches": self._sketch_settings(),
+        }
+
+    def _index_row(self, _id: int, row: dict, fields: Iterable[str or tuple]):
+        """ Добавить запись в индексы по полям fields """
+        for field in fields:
+            self.indexes[field].add_row(_id, row)
+
+    def _unindex_row(self, _id: int, row: dict, fields: Iterable[str or tuple]):
+        """ Убрать запись из индексов по полям fields """
+        for field in fields:
+            self.indexes[field].remove_row(_id, row)
+
+    def _sketch_row(self, _id: int, row: dict, sketches: Iterable['Sketch']):
+        """ Учесть запись в сводках """
+        for sketch in sketches:
+            sketch.add_row(_id, row)
+
+    def _unsketch_row(self, _id: int, row: dict, sketches: Iterable['Sketch']):
+        """ Вычесть запись из сводок """
+        for sketch in sketches:
+            sketch.remove_row(_id, row)
 
     def insert(self, row: dict) -> dict:
         """
@@ -239,36 +3187,251 @@ class Table:
         if isinstance(row, dict):
             # try to convert values to int
             if self.convert:
-                for k, v in row.items():
-                    if k in self.convert_exclude:
-                        continue
+                self._convert_row(row, {})
+            self._check_new_id(row, 'insert')
+            return self._store_new(row, _EMPTY_IDS)
+        else:
+            raise DBTypeError(self, "insert", 'row', row, dict)
 
-                    try:
-                        if isinstance(row[k], str):
-                            if "." in row[k]:
-                                row[k] = float(v)
-                            else:
-                                row[k] = int(v)
-                    except ValueError:
-                        pass
-            # check index
+    def insert_many(self, rows: Iterable[dict]) -> List[dict]:
+        """
+        Вставить пачку уникальных записей. План конвертации полей строится один
+        раз на пачку; id проверяются до вставки, поэтому при ошибке таблица не меняется
+        :param rows: записи
+        :return: записи из БД
+        """
+        rows = list(rows)
+        plan = {}
+        for row in rows:
+            if not isinstance(row, dict):
+                raise DBTypeError(self, "insert_many", 'row', row, dict)
+            if self.convert:
+                self._convert_row(row, plan)
+        reserved = set()
+        for row in rows:
             if "id" in row:
-                _id = row['id']
-                if not isinstance(_id, int):
-                    raise DBIndexError(self, 'insert', "поле id должен быть числом, а не `{}` ({})".format(_id, type(_id)))
-                if _id in self.meta_data:
-                    raise DBIndexError(self, 'insert', "Запись с данным id ({}) уже есть в таблице".format(_id))
-            else:
-                # create index
-                while self.index_count in self.meta_data:
-                    self.index_count += 1
-                _id = row["id"] = self.index_count
-            # add row in table
-            self.meta_data[_id] = row
+                self._check_new_id(row, 'insert_many')
+                if row['id'] in reserved:
+                    raise DBIndexError(self, 'insert_many', "id {} встречается в пачке дважды".format(row['id']))
+                reserved.add(row['id'])
+        return [self._store_new(row, reserved) for row in rows]
+
+    def upsert_many(self, rows: Iterable[dict]) -> List[dict]:
+        """
+        Создать или обновить пачку записей (как ins_upd для каждой, но с одним
+        планом конвертации полей на пачку и без исключений для существующих записей)
+        :param rows: записи
+        :return: записи из БД
+        """
+        plan = {}
+        return [self._upsert(row, plan, 'upsert_many') for row in rows]
+
+    def _convert_row(self, row: dict, plan: Dict[object, bool]):
+        """
+        Конвертировать строковые значения записи в числа
+        :param row: запись
+        :param plan: план конвертации пачки: поле -> конвертировать ли его;
+          дополняется по мере появления новых полей и общий для всей пачки
+        """
+        for k, v in row.items():
+            if isinstance(v, str):
+                need = plan.get(k)
+                if need is None:
+                    need = plan[k] = k not in self.convert_exclude
+                if need:
+                    row[k] = _convert_str(v)
+
+    def interned(self, value: str) -> str or None:
+        """
+        Строка из пула таблицы, равная value
+        :param value: строка
+        :return: строка из пула или None, если такой строки в таблице нет
+        """
+        code = self._codes.get(value)
+        return None if code is None else self._strings[code]
+
+    def intern_fields(self, fields: Iterable[str]) -> 'Table':
+        """
+        Хранить в пуле строки ещё и полей fields (например, у таблицы из снимка,
+        сделанного без intern): значения этих полей в уже записанных записях
+        переводятся в пул через update, поэтому индексы, представления и
+        следующий снимок их увидят
+        :param fields: поля
+        :return: таблица
+        """
+        added = [field for field in fields if field not in self.intern]
+        if not added:
+            return self
+        self.intern.extend(added)
+        for _id in list(self.meta_data):
+            data = self.get(_id)
+            changes = {field: data[field] for field in added if data.get(field) is not None}
+            if changes:
+                self._update(data, changes)
+        return self
+
+    def _intern(self, value: str) -> str:
+        """ Положить строку в пул (если её там нет) и вернуть строку из пула """
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._strings)
+            self._strings.append(value)
+        return self._strings[code]
+
+    def _intern_value(self, value: object) -> object:
+        """ Заменить строки значения (и ключи словарей в нём) строками из пула """
+        if isinstance(value, str):
+            return self._intern(value)
+        if isinstance(value, dict):
+            return {self._intern_value(k): self._intern_value(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._intern_value(v) for v in value]
+        return value
+
+    def _intern_row(self, row: dict):
+        """ Заменить значения полей из self.intern значениями из пула """
+        for field in self.intern:
+            value = row.get(field)
+            if value is not None:
+                row[field] = self._intern_value(value)
+
+    def _load_pool(self, strings: List[str]):
+        """ Восстановить пул строк из снимка (номера строк сохраняются) """
+        for value in strings:
+            self._intern(value)
+
+    def _encode_row(self, row: dict) -> dict:
+        """ Запись для JSON-снимка: строки полей из self.intern заменяются номерами в пуле """
+        if not self.intern:
+            return row
+        row = dict(row)
+        for field in self.intern:
+            code = self._codes.get(row.get(field)) if isinstance(row.get(field), str) else None
+            if code is not None:
+                row[field] = {"__s__": code}
+        return row
+
+    def _decode_row(self, row: dict) -> dict:
+        """ Обратное к _encode_row """
+        for field in self.intern:
+            value = row.get(field)
+            if isinstance(value, dict) and "__s__" in value:
+                row[field] = self._strings[value["__s__"]]
+        return row
+
+    def export_jsonl(self, file_name: str) -> int:
+        """
+        Выгрузить таблицу в файл JSON Lines: первая строка -- заголовок с параметрами
+        таблицы, дальше по записи на строку. Записи кодируются по одной (лениво
+        загруженные не остаются в памяти), файл заменяется целиком только в конце.
+        Файл с расширением .gz, .bz2 или .xz сжимается потоком. Загрузить обратно -- Table.load_jsonl.
+        :param file_name: имя файла
+        :return: число записанных записей
+        """
+        encode = MemNRDBEncoder(ensure_ascii=False).encode
+        count = 0
+        with _open_codec(file_name + ".tmp", "wt", _jsonl_table_codec(file_name)[1]) as f:
+            f.write(json.dumps({"table": self.name,
+                                "version": MemNRDB.VERSION,
+                                "settings": self._settings(),
+                                "index_count": self.index_count}, ensure_ascii=False))
+            f.write("\n")
+            for _id, row in self._scan_items():
+                f.write(encode(row))
+                f.write("\n")
+                count += 1
+        os.replace(file_name + ".tmp", file_name)
+        return count
+
+    @staticmethod
+    def load_jsonl(file_name: str) -> 'Table':
+        """
+        Загрузить таблицу из файла, записанного export_jsonl; записи читаются
+        по одной и вставляются пачками по JSONL_BATCH
+        :param file_name: имя файла
+        :return: таблица
+        """
+        _read_jsonl_header(file_name)
+        return _jsonl_table_loader(file_name)()
+
+    def _check_new_id(self, row: dict, operation: str):
+        """ Проверить id новой записи, если он задан """
+        if "id" in row:
+            _id = row['id']
+            if not isinstance(_id, int):
+                raise DBIndexError(self, operation, "поле id должен быть числом, а не `{}` ({})".format(_id, type(_id)))
+            if _id in self.meta_data:
+                raise DBIndexError(self, operation, "Запись с данным id ({}) уже есть в таблице".format(_id))
+
+    def _store_new(self, row: dict, reserved: Set[int]) -> dict:
+        """
+        Положить проверенную новую запись в таблицу, при необходимости выдав ей id
+        :param reserved: id, которые заняты записями той же пачки
+        :return: запись из БД
+        """
+        if "id" in row:
+            _id = row['id']
         else:
-            raise DBTypeError(self, "insert", 'row', row, dict)
+            # create index
+            while self.index_count in self.meta_data or self.index_count in reserved:
+                self.index_count += 1
+            _id = row["id"] = self.index_count
+        # add row in table
+        row = self._place(_id, row)
+        self._dirty.add(_id)
+        if self.indexes:
+            self._index_row(_id, row, self.indexes)
+        if self.sketches:
+            self._sketch_row(_id, row, self.sketches.values())
+        for view in self.views.values():
+            if view.built:
+                view._offer(_id, row)
         return row
 
+    def _place(self, _id: int, row: dict) -> dict:
+        """ Положить запись в хранилище таблицы и вернуть её в том виде, в котором она хранится """
+        self.version += 1
+        if self.intern:
+            self._intern_row(row)
+        if self.compact:
+            row = CompactRow.from_mapping(self._shapes, row)
+        with self._write_lock:
+            if self._snapshots:
+                self._preserve(_id, self.meta_data.get(_id), False)
+            self.meta_data[_id] = row
+        return row if type(self.meta_data) is dict else self.meta_data[_id]
+
+    def _preserve(self, _id: int, old: dict or None, for_update: bool) -> dict or None:
+        """
+        Сохранить состояние записи до изменения для открытых снимков (вызывается под _write_lock).
+        :param old: текущая запись или None, если её нет
+        :param for_update: запись будет изменена на месте -- вернуть копию, которую можно менять
+          (колоночные записи меняются только на месте)
+        :return: запись, которую можно менять
+        """
+        columnar = isinstance(self.meta_data, ColumnarRows)
+        if old is None:
+            before = _ABSENT
+        elif columnar:
+            before = dict(old)
+        else:
+            # заменённая запись больше не меняется, поэтому её можно отдать снимкам как есть
+            before = old
+        for snapshot in self._snapshots:
+            snapshot._before.setdefault(_id, before)
+        if not for_update or columnar:
+            return old
+        return old.copy()
+
+    def snapshot(self) -> 'TableSnapshot':
+        """
+        Снимок таблицы на текущий момент для чтения, пока другой поток пишет в неё.
+        Пока снимок открыт, запись через insert/update/ins_upd сохраняет прежние
+        состояния изменённых записей, а update меняет копию записи (copy-on-write).
+        :return: снимок (закрывается через close() или with)
+        """
+        return TableSnapshot(self)
+
     def update(self, row: dict) -> dict:
         """
         Обновить запись в БД (только если уже запись с таким id существует)
@@ -277,32 +3440,142 @@ class Table:
         """
         if isinstance(row, dict):
             if 'id' in row:
-                data = self.get(row['id'])
-                data.update(row)
-                _to_del = []
-                for k, v in data.items():
-                    if v is None:
-                        _to_del.append(k)
-                for k in _to_del:
-                    del data[k]
-                return data
+                return self._update(self.get(row['id']), row)
             else:
                 raise DBIndexError(self, 'update', "не найден id записи")
         else:
             raise DBTypeError(self, "insert", 'row', row, dict)
 
+    def _update(self, data: dict, row: dict) -> dict:
+        """ Применить изменения row к записи data из таблицы """
+        _id = data['id']
+        # переиндексируются только те поля, которые меняются
+        fields = [field for field, index in self.indexes.items() if index.path[0] in row]
+        if fields:
+            self._unindex_row(_id, data, fields)
+        sketches = [sketch for sketch in self.sketches.values() if sketch.path[0] in row]
+        if sketches:
+            self._unsketch_row(_id, data, sketches)
+        views = self._changed_views(row) if self.views else []
+        for view in views:
+            view._discard(_id)
+        self.version += 1
+        if self.intern:
+            self._intern_row(row)
+        with self._write_lock:
+            copied = False
+            if self._snapshots:
+                new_data = self._preserve(_id, data, True)
+                copied = new_data is not data
+                data = new_data
+            data.update(row)
+            _to_del = []
+            for k, v in data.items():
+                if v is None:
+                    _to_del.append(k)
+            for k in _to_del:
+                del data[k]
+            if copied:
+                self.meta_data[_id] = data
+        if fields:
+            self._index_row(_id, data, fields)
+        if sketches:
+            self._sketch_row(_id, data, sketches)
+        for view in views:
+            view._offer(_id, data)
+        self._dirty.add(_id)
+        return data
+
     def ins_upd(self, row: dict) -> dict:
         """
         Создать или обновить запись в БД
         :param row: запись
         :return: запись из БД
         """
-        try:
-            return self.insert(row)
-        except DBIndexError:
-            pass
+        return self._upsert(row, {}, 'ins_upd')
+
+    def _upsert(self, row: dict, plan: Dict[object, bool], operation: str) -> dict:
+        if not isinstance(row, dict):
+            raise DBTypeError(self, operation, 'row', row, dict)
+        if self.convert:
+            self._convert_row(row, plan)
+        _id = row.get('id')
+        if isinstance(_id, int) and _id in self.meta_data:
+            return self._update(self.meta_data[_id], row)
+        self._check_new_id(row, operation)
+        return self._store_new(row, _EMPTY_IDS)
+
+    def _read_ids(self) -> Iterable[int]:
+        """
+        id записей для перебора, который не ломается, если другой поток в это время
+        вставляет записи: у dict берётся список id (без блокировки писателей дольше
+        копирования), колонки и записи снимка в mmap перебираются по массивам
+        """
+        meta_data = self.meta_data
+        if type(meta_data) is not dict:
+            return iter(meta_data)
+        with self._write_lock:
+            return list(meta_data)
+
+    def _scan_items(self) -> Iterable[tuple]:
+        """
+        Пары (id, запись) для чтения при полном просмотре таблицы.
+        Лениво загруженные записи при этом не остаются в памяти, поэтому
+        изменять полученные записи нельзя. Вставки из другого потока просмотру
+        не мешают (см. _read_ids).
+        """
+        meta_data = self.meta_data
+        if isinstance(meta_data, MappedRows):
+            return meta_data.scan()
+        if type(meta_data) is not dict:
+            return meta_data.items()
+        return self._dict_items(meta_data)
+
+    def _dict_items(self, meta_data: Dict[int, dict]) -> Iterable[tuple]:
+        for _id in self._read_ids():
+            row = meta_data.get(_id)
+            if row is not None:
+                yield _id, row
+
+    def _peek(self, _id: int) -> dict:
+        """ Запись для чтения (лениво загруженная запись не остаётся в памяти) """
+        if isinstance(self.meta_data, MappedRows):
+            return self.meta_data.peek(_id)
+        return self.meta_data[_id]
+
+    def touch(self, _id: int):
+        """
+        Отметить запись изменённой, если её поменяли напрямую, а не через update
+        (чтобы она попала в журнал при следующем сохранении)
+        :param _id: id записи
+        """
+        self.get(_id)
+        self._dirty.add(_id)
+        self.version += 1
 
-        return self.update(row)
+    def _put(self, row: dict) -> dict:
+        """
+        Положить запись с id как есть (без конвертации), заменив запись с тем же id.
+        Используется при восстановлении из журнала.
+        """
+        _id = row['id']
+        old = self.meta_data.get(_id)
+        if old is not None and self.indexes:
+            self._unindex_row(_id, old, self.indexes)
+        if old is not None and self.sketches:
+            self._unsketch_row(_id, old, self.sketches.values())
+        views = [view for view in self.views.values() if view.built]
+        if old is not None:
+            for view in views:
+                view._discard(_id)
+        row = self._place(_id, row)
+        if self.indexes:
+            self._index_row(_id, row, self.indexes)
+        if self.sketches:
+            self._sketch_row(_id, row, self.sketches.values())
+        for view in views:
+            view._offer(_id, row)
+        return row
 
     def rows(self, to_class: bool or 'Row'=False) -> Iterable[dict or 'Row']:
         """
@@ -313,8 +3586,13 @@ class Table:
           T <= Row: Применять T к записи
         :return:
         """
-        for row in self.meta_data.values():
-            yield _apply_class(row, to_class)
+        meta_data = self.meta_data
+        for _id in self._read_ids():
+            try:
+                row = meta_data[_id]
+            except KeyError:
+                continue
+            yield _apply_class(row, to_class, self)
 
     def get(self, _id: int, to_class: bool or 'Row'=False) -> dict or 'Row':
         """
@@ -324,10 +3602,100 @@ class Table:
         :return:
         """
         try:
-            return _apply_class(self.meta_data[_id], to_class)
+            return _apply_class(self.meta_data[_id], to_class, self)
         except KeyError:
             raise DBIndexError(self, 'get', "Элемента с таким id ({}) не найдено".format(_id))
 
+    def stats(self, sample: int or None=None) -> dict:
+        """
+        Оценка памяти таблицы. Значения полей оцениваются по sample записям, взятым
+        равномерно по таблице, и пересчитываются на всю таблицу; колонки считаются точно.
+        Общие объекты (строки из пула, малые числа, None, True, False) и имена полей
+        в размер значений не входят.
+        :param sample: сколько записей просмотреть (по умолчанию -- STATS_SAMPLE)
+        :return:
+          rows -- число записей; storage -- хранилище: dict, compact, columnar или mapped;
+          fields -- поле -> {rows: в скольких записях есть, bytes: память значений}
+            (по убыванию памяти);
+          row_bytes -- память самих записей и словаря таблицы;
+          indexes -- имя индекса (Index.name) -> его статистика (см. Index.stats);
+          sketches -- "тип:имя" сводки -> её статистика;
+          strings -- размер пула строк; bytes -- всего.
+          Для mapped ещё mapped_bytes -- размер снимка в mmap; bytes -- он и уже декодированные
+          записи, а fields и row_bytes оценивают записи так, как если бы все они были декодированы
+        """
+        sample = max(1, self.STATS_SAMPLE if sample is None else sample)
+        meta_data = self.meta_data
+        count = len(meta_data)
+        sampled = list(meta_data)[::max(1, count // sample)][:sample]
+        scale = count / len(sampled) if sampled else 0.0
+        columnar = isinstance(meta_data, ColumnarRows)
+        interned = set(self.intern)
+        fields = {}  # type: Dict[object, list]  # поле -> [записей, байт] в выборке
+        row_bytes = 0
+        for _id in sampled:
+            if columnar:
+                # в колоночной записи вне колонок хранится только её dict с остальными полями
+                row = meta_data._rest[meta_data._pos[_id]]
+                if row is None:
+                    continue
+                row_bytes += sys.getsizeof(row)
+            else:
+                row = self._peek(_id)
+                row_bytes += sys.getsizeof(row)
+                if isinstance(row, CompactRow):
+                    row_bytes += sys.getsizeof(row._values)
+            for field, value in row.items():
+                entry = fields.get(field)
+                if entry is None:
+                    entry = fields[field] = [0, 0]
+                entry[0] += 1
+                if field not in interned or type(value) is not str:
+                    entry[1] += _value_size(value)
+        field_stats = {field: {"rows": round(entry[0] * scale), "bytes": round(entry[1] * scale)}
+                       for field, entry in fields.items()}
+        row_bytes = round(row_bytes * scale) + sys.getsizeof(meta_data)
+
+        storage = "compact" if self.compact else "dict"
+        result = {}
+        if columnar:
+            storage = "columnar"
+            row_bytes += sys.getsizeof(meta_data._pos) + sys.getsizeof(meta_data._rest)
+            field_stats["id"] = {"rows": count, "bytes": len(meta_data._ids) * meta_data._ids.itemsize}
+            for field, (values, present) in meta_data._columns.items():
+                stats = field_stats.setdefault(field, {"rows": 0, "bytes": 0})
+                stats["rows"] += present.count(1)
+                stats["bytes"] += len(values) * values.itemsize + len(present)
+        elif isinstance(meta_data, MappedRows):
+            storage = "mapped"
+            row_bytes += sys.getsizeof(meta_data._rows)
+            result["mapped_bytes"] = meta_data._data.nbytes + meta_data._ids.nbytes + meta_data._offsets.nbytes
+
+        indexes = {index.name: index.stats() for index in self.indexes.values()}
+        sketches = {"{}:{}".format(sketch.kind, sketch.name): sketch.stats() for sketch in self.sketches.values()}
+        strings = {
+            "count": len(self._strings),
+            "bytes": (sum(sys.getsizeof(string) for string in self._strings)
+                      + sys.getsizeof(self._strings) + sys.getsizeof(self._codes)) if self._strings else 0,
+        }
+        total = row_bytes + sum(stats["bytes"] for stats in field_stats.values())
+        if "mapped" == storage:
+            # в памяти -- только уже декодированные записи
+            total = (result["mapped_bytes"] + sys.getsizeof(meta_data) + sys.getsizeof(meta_data._rows)
+                     + round(total / max(count, 1) * len(meta_data._rows)))
+        total += sum(stats["bytes"] for stats in chain(indexes.values(), sketches.values())) + strings["bytes"]
+        result.update({
+            "rows": count,
+            "storage": storage,
+            "bytes": total,
+            "row_bytes": row_bytes,
+            "fields": dict(sorted(field_stats.items(), key=lambda item: -item[1]["bytes"])),
+            "indexes": indexes,
+            "sketches": sketches,
+            "strings": strings,
+        })
+        return result
+
     def __len__(self):
         return len(self.meta_data)
 
@@ -361,7 +3729,12 @@ class Row:
     >>> row.field = 'val'
     >>> row.field
     'val'
+
+    Запись, полученная из таблицы (get, rows, запрос), при изменении через Row
+    отмечается в таблице изменённой (Table.touch): кеш запросов и журнал это видят.
     """
+    _table = None  # type: Table  # таблица, из которой получена запись
+
     def __init__(self, raw: dict):
         object.__setattr__(self, "_data", raw)
 
@@ -374,6 +3747,7 @@ class Row:
 
     def __setitem__(self, key, value):
         self._data[key] = value
+        self._touch()
 
     def __getattr__(self, item: str):
         if '_' == item[0]:
@@ -383,6 +3757,11 @@ class Row:
 
     def __setattr__(self, key, value):
         self._data[key] = value
+        self._touch()
+
+    def _touch(self):
+        if self._table is not None:
+            self._table.touch(self._data['id'])
 
     def __delete__(self, instance):
         return NotImplemented
@@ -431,66 +3810,322 @@ class Query:
     >>> q.all(to_class=SomeClassRow) # doctest: +ELLIPSIS
     <generator object Query.all at 0x...>
 
-    Либо во встроенный:
-    >>> q.limit(100, to_class=True) # doctest: +ELLIPSIS
-    <generator object Query.limit at 0x...>
+    Либо во встроенный:
+    >>> q.limit(100, to_class=True) # doctest: +ELLIPSIS
+    <generator object Query.limit at 0x...>
+
+    """
+
+    def __init__(self, table: "Table" or str = None):
+        self.path = []  # адрес поля
+        self.test_method_name = None  # метод, который будет вызываться у значения для проверки
+        self.test_value = None  # значение проверки
+        self.db = None  # ассоциированная база данных
+        # ассоциированная таблица, из которой берутся записи
+        self.table_name = table.name if isinstance(table, Table) else table
+        self._order = None  # (путь к полю, по убыванию) -- порядок выдачи записей
+        self._select = None  # type: List[List[object]]  # пути к полям проекции
+        self._each = False  # проверяются элементы поля-списка, см. any()
+
+    def __call__(self, row: dict) -> dict or None:
+        """
+        Проверяет запись в соответствии с фильтром
+        :param row: запись
+        :return: Строка или ничего, в зависимости от того, прошёл ли тест
+        """
+        res = self._check(row)
+
+        if res:
+            return row
+        else:
+            return None
+
+    def all(self, db: MemNRDB or None = None, to_class: bool or Row=False, workers: int=1) -> Iterable[Row]:
+        """
+        Возвращает все прошедшие фильтр записи
+        :param db: База данных, с которой будет работать запрос
+        :param to_class: преобразование в класс
+        :param workers: число процессов, проверяющих записи (больших таблиц, где есть fork)
+        :return: записи
+        """
+        db = self._db(db)
+        if isinstance(db, ShardedMemNRDB):
+            yield from db._query_rows(self, None, to_class)
+            return
+        yield from self._run(db, None, to_class, workers)
+
+    def limit(self, count: int, db: MemNRDB = None, to_class: bool or Row=False, workers: int=1) -> Iterable[Row]:
+        """
+        Возвращает count записей, прошедших фильтр
+        :param count: кол-во записей, которые нужно вернуть
+        :param db: База данных, если не задана
+        :param to_class: преобразование в класс
+        :param workers: число процессов, проверяющих записи
+        :return: записи
+        """
+        db = self._db(db)
+        if isinstance(db, ShardedMemNRDB):
+            yield from db._query_rows(self, count, to_class)
+            return
+        for row in self._run(db, count, to_class, workers):
+            yield row
+            count -= 1
+            if 0 == count:
+                return
+
+    def _run(self, db: MemNRDB, count: int or None, to_class: bool or Row, workers: int) -> Iterable[object]:
+        """
+        Записи (или проекции) прошедшие фильтр, с учётом в профиле запросов, если он включён
+        :param count: сколько первых записей нужно при заданном порядке (None -- все)
+        """
+        table = db[self.table_name]
+        rows = self._rows(db, table, count, to_class, workers)
+        if table._profiler is not None:
+            rows = table._profiler._timed(self, table, rows)
+        return rows
+
+    def _rows(self, db: MemNRDB, table: Table, count: int or None, to_class: bool or Row,
+              workers: int) -> Iterable[object]:
+        if self._select is not None:
+            yield from self._selected(db, table, count, to_class, workers)
+            return
+        meta_data = table.meta_data
+        if self._order is None:
+            ids = db._query_ids(self, table, workers)
+        else:
+            ids = self._ordered_ids(db, table, count, workers)
+        for _id in ids:
+            yield _apply_class(meta_data[_id], to_class, table)
+
+    def order_by(self, *path: object, desc: bool=False) -> 'Query':
+        """
+        Выдавать записи в порядке значения поля. Числа идут раньше строк, записи
+        с равными значениями -- по id (по убыванию -- всё в обратном порядке);
+        записи без поля (или с несравнимым значением) -- в конце, в порядке таблицы.
+        Вместе с limit(k) записи отбираются кучей из k элементов, а если по полю
+        есть упорядоченный индекс -- проходом по индексу до k-й подходящей записи.
+
+        >>> U = Query("users")
+        >>> q = (U.sex == 1).order_by("graduation", desc=True)
+        >>> db = MemNRDB()
+        >>> rows = db.query(q).limit(100)
+
+        :param path: путь к полю
+        :param desc: по убыванию
+        :return: новый запрос
+        """
+        if not path:
+            raise DBException("Не задано поле сортировки")
+        new_q = copy.copy(self)
+        new_q._order = (list(path), desc)
+        return new_q
+
+    def select(self, *paths: object) -> 'Query':
+        """
+        Выдавать вместо записей кортежи значений полей (None, если поля нет).
+        Поле задаётся именем или кортежем -- путём к вложенному полю. Записи
+        читаются без сохранения в памяти (см. Table._peek), а при параллельном
+        просмотре дочерние процессы передают только кортежи.
+
+        >>> U = Query("users")
+        >>> db = MemNRDB()
+        >>> users = db.init_table("users")
+        >>> row = users.insert({"first_name": "Иван", "sex": 1, "cost": {"g": 0.5}})
+        >>> list(db.query((U.sex == 1).select("id", "first_name", ("cost", "g"), "city")).all())
+        [(1, 'Иван', 0.5, None)]
+
+        :param paths: поля
+        :return: новый запрос
+        """
+        if not paths:
+            raise DBException("Не заданы поля проекции")
+        new_q = copy.copy(self)
+        new_q._select = [list(path) if isinstance(path, (tuple, list)) else [path] for path in paths]
+        return new_q
+
+    def _selected(self, db: MemNRDB, table: Table, count: int or None, to_class: bool or Row,
+                  workers: int) -> Iterable[tuple]:
+        """ Проекции прошедших фильтр записей (count первых, если задан порядок) """
+        if to_class:
+            raise DBException("Проекцию нельзя преобразовать в класс записи")
+        project = self._projector()
+        if self._order is None:
+            yield from self.plan(table).projected(project, workers)
+            return
+        peek = table._peek
+        for _id in self._ordered_ids(db, table, count, workers):
+            yield project(_id, peek(_id))
 
-    """
+    def _projector(self):
+        """ Функция (id, запись) -> кортеж значений полей проекции """
+        getters = [Aggregation._row_getter(path) for path in self._select]
 
-    def __init__(self, table: "Table" or str = None):
-        self.path = []  # адрес поля
-        self.test_method_name = None  # метод, который будет вызываться у значения для проверки
-        self.test_value = None  # значение проверки
-        self.db = None  # ассоциированная база данных
-        # ассоциированная таблица, из которой берутся записи
-        self.table_name = table.name if isinstance(table, Table) else table
+        def project(_id: int, row: dict) -> tuple:
+            return tuple([get(_id, row) for get in getters])
+        return project
 
-    def __call__(self, row: dict) -> dict or None:
+    def _ordered_ids(self, db: MemNRDB, table: Table, count: int or None, workers: int=1) -> List[int]:
         """
-        Проверяет запись в соответствии с фильтром
-        :param row: запись
-        :return: Строка или ничего, в зависимости от того, прошёл ли тест
+        id прошедших фильтр записей в порядке self._order
+        :param count: сколько первых записей нужно (None -- все)
         """
-        res = self._check(row)
+        path, desc = self._order
+        plan = self.plan(table)
+        index = table.indexes.get(path[0]) if 1 == len(path) else None
+        if isinstance(index, SortedIndex) and not index.multi:
+            candidates = plan.candidates
+            # проход по индексу проверяет в среднем count / доля подходящих записей
+            if candidates is None or (count is not None and count * len(table) <= len(candidates) ** 2):
+                return self._index_ordered_ids(db, table, plan, index, desc, count)
 
-        if res:
-            return row
+        if workers > 1:
+            peek = table._peek
+            items = ((_id, peek(_id)) for _id in plan.ids(workers))
         else:
-            return None
+            items = plan.items()
+        if 1 == len(path):
+            field = path[0]
+            values = ((_id, row.get(field)) for _id, row in items)
+        else:
+            values = ((_id, _value_by_path(row, path)) for _id, row in items)
+        order_class = SortedIndex.order_class
+        rest = []  # type: List[int]  # записи без значения, по которому можно сортировать
 
-    def all(self, db: MemNRDB or None = None, to_class: bool or Row=False) -> Iterable[Row]:
-        """
-        Возвращает все прошедшие фильтр записи
-        :param db: База данных, с которой будет работать запрос
-        :param to_class: преобразование в класс
-        :return: записи
-        """
+        def keys() -> Iterable[tuple]:
+            for _id, value in values:
+                if value.__class__ is int or value.__class__ is str:
+                    yield (value.__class__ is str), value, _id
+                    continue
+                cls = order_class(value)
+                if cls is not None:
+                    yield cls, value, _id
+                elif count is None or len(rest) < count:
+                    rest.append(_id)
+
+        if count is None:
+            top = sorted(keys(), reverse=desc)
+        else:
+            top = (heapq.nlargest if desc else heapq.nsmallest)(count, keys())
+        ids = [key[2] for key in top] + rest
+        return ids if count is None else ids[:count]
+
+    def _index_ordered_ids(self, db: MemNRDB, table: Table, plan: 'QueryPlan', index: 'SortedIndex',
+                           desc: bool, count: int or None) -> List[int]:
+        """ id в порядке упорядоченного индекса: записи проверяются, пока не наберётся count """
+        check = plan.check
+        peek = table._peek
+        candidates = plan.candidates
+        if candidates is not None and not isinstance(candidates, (set, frozenset)):
+            candidates = set(candidates)
+        ids = []
+        for _id in index.ids(reverse=desc):
+            if count is not None and len(ids) >= count:
+                return ids
+            if (candidates is None or _id in candidates) and check(peek(_id)):
+                ids.append(_id)
+        # в индексе нет записей без поля -- они идут последними
+        path = index.path
+        for _id in db._query_ids(self, table):
+            if count is not None and len(ids) >= count:
+                break
+            if SortedIndex.order_class(_value_by_path(peek(_id), path)) is None:
+                ids.append(_id)
+        return ids
+
+    def _db(self, db: MemNRDB or None) -> MemNRDB:
+        """ БД, с которой работает запрос (заданная ему или переданная) """
         if self.db and db:
             raise DBException("База данных уже задана")
         if not self.db and not db:
             raise DBException("База данных не задана!")
+        return self.db or db
 
-        db = self.db or db
-        table = db[self.table_name]
+    def _table(self, db: MemNRDB or None) -> Table:
+        """ Таблица запроса в заданной БД """
+        return self._db(db)[self.table_name]
 
-        for row in table.rows():
-            r = self(row)
-            if r is not None:
-                yield _apply_class(r, to_class)
+    def count(self, db: MemNRDB or None = None) -> int:
+        """
+        Число прошедших фильтр записей (сами записи не создаются)
+        :param db: База данных, если не задана
+        :return: число записей
+        """
+        return Aggregation(self).agg(db, count="count")["count"]
 
-    def limit(self, count: int, db: MemNRDB = None, to_class: bool or Row=False) -> Iterable[Row]:
+    def agg(self, db: MemNRDB or None = None, **aggregates) -> dict:
         """
-        Возвращает count записей, прошедших фильтр
-        :param count: кол-во записей, которые нужно вернуть
+        Посчитать агрегаты по прошедшим фильтр записям за один проход
         :param db: База данных, если не задана
-        :param to_class: преобразование в класс
-        :return: записи
+        :param aggregates: имя результата -> "count" или (функция, *путь к полю), см. Aggregation
+        :return: имя результата -> значение
         """
-        for row in self.all(db=db, to_class=to_class):
-            yield row
-            count -= 1
-            if 0 == count:
-                return
+        return Aggregation(self).agg(db, **aggregates)
+
+    def group_by(self, *path: object) -> 'Aggregation':
+        """
+        Сгруппировать прошедшие фильтр записи по значению поля
+        :param path: путь к полю
+        :return: группировка, агрегаты по которой считает .agg(...)
+        """
+        if not path:
+            raise DBException("Не задано поле группировки")
+        return Aggregation(self, list(path))
+
+    def plan(self, table: Table) -> 'QueryPlan':
+        """
+        Составляет план выполнения запроса по таблице
+        :param table: таблица
+        :return: план
+        """
+        return QueryPlan(self, table)
+
+    def _candidates(self, table: Table) -> Iterable[int] or None:
+        """
+        Возвращает id записей, среди которых точно есть все подходящие под запрос,
+        если их можно получить из индекса; иначе None (нужен полный просмотр таблицы).
+        Каждая запись-кандидат всё равно проверяется через _check.
+        :param table: таблица, по которой выполняется запрос
+        :return: множество id или None
+        """
+        if self.test_value is None or not self.path:
+            return None
+        if self._interned_eq(table) and table.interned(self.test_value) is None:
+            return _EMPTY_IDS
+        index = self._index(table)
+        if index is not None:
+            return index.candidates(self.test_method_name, self.test_value)
+        if 1 == len(self.path) and not self._each and isinstance(table.meta_data, ColumnarRows):
+            return table.meta_data.column_candidates(self.path[0], self.test_method_name, self.test_value)
+        return None
+
+    def _index(self, table: Table) -> Index or None:
+        """ Индекс таблицы по полю запроса, подходящий для отбора кандидатов (или None) """
+        if not self.path:
+            return None
+        index = table.indexes.get(self.path[0] if 1 == len(self.path) else tuple(self.path))
+        if index is None or index.multi != self._each:
+            return None
+        return index
+
+    def _canonical(self) -> tuple:
+        """ Каноническая форма запроса: одинаковые по смыслу запросы дают равные формы """
+        # тип значения важен: у int-поля `== 1.0` не проходит, а `== 1` проходит
+        return ("q", tuple(self.path), self._each, self.test_method_name, type(self.test_value).__name__,
+                self.test_value)
+
+    def _cache_key(self) -> tuple or None:
+        """ Ключ для кеша результатов или None, если запрос нельзя кешировать """
+        key = self._canonical()
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _interned_eq(self, table: Table) -> bool:
+        """ Запрос -- сравнение на равенство строкового поля, хранящегося в пуле таблицы """
+        return ("__eq__" == self.test_method_name and isinstance(self.test_value, str)
+                and 1 == len(self.path) and not self._each and self.path[0] in table.intern)
 
     @staticmethod
     def _any(row: dict or Row) -> bool:
@@ -501,8 +4136,44 @@ class Query:
         """ Запрос будет проверять на существование поля """
         new_q = copy.copy(self)
         new_q.test_method_name = "_exist_field"
+        new_q.test_value = None
+        return new_q
+
+    def any(self) -> 'Query':
+        """
+        Проверять элементы поля-списка: запрос проходит, если проходит хотя бы один
+        элемент (у поля не списка -- не проходит). По многозначному индексу
+        (Table.create_index(..., multi=True)) такие запросы отвечают без просмотра таблицы.
+
+        >>> U = Query("users")
+        >>> (U.universities.any() == 671)._check({"universities": [1, 671]})
+        True
+        >>> (U.universities.any() > 1000)._check({"universities": [1, 671]})
+        False
+
+        :return: новый запрос
+        """
+        if self.test_method_name:
+            raise DBException("Подзапрос уже сгенерирован, невозможно получить из него новый")
+        new_q = copy.copy(self)
+        new_q._each = True
         return new_q
 
+    def _check_items(self, row: dict or Row) -> bool:
+        """ Проходит ли фильтр хотя бы один элемент поля-списка """
+        items = self._get_val_by_path(row)
+        if not isinstance(items, (list, tuple, set, frozenset)):
+            return False
+        for item in items:
+            if item is None:
+                continue
+            if self.test_value is None:
+                return True
+            res = getattr(item, self.test_method_name)(self.test_value)
+            if NotImplemented != res and res:
+                return True
+        return False
+
     def _exist_field(self, row: dict or Row) -> bool:
         """ Проверяет, существует ли поле """
         return self._get_val_by_path(row) is not None
@@ -523,6 +4194,8 @@ class Query:
         :param row: запись
         :return:
         """
+        if self._each:
+            return self._check_items(row)
         if self._exist_field(row):
             if self.test_value is None:
                 return True
@@ -536,6 +4209,10 @@ class Query:
                 return True if res else False
         return False
 
+    def _fields(self) -> Set[object]:
+        """ Поля записи (верхнего уровня), от которых зависит результат проверки """
+        return set(self.path[:1])
+
     def __getitem__(self, item: object) -> 'Query':
         if self.test_method_name:
             raise DBException("Подзапрос уже сгенерирован, невозможно получить из него новый")
@@ -559,10 +4236,11 @@ class Query:
         return QueryLogic("__or__", self, other)
 
     def _comparison_filter_generator(self, test_method_name: str, test_value: object):
-        """ Задаёт, какую операцию с чем выполнить """
-        self.test_method_name = test_method_name
-        self.test_value = test_value
-        return self
+        """ Задаёт, какую операцию с чем выполнить (у копии запроса, чтобы поле можно было переиспользовать) """
+        new_q = copy.copy(self)
+        new_q.test_method_name = test_method_name
+        new_q.test_value = test_value
+        return new_q
 
     def __eq__(self, other) -> "Query":
         return self._comparison_filter_generator("__eq__", other)
@@ -590,9 +4268,35 @@ class Query:
         # TODO: разобраться, почему не работает
         return self._comparison_filter_generator("__is_not__", other)
 
+    _OPERATORS = {
+        "__eq__": "==",
+        "__ne__": "!=",
+        "__lt__": "<",
+        "__le__": "<=",
+        "__gt__": ">",
+        "__ge__": ">=",
+        "_exist_field": "exists",
+    }
+
+    def __str__(self):
+        field = ".".join(str(p) for p in ([self.table_name] if self.table_name else []) + self.path)
+        if self._each:
+            field += ".any()"
+        if self.test_method_name is None:
+            return field
+        if "_exist_field" == self.test_method_name:
+            return "{} exists".format(field)
+        return "{} {} {!r}".format(field, self._OPERATORS.get(self.test_method_name, self.test_method_name),
+                                   self.test_value)
+
     def __copy__(self) -> 'Query':
         new_q = Query(self.table_name)
         new_q.path = self.path[:]
+        new_q.test_method_name = self.test_method_name
+        new_q.test_value = self.test_value
+        new_q._order = self._order
+        new_q._select = self._select
+        new_q._each = self._each
         return new_q
 
 
@@ -606,11 +4310,941 @@ class QueryLogic(Query):
         if left.table_name != right.table_name:
             raise NotImplementedError("Невозможно создавать запросы из разных таблиц")
         self.table_name = left.table_name
-        self.mt = getattr(True, self.method_name)
-        self.mf = getattr(False, self.method_name)
+        self._order = None
+        self._select = None
+        self._each = False
 
     def _check(self, row: dict) -> bool:
-        return (self.mt if (self.left._check(row)) else self.mf)(self.right._check(row))
+        if "__and__" == self.method_name:
+            return self.left._check(row) and self.right._check(row)
+        return self.left._check(row) or self.right._check(row)
+
+    def _candidates(self, table: Table) -> Iterable[int] or None:
+        return self.plan(table).candidates
+
+    def _fields(self) -> Set[object]:
+        return self.left._fields() | self.right._fields()
+
+    def __str__(self):
+        return "({}) {} ({})".format(self.left, "&" if "__and__" == self.method_name else "|", self.right)
 
     def __copy__(self) -> 'QueryLogic':
-        return QueryLogic(self.method_name, self.left, self.right)
+        new_q = QueryLogic(self.method_name, self.left, self.right)
+        new_q._order = self._order
+        new_q._select = self._select
+        return new_q
+
+    def _canonical(self) -> tuple:
+        # цепочка одинаковых операций сворачивается, порядок операндов не важен
+        _, children = QueryPlan._flatten(self)
+        return (self.method_name,) + tuple(sorted((child._canonical() for child in children), key=repr))
+
+
+class Aggregation:
+    """
+    Агрегаты по записям, прошедшим фильтр, -- за один проход по таблице.
+
+    Агрегат задаётся как "count" (число записей) или кортеж (функция, *путь к полю):
+    count -- число записей, где поле есть; sum, avg -- сумма и среднее чисел;
+    min, max. Записи без поля в агрегате не участвуют; если поля нет ни у одной
+    записи группы, sum = 0, а avg, min и max -- None.
+    Записи, у которых поля группировки нет (или его значение нехешируемое),
+    ни в одну группу не попадают -- как и в хеш-индекс.
+
+    Если по полю группировки есть хеш-индекс, число записей в группах всей
+    таблицы берётся из него; поля колоночной таблицы читаются прямо из колонок,
+    а без группировки агрегаты по ним считаются по массивам колонок целиком.
+
+    >>> db = MemNRDB()
+    >>> users = db.init_table("users")
+    >>> for faculty, cost in (("ФИТ", 0.5), ("ФИТ", 1.5), ("ММФ", 2.0), (None, 1.0)):
+    ...     row = users.insert({"faculty": faculty, "cost": {"g": cost}})
+    >>> U = Query("users")
+    >>> db.query(U).count()
+    4
+    >>> db.query(U).group_by("faculty").agg(users="count", cost=("avg", "cost", "g"))
+    {'ФИТ': {'users': 2, 'cost': 1.0}, 'ММФ': {'users': 1, 'cost': 2.0}}
+    >>> db.query(U.faculty == "ФИТ").agg(max_cost=("max", "cost", "g"), total=("sum", "cost", "g"))
+    {'max_cost': 1.5, 'total': 2.0}
+    """
+    FUNCTIONS = ("count", "sum", "avg", "min", "max")
+
+    def __init__(self, query: Query, group_path: List[object] or None=None):
+        self.query = query
+        self.group_path = group_path
+
+    def _parse(self, aggregates: dict) -> List[tuple]:
+        """ Разобрать описания агрегатов в список (имя, функция, путь) """
+        specs = []
+        for name, spec in aggregates.items():
+            if isinstance(spec, str):
+                spec = (spec,)
+            if not isinstance(spec, tuple) or not spec or spec[0] not in self.FUNCTIONS:
+                raise DBException("Неизвестный агрегат `{}`: {}".format(name, spec))
+            if 1 == len(spec) and "count" != spec[0]:
+                raise DBException("Для агрегата `{}` не задано поле".format(name))
+            specs.append((name, spec[0], list(spec[1:])))
+        return specs
+
+    def agg(self, db: MemNRDB or None = None, **aggregates) -> dict:
+        """
+        Посчитать агрегаты
+        :param db: База данных, если не задана
+        :param aggregates: имя результата -> "count" или (функция, *путь к полю)
+        :return: без группировки -- имя -> значение; с группировкой -- значение поля -> (имя -> значение)
+        """
+        specs = self._parse(aggregates)
+        query = self.query
+        db = query._db(db)
+        if isinstance(db, ShardedMemNRDB):
+            return db._aggregate(self, specs)
+        table = db[query.table_name]
+        if table._profiler is None:
+            return self._agg(db, table, specs)
+        start = time.perf_counter()
+        result = self._agg(db, table, specs)
+        table._profiler._add_call(query, table, time.perf_counter() - start, len(result) if self.group_path else 1)
+        return result
+
+    def _agg(self, db: MemNRDB, table: Table, specs: List[tuple]) -> dict:
+        query = self.query
+        groups = self._index_counts(table, specs)
+        if groups is not None:
+            return groups
+
+        # каждое поле читается из записи один раз, а агрегаты копятся на ходу:
+        # по группе хранятся только число значений поля, их сумма, минимум и максимум
+        paths = []  # type: List[List[object]]
+        for name, func, path in specs:
+            if path and path not in paths:
+                paths.append(path)
+        all_paths = paths + [self.group_path] if self.group_path else paths
+        filtered = isinstance(query, QueryLogic) or bool(query.path)
+        if not filtered and not all_paths:
+            return self._finish(table, specs, paths, len(table), [])
+        # что копить по каждому полю: сумму (sum, avg) и минимум с максимумом (min, max)
+        needs = [(any(path == p and func in ("sum", "avg") for name, func, p in specs),
+                  any(path == p and func in ("min", "max") for name, func, p in specs)) for path in paths]
+        getters = self._column_getters(table, all_paths)
+        if getters is not None:
+            # все поля читаются из колонок по позициям записей, сами записи не нужны
+            positions = range(len(table))
+            if filtered:
+                positions = list(table.meta_data.positions(db._query_ids(query, table)))
+            if not self.group_path:
+                # без группировки агрегаты считаются прямо по массивам колонок
+                states = [table.meta_data.column_state(path[0], positions if filtered else None, add, order)
+                          for path, (add, order) in zip(paths, needs)]
+                if None not in states:
+                    return self._finish(table, specs, paths, len(positions), states)
+            items = zip(positions, repeat(None))
+        else:
+            getters = {tuple(path): self._row_getter(path) for path in all_paths}
+            if filtered:
+                peek = table._peek
+                items = ((_id, peek(_id)) for _id in db._query_ids(query, table))
+            else:
+                # без фильтра план не нужен
+                items = table._scan_items()
+        gets = [getters[tuple(path)] for path in paths]
+        get_key = getters[tuple(self.group_path)] if self.group_path else None
+
+        # группа -> [число записей, состояние каждого поля], состояние поля --
+        # [число значений, сумма, минимум, максимум, не число, несравнимое значение]
+        groups = {}  # type: Dict[object, list]
+        for item, row in items:
+            key = None
+            if get_key is not None:
+                key = get_key(item, row)
+                if key is None:
+                    continue
+            try:
+                group = groups.get(key)
+            except TypeError:
+                continue
+            if group is None:
+                group = groups[key] = [0, [[0, 0, None, None, None, None] for _ in paths]]
+            group[0] += 1
+            for state, get, (add, order) in zip(group[1], gets, needs):
+                value = get(item, row)
+                if value is None:
+                    continue
+                state[0] += 1
+                if add:
+                    if isinstance(value, (int, float)):
+                        state[1] += value
+                    elif state[4] is None:
+                        state[4] = value
+                if order:
+                    try:
+                        if state[2] is None:
+                            state[2] = state[3] = value
+                        elif value < state[2]:
+                            state[2] = value
+                        elif value > state[3]:
+                            state[3] = value
+                    except TypeError:
+                        if state[5] is None:
+                            state[5] = state[2] if isinstance(value, (int, float)) else value
+
+        result = {key: self._finish(table, specs, paths, count, states) for key, (count, states) in groups.items()}
+        if self.group_path:
+            return result
+        return result.get(None) or self._finish(table, specs, paths, 0, [[0, 0, None, None, None, None] for _ in paths])
+
+    @staticmethod
+    def _finish(table: Table, specs: List[tuple], paths: List[List[object]], count: int,
+                states: List[list]) -> dict:
+        """ Итоговые значения агрегатов группы по накопленному состоянию её полей """
+        result = {}
+        for name, func, path in specs:
+            if not path:
+                result[name] = count
+                continue
+            n, total, low, high, not_number, unordered = states[paths.index(path)]
+            if "count" == func:
+                result[name] = n
+            elif "min" == func or "max" == func:
+                if unordered is not None:
+                    raise DBTypeError(table, "agg", name, unordered, float)
+                result[name] = low if "min" == func else high
+            elif not_number is not None:
+                raise DBTypeError(table, "agg", name, not_number, float)
+            elif "sum" == func:
+                result[name] = total
+            else:
+                result[name] = total / n if n else None
+        return result
+
+    @staticmethod
+    def _row_getter(path: List[object]):
+        """ Функция (id, запись) -> значение поля записи """
+        if 1 == len(path):
+            field = path[0]
+            return lambda _id, row: row.get(field)
+        return lambda _id, row: _value_by_path(row, path)
+
+    def _index_counts(self, table: Table, specs: List[tuple]) -> dict or None:
+        """ Число записей в группах всей таблицы по хеш-индексу поля группировки (или None) """
+        query = self.query
+        if (not self.group_path or 1 != len(self.group_path) or isinstance(query, QueryLogic) or query.path
+                or any("count" != func or path for name, func, path in specs)):
+            return None
+        index = table.indexes.get(self.group_path[0])
+        # многозначный индекс считает записи по элементам, а не по значениям поля
+        if not isinstance(index, HashIndex) or index.multi:
+            return None
+        return {value: {name: count for name, func, path in specs} for value, count in index.counts().items()}
+
+    @staticmethod
+    def _column_getters(table: Table, paths: List[List[object]]) -> Dict[tuple, object] or None:
+        """
+        Функции (позиция, запись) -> значение, читающие поля прямо из колонок,
+        если все поля -- колонки таблицы (иначе None)
+        """
+        meta_data = table.meta_data
+        if not isinstance(meta_data, ColumnarRows):
+            return None
+        getters = {}
+        for path in paths:
+            if 1 != len(path) or path[0] not in table.columns:
+                return None
+            getters[tuple(path)] = meta_data.column_getter(path[0])
+        return getters
+
+
+class MaterializedView:
+    """
+    Материализованное представление: id записей таблицы, прошедших фильтр запроса,
+    и агрегаты по ним (как у Aggregation без группировки).
+
+    Как и индекс, представление строится при первом чтении, а дальше его
+    поддерживает сама таблица: insert, update и ins_upd проверяют запросом только
+    изменённую запись и поправляют множество id и агрегаты, поэтому чтение стоит
+    O(результата), а запись -- O(1) на представление (update не трогает
+    представления, от полей которых ничего не изменилось). min и max после удаления
+    текущего минимума (максимума) пересчитываются по различным значениям при чтении.
+    Значения, учтённые в агрегатах, представление помнит для каждой записи и при
+    изменении вычитает именно их (вложенное поле могли изменить на месте до update).
+    Записи, изменённые напрямую, представление не увидит -- см. refresh.
+
+    >>> db = MemNRDB()
+    >>> users = db.init_table("users")
+    >>> rows = users.insert_many([{"university": 671, "cost": 1}, {"university": 671, "cost": 3}, {"cost": 5}])
+    >>> U = Query("users")
+    >>> nsu = db.create_view("nsu", U.university == 671, users="count", cost=("avg", "cost"))
+    >>> nsu.ids()
+    [1, 2]
+    >>> row = users.insert({"university": 671, "cost": 8})
+    >>> row = users.update({"id": 1, "university": 1})
+    >>> nsu.ids(), nsu.agg()
+    ([2, 4], {'users': 2, 'cost': 5.5})
+    """
+
+    def __init__(self, name: str, query: Query, table: Table, aggregates: dict):
+        self.name = name
+        self.query = query
+        self.table = table
+        self.specs = Aggregation(query)._parse(aggregates)
+        # поля, при изменении которых запись нужно проверить заново
+        self.fields = query._fields() | {path[0] for name, func, path in self.specs if path}
+        # id записей в порядке попадания в представление -> значения, учтённые в агрегатах по полям
+        self._ids = {}  # type: Dict[int, tuple]
+        self._aggregates = []  # type: List[_RunningAggregate]
+        self._measures = []  # type: List[_RunningAggregate]  # агрегаты по полям (не count)
+        self.built = False
+
+    def _ensure(self):
+        """ Построить представление по таблице """
+        if self.built:
+            return
+        self.built = True
+        self._ids = {}
+        self._aggregates = [_RunningAggregate(self.table, name, func) for name, func, path in self.specs]
+        self._measures = [aggregate for aggregate, (name, func, path) in zip(self._aggregates, self.specs) if path]
+        for _id, row in self.query.plan(self.table).items():
+            self._add(_id, row)
+
+    def refresh(self):
+        """ Пересобрать представление (например, после изменения записей в обход update) """
+        self.built = False
+        self._ensure()
+
+    def _add(self, _id: int, row: dict):
+        """ Добавить запись, прошедшую фильтр """
+        values = tuple(_value_by_path(row, path) for name, func, path in self.specs if path)
+        self._ids[_id] = values
+        for aggregate, value in zip(self._measures, values):
+            aggregate.add(value)
+
+    def _offer(self, _id: int, row: dict):
+        """ Новое состояние записи: добавить её, если она проходит фильтр """
+        if self.query._check(row):
+            self._add(_id, row)
+
+    def _discard(self, _id: int):
+        """ Запись меняется: убрать её и учтённые по ней значения, если она была в представлении """
+        values = self._ids.pop(_id, None)
+        if values is None:
+            return
+        for aggregate, value in zip(self._measures, values):
+            aggregate.remove(value)
+
+    def ids(self) -> List[int]:
+        """ id записей представления """
+        self._ensure()
+        return list(self._ids)
+
+    def rows(self, to_class: bool or 'Row'=False) -> Iterable[dict or 'Row']:
+        """
+        Записи представления
+        :param to_class: обработка каждой записи, см. Table.rows
+        """
+        meta_data = self.table.meta_data
+        for _id in self.ids():
+            yield _apply_class(meta_data[_id], to_class, self.table)
+
+    def agg(self) -> dict:
+        """
+        Текущие значения агрегатов
+        :return: имя -> значение
+        """
+        self._ensure()
+        return {aggregate.name: len(self._ids) if not path else aggregate.result()
+                for aggregate, (name, func, path) in zip(self._aggregates, self.specs)}
+
+    def __contains__(self, _id: int) -> bool:
+        self._ensure()
+        return _id in self._ids
+
+    def __len__(self):
+        self._ensure()
+        return len(self._ids)
+
+    def __str__(self):
+        return "<MemNRDB.MaterializedView:{}> {}".format(self.name, self.query)
+
+
+class _RunningAggregate:
+    """ Агрегат, который пересчитывается при добавлении и удалении значений """
+
+    def __init__(self, table: Table, name: str, func: str):
+        self.table = table
+        self.name = name
+        self.func = func
+        self.count = 0  # сколько значений учтено
+        self.total = 0  # сумма чисел (sum, avg)
+        # значения, которые нельзя сложить или сравнить: значение -> сколько раз учтено
+        self.bad = {}  # type: Dict[object, int]
+        self.bad_unhashable = []  # такие значения, если они нехешируемые
+        self.values = {}  # type: Dict[object, int]  # значение -> сколько раз учтено (min, max)
+        self._extreme = _ABSENT  # текущий min/max; _ABSENT -- нужно пересчитать
+
+    def add(self, value: object):
+        if value is None:
+            return
+        self.count += 1
+        func = self.func
+        if "sum" == func or "avg" == func:
+            if isinstance(value, (int, float)):
+                self.total += value
+            else:
+                self._add_bad(value)
+        elif "min" == func or "max" == func:
+            try:
+                self.values[value] = self.values.get(value, 0) + 1
+            except TypeError:
+                self._add_bad(value)
+                return
+            extreme = self._extreme
+            if extreme is not _ABSENT:
+                try:
+                    if (value < extreme) if "min" == func else (value > extreme):
+                        self._extreme = value
+                except TypeError:
+                    self._extreme = _ABSENT
+
+    def remove(self, value: object):
+        if value is None:
+            return
+        self.count -= 1
+        func = self.func
+        if "sum" == func or "avg" == func:
+            if isinstance(value, (int, float)):
+                self.total -= value
+            else:
+                self._remove_bad(value)
+        elif "min" == func or "max" == func:
+            try:
+                count = self.values[value] - 1
+            except (TypeError, KeyError):
+                self._remove_bad(value)
+                return
+            if count:
+                self.values[value] = count
+            else:
+                del self.values[value]
+                if self._extreme is not _ABSENT and value == self._extreme:
+                    self._extreme = _ABSENT
+
+    def _add_bad(self, value: object):
+        try:
+            self.bad[value] = self.bad.get(value, 0) + 1
+        except TypeError:
+            self.bad_unhashable.append(value)
+
+    def _remove_bad(self, value: object):
+        try:
+            count = self.bad.get(value, 0) - 1
+        except TypeError:
+            if value in self.bad_unhashable:
+                self.bad_unhashable.remove(value)
+            return
+        if count > 0:
+            self.bad[value] = count
+        elif count == 0:
+            del self.bad[value]
+
+    def result(self) -> object:
+        func = self.func
+        if "count" == func:
+            return self.count
+        if self.bad or self.bad_unhashable:
+            value = next(iter(self.bad)) if self.bad else self.bad_unhashable[0]
+            raise DBTypeError(self.table, "agg", self.name, value, float)
+        if "sum" == func:
+            return self.total
+        if "avg" == func:
+            return self.total / self.count if self.count else None
+        if not self.values:
+            return None
+        if self._extreme is _ABSENT:
+            try:
+                self._extreme = min(self.values) if "min" == func else max(self.values)
+            except TypeError:
+                value = next((value for value in self.values if not isinstance(value, (int, float))), None)
+                raise DBTypeError(self.table, "agg", self.name, value, float)
+        return self._extreme
+
+
+def _value_size(value: object) -> int:
+    """ Память значения поля вместе с вложенными значениями (общие объекты не считаются) """
+    if value is None or value is True or value is False:
+        return 0
+    if value.__class__ is int and -5 <= value <= 256:
+        return 0
+    size = sys.getsizeof(value)
+    if isinstance(value, Mapping):
+        for item in value.values():
+            size += _value_size(item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += _value_size(item)
+    return size
+
+
+def _value_by_path(row: dict, path: List[object]) -> object or None:
+    """ Значение поля записи по пути или None, если его нет """
+    for p in path:
+        if not isinstance(row, Mapping) or p not in row:
+            return None
+        row = row[p]
+    return row
+
+
+class QueryPlan:
+    """
+    План выполнения запроса по таблице.
+
+    Цепочки одинаковых `&`/`|` сворачиваются в один узел. Листья, по полям которых
+    есть индексы, превращаются в множества id-кандидатов: для `&` они пересекаются
+    (сравнения одного поля склеиваются в один диапазон упорядоченного индекса),
+    для `|` объединяются. Оставшиеся проверки упорядочиваются по оценке
+    селективности и вычисляются с коротким замыканием: в `&` сначала самые
+    отсекающие, в `|` -- самые пропускающие.
+
+    >>> t = Table("users", indexes={'university': 'hash', 'graduation': 'sorted'})
+    >>> U = Query("users")
+    >>> plan = ((U.university == 671) & (U.graduation >= 2015) & (U.graduation < 2020) & (U.sex == 1)).plan(t)
+    >>> plan.used_indexes
+    ['graduation', 'university']
+    >>> (U.sex == 1).plan(t).candidates is None
+    True
+    """
+    # Оценка доли записей, проходящих проверку, для полей без индекса
+    SELECTIVITY = {
+        "__eq__": 0.1,
+        "__ne__": 0.9,
+        "__lt__": 0.3,
+        "__le__": 0.3,
+        "__gt__": 0.3,
+        "__ge__": 0.3,
+    }
+    DEFAULT_SELECTIVITY = 0.8
+
+    # Пересекать с кандидатами-списком, только если он не намного больше текущего результата;
+    # иначе дешевле проверить лишние записи предикатом
+    INTERSECT_FACTOR = 4
+
+    # Параллельный просмотр включается для таблиц (или кандидатов) не меньше этого размера;
+    # записи делятся на столько кусков на процесс, чтобы limit мог остановиться пораньше
+    PARALLEL_MIN_ROWS = 10000
+    CHUNKS_PER_WORKER = 4
+
+    _LOWER = {"__gt__": False, "__ge__": True}
+    _UPPER = {"__lt__": False, "__le__": True}
+
+    def __init__(self, query: Query, table: Table):
+        self.query = query
+        self.table = table
+        self.used_indexes = []  # type: List[str]
+        self._size = max(len(table), 1)
+        self._leaf_candidates = {}  # type: Dict[int, Iterable[int] or None]
+        self._backed = set()  # type: Set[int]  # id() узлов, для которых есть кандидаты из индексов
+        self.candidates = self._plan_candidates(query)
+        self.check = self._compile(query)
+        if table._profiler is not None:
+            self.check = table._profiler._planned(self)
+
+    @staticmethod
+    def _flatten(node: Query) -> (str or None, List[Query]):
+        """ Сворачивает цепочку одинаковых логических операций в список операндов """
+        if not isinstance(node, QueryLogic):
+            return None, []
+        children = []
+        stack = [node]
+        while stack:
+            cur = stack.pop()
+            if isinstance(cur, QueryLogic) and cur.method_name == node.method_name:
+                stack.append(cur.right)
+                stack.append(cur.left)
+            else:
+                children.append(cur)
+        return node.method_name, children
+
+    def _use_index(self, field: str):
+        if field not in self.used_indexes:
+            self.used_indexes.append(field)
+
+    def _leaf(self, leaf: Query) -> Iterable[int] or None:
+        """ Кандидаты для листа (вычисляются один раз) """
+        key = id(leaf)
+        if key not in self._leaf_candidates:
+            candidates = leaf._candidates(self.table)
+            self._leaf_candidates[key] = candidates
+            if candidates is not None:
+                index = leaf._index(self.table)
+                self._use_index(leaf.path[0] if index is None else index.name)
+        return self._leaf_candidates[key]
+
+    def _range_leaf(self, leaf: Query) -> (str, int) or None:
+        """ Ключ (поле, класс значения), если лист -- сравнение по полю с упорядоченным индексом """
+        if leaf.test_method_name not in self._LOWER and leaf.test_method_name not in self._UPPER:
+            return None
+        if leaf.test_value is None:
+            return None
+        index = leaf._index(self.table)
+        # у многозначного индекса сравнения могут выполняться на разных элементах -- их не склеить
+        if not isinstance(index, SortedIndex) or index.multi:
+            return None
+        cls = SortedIndex.order_class(leaf.test_value)
+        if cls is None:
+            return None
+        return index.field, cls
+
+    def _merged_ranges(self, children: List[Query]) -> List[Iterable[int]]:
+        """
+        Склеивает сравнения одного поля под `&` в диапазоны упорядоченного индекса
+        (например, `x >= 2015` и `x < 2020` -> один поиск [2015, 2020))
+        """
+        groups = {}  # type: Dict[tuple, List[Query]]
+        for child in children:
+            if not isinstance(child, QueryLogic):
+                key = self._range_leaf(child)
+                if key is not None:
+                    groups.setdefault(key, []).append(child)
+
+        result = []
+        for (field, cls), leaves in groups.items():
+            if len(leaves) < 2:
+                continue
+            lo = hi = None
+            lo_inclusive = hi_inclusive = True
+            for leaf in leaves:
+                value = leaf.test_value
+                if leaf.test_method_name in self._LOWER:
+                    inclusive = self._LOWER[leaf.test_method_name]
+                    if lo is None or value > lo or (value == lo and not inclusive):
+                        lo, lo_inclusive = value, inclusive
+                else:
+                    inclusive = self._UPPER[leaf.test_method_name]
+                    if hi is None or value < hi or (value == hi and not inclusive):
+                        hi, hi_inclusive = value, inclusive
+            index = self.table.indexes[field]
+            result.append(index.range(lo, hi, lo_inclusive, hi_inclusive))
+            self._use_index(index.name)
+            for leaf in leaves:
+                self._leaf_candidates[id(leaf)] = None
+                self._backed.add(id(leaf))
+        return result
+
+    def _plan_candidates(self, node: Query) -> Iterable[int] or None:
+        """ Кандидаты для поддерева (None -- нужен полный просмотр) """
+        op, children = self._flatten(node)
+        if op is None:
+            candidates = self._leaf(node)
+        elif "__and__" == op:
+            parts = self._merged_ranges(children)
+            for child in children:
+                if id(child) in self._backed:
+                    continue
+                part = self._plan_candidates(child)
+                if part is not None:
+                    parts.append(part)
+            candidates = self._intersect(parts) if parts else None
+        else:
+            parts = []
+            for child in children:
+                part = self._plan_candidates(child)
+                if part is None:
+                    parts = None
+                    break
+                parts.append(part)
+            candidates = None
+            if parts is not None:
+                candidates = set()
+                for part in parts:
+                    candidates.update(part)
+        if candidates is not None:
+            self._backed.add(id(node))
+        return candidates
+
+    def _intersect(self, parts: List[Iterable[int]]) -> Set[int]:
+        """ Пересечение множеств кандидатов, начиная с самого маленького """
+        parts = sorted(parts, key=len)
+        result = set(parts[0])
+        for part in parts[1:]:
+            if not result:
+                break
+            if isinstance(part, (set, frozenset)):
+                result &= part
+            elif len(part) <= self.INTERSECT_FACTOR * len(result):
+                result.intersection_update(part)
+        return result
+
+    def _selectivity(self, node: Query) -> float:
+        """ Оценка доли записей, проходящих проверку поддерева """
+        op, children = self._flatten(node)
+        if op is None:
+            candidates = self._leaf_candidates.get(id(node))
+            if candidates is not None:
+                return len(candidates) / self._size
+            if not node.path:
+                return 1.0
+            return self.SELECTIVITY.get(node.test_method_name, self.DEFAULT_SELECTIVITY)
+        if "__and__" == op:
+            result = 1.0
+            for child in children:
+                result *= self._selectivity(child)
+            return result
+        result = 1.0
+        for child in children:
+            result *= 1.0 - self._selectivity(child)
+        return 1.0 - result
+
+    def _compile(self, node: Query):
+        """ Собирает функцию проверки записи с упорядоченными операндами """
+        op, children = self._flatten(node)
+        if op is None:
+            if node._interned_eq(self.table):
+                return self._identity_check(node)
+            return node._check
+        if "__and__" == op:
+            # проверки, уже учтённые индексами, для кандидатов почти всегда истинны -- их в конец
+            children.sort(key=lambda c: (id(c) in self._backed, self._selectivity(c)))
+            checks = [self._compile(child) for child in children]
+
+            def check(row):
+                for _check in checks:
+                    if not _check(row):
+                        return False
+                return True
+        else:
+            children.sort(key=self._selectivity, reverse=True)
+            checks = [self._compile(child) for child in children]
+
+            def check(row):
+                for _check in checks:
+                    if _check(row):
+                        return True
+                return False
+        return check
+
+    def _identity_check(self, leaf: Query):
+        """ Проверка равенства строки из пула: все такие значения в таблице -- объекты пула """
+        value = self.table.interned(leaf.test_value)
+        field = leaf.path[0]
+        if value is None:
+            return lambda row: False
+        return lambda row: row.get(field) is value
+
+    def items(self) -> Iterable[tuple]:
+        """ Пары (id, запись) для прошедших фильтр записей (запись -- только для чтения) """
+        check = self.check
+        if self.candidates is None:
+            for _id, row in self.table._scan_items():
+                if check(row):
+                    yield _id, row
+        else:
+            peek = self.table._peek
+            # копия нужна, чтобы изменения индексов во время обхода не ломали итерацию
+            for _id in list(self.candidates):
+                row = peek(_id)
+                if check(row):
+                    yield _id, row
+
+    def ids(self, workers: int=1) -> Iterable[int]:
+        """
+        id записей, прошедших фильтр
+        :param workers: число процессов; больше одного -- параллельный просмотр
+        """
+        yield from self.projected(None, workers)
+
+    def projected(self, project, workers: int=1) -> Iterable[object]:
+        """
+        Проекции прошедших фильтр записей
+        :param project: функция (id, запись) -> результат; None -- id записи
+        :param workers: число процессов; больше одного -- параллельный просмотр
+          (тогда проекции считаются в дочерних процессах и передаются только они)
+        """
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            ids = list(self.candidates if self.candidates is not None else self.table._read_ids())
+            if len(ids) >= self.PARALLEL_MIN_ROWS:
+                yield from self._parallel_ids(ids, workers, project)
+                return
+        if project is None:
+            for _id, row in self.items():
+                yield _id
+        else:
+            for _id, row in self.items():
+                yield project(_id, row)
+
+    def _parallel_ids(self, ids: List[int], workers: int, project=None) -> Iterable[object]:
+        """
+        Проверить записи в дочерних процессах. Процессы создаются через fork и видят
+        таблицу в момент запуска (память общая, copy-on-write); каждый получает только
+        номер куска ids и возвращает прошедшие фильтр id (или их проекции project).
+        Куски возвращаются по порядку, так что результат совпадает с последовательным просмотром.
+        """
+        step = -(-len(ids) // (workers * self.CHUNKS_PER_WORKER))
+        # при fork аргументы инициализатора не сериализуются, а достаются процессу
+        # вместе с памятью -- в том числе процессу, который Pool перезапустит
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=_init_scan,
+                                                        initargs=(self, ids, step, project))
+        try:
+            for chunk in pool.imap(_scan_chunk, range(0, len(ids), step)):
+                yield from chunk
+        finally:
+            # если результат дочитали не до конца (limit), оставшиеся куски не нужны
+            pool.terminate()
+            pool.join()
+
+    def rows(self) -> Iterable[dict]:
+        """ Записи, прошедшие фильтр """
+        meta_data = self.table.meta_data
+        for _id in self.ids():
+            yield meta_data[_id]
+
+    def __str__(self):
+        if self.candidates is None:
+            return "<QueryPlan:{}> full scan".format(self.table.name)
+        return "<QueryPlan:{}> indexes: {}; candidates: {}".format(
+            self.table.name, ", ".join(self.used_indexes), len(self.candidates)
+        )
+
+
+class QueryProfiler:
+    """
+    Профиль запросов к таблицам БД, включается через MemNRDB.profile().
+
+    Запросы различаются по тексту фильтра (str(query)) и таблице; для каждого копится:
+      calls -- выполнений (all, limit, count, agg), rows -- выданных записей (или групп),
+      seconds, max_seconds -- время внутри запроса (время обработки выданных записей
+        вызывающим кодом не входит),
+      plans -- составленных планов, из них full_scans -- с полным просмотром таблицы,
+      index_hits -- поле -> сколько планов использовали индекс по нему,
+      candidates -- id-кандидатов из индексов, scanned -- записей, проверенных фильтром
+        (проверки в дочерних процессах параллельного просмотра не видны),
+      cache_hits -- ответов из кеша запросов.
+    Запросы с большим scanned и full_scans -- первые кандидаты на индекс.
+
+    >>> db = MemNRDB()
+    >>> users = db.init_table("users", indexes=["sex"])
+    >>> rows = users.insert_many([{"sex": i % 2, "graduation": 2010 + i % 5} for i in range(10)])
+    >>> profiler = db.profile()
+    >>> U = Query("users")
+    >>> len(list(db.query((U.sex == 1) & (U.graduation > 2012)).all()))
+    2
+    >>> db.query(U.graduation > 2012).count()
+    4
+    >>> for record in sorted(profiler.report(), key=lambda r: r["query"]):
+    ...     print(record["query"], record["index_hits"], record["full_scans"], record["scanned"])
+    (users.sex == 1) & (users.graduation > 2012) {'sex': 1} 0 5
+    users.graduation > 2012 {} 1 10
+    >>> text = profiler.to_json()
+    """
+    def __init__(self):
+        self.records = {}  # type: Dict[tuple, dict]  # (таблица, текст запроса) -> счётчики
+
+    def _record(self, query: Query, table: Table) -> dict:
+        text = str(query)
+        record = self.records.get((table.name, text))
+        if record is None:
+            record = self.records[(table.name, text)] = {
+                "table": table.name,
+                "query": text,
+                "calls": 0,
+                "rows": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "plans": 0,
+                "full_scans": 0,
+                "index_hits": {},
+                "candidates": 0,
+                "scanned": 0,
+                "cache_hits": 0,
+            }
+        return record
+
+    def _add_call(self, query: Query, table: Table, seconds: float, rows: int):
+        record = self._record(query, table)
+        record["calls"] += 1
+        record["rows"] += rows
+        record["seconds"] += seconds
+        record["max_seconds"] = max(record["max_seconds"], seconds)
+
+    def _timed(self, query: Query, table: Table, items: Iterable[object]) -> Iterable[object]:
+        """ Выдать items, считая время их получения и их число """
+        items = iter(items)
+        seconds = 0.0
+        rows = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                rows += 1
+                yield item
+        finally:
+            # и если запрос дочитали не до конца (limit)
+            self._add_call(query, table, seconds, rows)
+
+    def _planned(self, plan: 'QueryPlan'):
+        """ Учесть план и вернуть его проверку, считающую проверенные записи """
+        record = self._record(plan.query, plan.table)
+        record["plans"] += 1
+        if plan.candidates is None:
+            record["full_scans"] += 1
+        else:
+            record["candidates"] += len(plan.candidates)
+        hits = record["index_hits"]
+        for field in plan.used_indexes:
+            hits[field] = hits.get(field, 0) + 1
+        check = plan.check
+
+        def counted(row: dict) -> bool:
+            record["scanned"] += 1
+            return check(row)
+        return counted
+
+    def report(self, sort_by: str="seconds") -> List[dict]:
+        """
+        Записи профиля, по убыванию счётчика sort_by
+        :param sort_by: счётчик (seconds, scanned, calls, ...)
+        """
+        return sorted((dict(record, index_hits=dict(record["index_hits"])) for record in self.records.values()),
+                      key=lambda record: record[sort_by], reverse=True)
+
+    def to_json(self, pretty: bool=False) -> str:
+        """ Профиль в JSON: {"queries": report()} """
+        kwargs = {"ensure_ascii": False}
+        if pretty:
+            kwargs["indent"] = 4
+        return json.dumps({"queries": self.report()}, **kwargs)
+
+    def dump(self, file_name: str, pretty: bool=False):
+        """ Записать профиль в файл в JSON """
+        with open(file_name, "wt") as f:
+            f.write(self.to_json(pretty))
+
+    def clear(self):
+        self.records.clear()
+
+
+# План, id, размер куска и проекция -- только в процессе параллельного просмотра (см. _init_scan)
+_scan_state = None  # type: tuple
+
+
+def _init_scan(plan: 'QueryPlan', ids: List[int], step: int, project):
+    """ Инициализатор процесса параллельного просмотра: запомнить, что он просматривает """
+    global _scan_state
+    _scan_state = (plan, ids, step, project)
+
+
+def _scan_chunk(start: int) -> List[object]:
+    """ Проверить кусок записей, начинающийся с позиции start (в дочернем процессе) """
+    plan, ids, step, project = _scan_state
+    check = plan.check
+    peek = plan.table._peek
+    if project is None:
+        return [_id for _id in ids[start:start + step] if check(peek(_id))]
+    result = []
+    for _id in ids[start:start + step]:
+        row = peek(_id)
+        if check(row):
+            result.append(project(_id, row))
+    return result
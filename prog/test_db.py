@@ -1,6 +1,16 @@
+import copy
+import json
+import os
+import pickle
+import shutil
+import threading
 import unittest
+from array import array
 
-from prog.mem_nr_db import Query, QueryLogic, MemNRDB, Table, DBException, Row, DBTypeError
+from prog import bench_db
+from prog.mem_nr_db import Query, QueryLogic, MemNRDB, Table, DBException, Row, DBTypeError, DBIndexError, \
+    HashIndex, SortedIndex, QueryPlan, MappedRows, ColumnarRows, CompactRow, ShardedMemNRDB, \
+    db_json_hook, _open_codec
 
 
 class TestDB(unittest.TestCase):
@@ -308,6 +318,1308 @@ class TestDB(unittest.TestCase):
 
         self.assertEqual(r3.test, 333)
 
+    def test_hash_index(self):
+        db = MemNRDB()
+        t = db.init_table("users", indexes=['university'])
+        self.assertIsInstance(t.indexes['university'], HashIndex)
+
+        t.insert({"id": 1, "university": 671})
+        t.insert({"id": 2, "university": "671"})
+        t.insert({"id": 3, "university": 1})
+        t.insert({"id": 4})
+        t.insert({"id": 5, "university": [671]})
+        self.assertEqual(set(t.indexes['university'].lookup(671)), {1, 2})
+
+        t.update({"id": 3, "university": 671})
+        t.update({"id": 1, "university": None})
+        t.ins_upd({"id": 4, "university": 671.0})
+        t.ins_upd({"id": 6, "university": 671})
+        self.assertEqual(set(t.indexes['university'].lookup(671)), {2, 3, 4, 6})
+
+        # индекс строится и для уже существующих записей
+        t.create_index('faculty')
+        t.update({"id": 3, "faculty": 5})
+        self.assertEqual(set(t.indexes['faculty'].lookup(5)), {3})
+
+        q = Query("users").university == 671
+        self.assertIsNotNone(db.query(q)._candidates(t))
+        data = sorted(r['id'] for r in db.query(q).all())
+        self.assertEqual(data, [2, 3, 4, 6])
+        self.assertEqual(data, sorted(r['id'] for r in t.rows() if q._check(r)))
+
+        with self.assertRaises(DBException):
+            t.drop_index('sex')
+        t.drop_index('faculty')
+        self.assertNotIn('faculty', t.indexes)
+
+        db.serialize("test_file.json")
+        new_db = MemNRDB.load("test_file.json")
+        self.assertEqual(set(new_db['users'].indexes['university'].lookup(671)), {2, 3, 4, 6})
+
+    def test_sorted_index(self):
+        db = MemNRDB()
+        t = db.init_table("users", indexes={'graduation': 'sorted'})
+        self.assertIsInstance(t.indexes['graduation'], SortedIndex)
+        with self.assertRaises(DBException):
+            t.create_index('graduation', kind='hash')
+        with self.assertRaises(DBException):
+            t.create_index('sex', kind='btree')
+
+        years = [2010, 2015, 2016, 2015.5, "2015", 0, None, [2015], float('nan')]
+        for i in range(300):
+            row = {"id": i + 1, "n": i}
+            year = years[i % len(years)]
+            if year is not None:
+                row["graduation"] = year
+            t.insert(row)
+        t.update({"id": 1, "graduation": 2020})
+        t.update({"id": 2, "graduation": None})
+
+        G = Query("users").graduation
+        for q in [G >= 2015, G > 2015, G < 2015, G <= 2015.5, G == 2016, G >= "2015", G < 0,
+                  G.exist()]:
+            expected = sorted(r['id'] for r in t.rows() if q._check(r))
+            self.assertEqual(sorted(r['id'] for r in db.query(q).all()), expected)
+
+        self.assertIsNotNone((G >= 2015)._candidates(t))
+        self.assertIsNone(G.exist()._candidates(t))
+
+        index = t.indexes['graduation']
+        ordered = [t.get(_id)['graduation'] for _id in index.ids()]
+        numbers = [v for v in ordered if not isinstance(v, str)]
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertTrue(all(isinstance(v, str) for v in ordered[len(numbers):]))
+        self.assertEqual(list(index.ids(reverse=True)), list(reversed(list(index.ids()))))
+        self.assertEqual(len(index.range(2015, 2016, hi_inclusive=False)),
+                         len([v for v in numbers if 2015 <= v < 2016]))
+        with self.assertRaises(DBException):
+            index.range(2015, "2016")
+
+    def test_query_plan(self):
+        db = MemNRDB()
+        t = db.init_table("users", indexes={'university': 'hash', 'graduation': 'sorted'})
+        for i in range(1, 501):
+            t.insert({"id": i, "university": [671, 1, 2][i % 3], "graduation": 2000 + i % 25,
+                      "sex": i % 2, "faculty": i % 7})
+
+        U = Query("users")
+        queries = [
+            (U.university == 671) & (U.graduation >= 2015) & (U.graduation < 2020) & (U.sex == 1),
+            ((U.university == 671) | (U.university == 1)) & (U.faculty == 3),
+            (U.university == 671) | (U.sex == 1),
+            (U.graduation > 2010) & (U.graduation <= 2010),
+            ((U.sex == 1) & (U.faculty > 2)) | ((U.graduation == 2003) & (U.university == 2)),
+        ]
+        for q in queries:
+            plan = q.plan(t)
+            self.assertIsInstance(plan, QueryPlan)
+            expected = sorted(r['id'] for r in t.rows() if q._check(r))
+            self.assertEqual(sorted(plan.ids()), expected)
+            self.assertEqual(sorted(r['id'] for r in db.query(q).all()), expected)
+
+        plan = queries[0].plan(t)
+        self.assertEqual(set(plan.used_indexes), {'university', 'graduation'})
+        self.assertLessEqual(len(plan.candidates), 500 // 3 // 5 + 1)
+        self.assertIsNotNone(queries[1].plan(t).candidates)
+        self.assertIsNone(queries[2].plan(t).candidates)
+        self.assertEqual(len(queries[3].plan(t).candidates), 0)
+
+        # короткое замыкание: второй операнд не вычисляется
+        calls = []
+
+        class Spy(Query):
+            def _check(self, row):
+                calls.append(row['id'])
+                return True
+
+        q = (U.sex == 5) & Spy("users")
+        self.assertEqual(list(q.plan(t).ids()), [])
+        self.assertEqual(calls, [])
+        self.assertFalse(q._check({"sex": 1}))
+        self.assertEqual(calls, [])
+
+        # глубокие цепочки не упираются в рекурсию
+        q = U.sex == 1
+        for i in range(1500):
+            q = q | (U.faculty == i + 100)
+        self.assertEqual(len(list(q.plan(t).ids())), 250)
+
+    def test_journal(self):
+        file_name = "test_journal.json"
+        journal_name = file_name + MemNRDB.JOURNAL_SUFFIX
+        self.addCleanup(lambda: [os.remove(name) for name in (file_name, journal_name)
+                                 if os.path.exists(name)])
+
+        db = MemNRDB()
+        t = db.init_table("users", convert_exclude=['bdate'], indexes=['university'])
+        for i in range(1, 101):
+            t.insert({"id": i, "university": 671, "bdate": "1.1"})
+        db.serialize(file_name, journal=True)  # снимка ещё нет -- пишется полный
+        self.assertFalse(os.path.exists(journal_name))
+        snapshot_size = os.path.getsize(file_name)
+
+        t.update({"id": 5, "university": 1})
+        t.insert({"id": 101, "university": 1})
+        db.init_table("posts").insert({"text": "привет"})
+        t.get(7)['bdate'] = "2.2"
+        t.touch(7)
+        db.serialize(file_name, journal=True)
+        self.assertEqual(os.path.getsize(file_name), snapshot_size)
+        with open(journal_name) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        # без изменений журнал не растёт
+        db.serialize(file_name, journal=True)
+        with open(journal_name) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        # оборванная последняя строка игнорируется
+        with open(journal_name, "at") as f:
+            f.write('{"table": "users", "ro')
+
+        new_db = MemNRDB.load(file_name)
+        nt = new_db['users']
+        self.assertEqual(len(nt), 101)
+        self.assertEqual(nt.get(5)['university'], 1)
+        self.assertEqual(nt.get(7)['bdate'], "2.2")
+        self.assertEqual(set(nt.indexes['university'].lookup(1)), {5, 101})
+        self.assertEqual(new_db['posts'].get(1)['text'], "привет")
+        with open(journal_name) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+        # сжатие журнала в снимок
+        new_db.compact(file_name, background=False)
+        self.assertFalse(os.path.exists(journal_name))
+        nt.update({"id": 6, "university": 2})
+        new_db.serialize(file_name, journal=True)
+        process = new_db.compact(file_name)
+        self.assertIsNotNone(process)
+        new_db.wait_compaction()
+        self.assertFalse(os.path.exists(journal_name + MemNRDB.COMPACTING_SUFFIX))
+
+        loaded = MemNRDB.load(file_name)
+        self.assertEqual(loaded['users'].get(5)['university'], 1)
+        self.assertEqual(loaded['users'].get(6)['university'], 2)
+        self.assertEqual(len(loaded['posts']), 1)
+
+    def test_binary_snapshot(self):
+        file_name = "test_binary.mnrdb"
+        self.addCleanup(lambda: [os.remove(name) for name in (file_name, file_name + MemNRDB.JOURNAL_SUFFIX)
+                                 if os.path.exists(name)])
+
+        db = MemNRDB()
+        t = db.init_table("users", convert_exclude=['bdate'], indexes={'university': 'hash'})
+        for i in range(1, 201):
+            t.insert({"id": i * 3, "university": [671, 1][i % 2], "first_name": "Имя{}".format(i),
+                      "cost": {"group_nsu24": 0.8}, "universities": [i], 12: (1, 2)})
+        db.init_table("empty", convert=False)
+        t.insert({"bdate": "1.1"})
+        db.serialize(file_name)
+        self.assertEqual(MemNRDB._detect_format(file_name), "binary")
+
+        new_db = MemNRDB.load(file_name)
+        nt = new_db['users']
+        self.assertIsInstance(nt.meta_data, MappedRows)
+        self.assertEqual(nt.meta_data.decoded, 0)
+        self.assertEqual(len(nt), 201)
+        self.assertEqual(new_db['empty'].convert, False)
+        self.assertEqual(nt.convert_exclude, ['bdate'])
+
+        row = nt.get(30)
+        # кортежи, как и в JSON, становятся списками
+        self.assertEqual(row, {**t.get(30), 12: [1, 2]})
+        self.assertEqual(row[12], [1, 2])
+        self.assertEqual(nt.meta_data.decoded, 1)
+        self.assertIn(1, nt.meta_data)
+        self.assertNotIn(2, nt.meta_data)
+        with self.assertRaises(DBException):
+            nt.get(2)
+
+        # полный просмотр не оставляет в памяти неподходящие записи
+        q = (Query("users").university == 1) & (Query("users").first_name == "Имя7")
+        self.assertEqual([r['id'] for r in new_db.query(q).all()], [21])
+        self.assertEqual(nt.meta_data.decoded, 2)
+        self.assertEqual(len(list(new_db.query(Query("users").university == 671).all())), 100)
+
+        nt.update({"id": 30, "university": 5})
+        self.assertEqual(nt.get(30)['university'], 5)
+        new_row = nt.insert({"first_name": "Новый"})
+        self.assertEqual(new_row['id'], 2)
+        self.assertEqual(list(nt.meta_data)[-1], 2)
+        self.assertEqual(len(nt), 202)
+
+        new_db.serialize(file_name, journal=True)
+        self.assertTrue(os.path.exists(file_name + MemNRDB.JOURNAL_SUFFIX))
+        loaded = MemNRDB.load(file_name)
+        self.assertEqual(loaded['users'].get(30)['university'], 5)
+        self.assertEqual(loaded['users'].get(2)['first_name'], "Новый")
+
+        loaded.serialize(file_name)
+        loaded = MemNRDB.load(file_name)
+        self.assertEqual(len(loaded['users']), 202)
+        self.assertEqual(sorted(r['id'] for r in loaded['users'].rows()),
+                         sorted(r['id'] for r in nt.rows()))
+        self.assertEqual(loaded['users'].get(2)['first_name'], "Новый")
+
+        # json <-> binary
+        loaded.serialize("test_file.json")
+        self.assertEqual(len(MemNRDB.load("test_file.json")['users']), 202)
+        with self.assertRaises(DBException):
+            loaded.serialize(file_name, fmt="xml")
+
+        # запись, ссылающаяся на функцию, не распаковывается: открытие снимка не выполняет код
+        class Payload:
+            def __reduce__(self):
+                return os.getcwd, ()
+        blob = pickle.dumps({"id": 1, "name": Payload()}, pickle.HIGHEST_PROTOCOL)
+        rows = MappedRows(memoryview(blob), array('q', [1]), array('q', [0, len(blob)]))
+        with self.assertRaises(DBException):
+            rows[1]
+        # и записать в бинарный снимок можно только данные
+        loaded['users'].update({"id": 2, "payload": Payload()})
+        self.addCleanup(lambda: os.path.exists("test_bad.mnrdb") and os.remove("test_bad.mnrdb"))
+        with self.assertRaises(DBException):
+            loaded.serialize("test_bad.mnrdb")
+
+    def test_lazy_tables(self):
+        db = MemNRDB()
+        db.init_table("users", indexes=['university']).insert({"id": 1, "university": 671})
+        db.init_table("posts").insert({"text": "пост"})
+        db.init_table("empty")
+
+        for file_name in ("test_file.json", "test_lazy.mnrdb"):
+            self.addCleanup(lambda name=file_name: [os.remove(n) for n in (name, name + MemNRDB.JOURNAL_SUFFIX)
+                                                    if os.path.exists(n)])
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)
+            self.assertEqual(loaded.tables, {})
+            self.assertEqual(sorted(loaded.table_names()), ["empty", "posts", "users"])
+            self.assertIn("posts", loaded)
+            self.assertNotIn("comments", loaded)
+            self.assertEqual(str(loaded), "<MemNRDB>, 3 tables")
+
+            users = loaded['users']
+            self.assertEqual(list(loaded.tables), ["users"])
+            self.assertEqual(len(users._dirty), 0)
+            self.assertIs(loaded.init_table("users"), users)
+            self.assertEqual(set(users.indexes['university'].lookup(671)), {1})
+
+            # журнал для незагруженной таблицы применяется при её загрузке
+            posts = loaded['posts']
+            posts.insert({"text": "ещё"})
+            loaded.serialize(file_name, journal=True)
+            reloaded = MemNRDB.load(file_name)
+            self.assertEqual(list(reloaded.tables), [])
+            self.assertEqual(len(reloaded['posts']), 2)
+            self.assertEqual(len(reloaded['posts']._dirty), 0)
+            self.assertNotIn("posts", reloaded._pending)
+
+            with self.assertRaises(DBException):
+                reloaded['comments']
+
+            reloaded.serialize(file_name)
+            self.assertEqual(len(MemNRDB.load(file_name)['empty']), 0)
+
+    def test_json_sections(self):
+        db = MemNRDB()
+        db.init_table("users").insert({"id": 1, "name": "Иван"})
+        db.init_table('посты "x"').insert({"text": "пост\nвторая строка"})
+        db.init_table("empty")
+
+        for file_name in ("test_sections.json", "test_sections.json.gz"):
+            self.addCleanup(lambda name=file_name: os.path.exists(name) and os.remove(name))
+            db.serialize(file_name)
+            codec = MemNRDB._detect_codec(file_name)
+            with _open_codec(file_name, "rt", codec) as f:
+                text = f.read()
+            # снимок -- обычный JSON-документ, по строке на таблицу
+            self.assertIsInstance(json.loads(text, object_hook=db_json_hook), MemNRDB)
+            self.assertEqual(len(text.splitlines()), 5)
+
+            # таблица, к которой не обращались, не разбирается ни при загрузке, ни при записи
+            with _open_codec(file_name, "wt", codec) as f:
+                f.write(text.replace('"пост\\nвторая строка"', '"пост'))
+            loaded = MemNRDB.load(file_name)
+            self.assertEqual(loaded['users'].get(1)['name'], "Иван")
+            self.assertEqual(len(loaded['empty']), 0)
+            loaded.serialize(file_name)
+            loaded = MemNRDB.load(file_name)
+            self.assertEqual(loaded['users'].get(1)['name'], "Иван")
+            with self.assertRaises(ValueError):
+                loaded['посты "x"']
+
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)
+            self.assertEqual(loaded['посты "x"'].get(1)['text'], "пост\nвторая строка")
+            loaded['users'].insert({"id": 2})
+            loaded.serialize(file_name)
+            self.assertEqual(len(MemNRDB.load(file_name)['users']), 2)
+            self.assertEqual(len(MemNRDB.load(file_name)['посты "x"']), 1)
+
+            # снимок с отступами и однострочный JSON разбираются целиком
+            for pretty in (True, False):
+                db.serialize(file_name, pretty=pretty)
+                if not pretty:
+                    with _open_codec(file_name, "wt", codec) as f:
+                        f.write(json.dumps(json.loads(text)))
+                loaded = MemNRDB.load(file_name)
+                self.assertEqual(sorted(loaded.table_names()), ["empty", "users", 'посты "x"'])
+                self.assertEqual(loaded['посты "x"'].get(1)['text'], "пост\nвторая строка")
+
+    def test_bulk(self):
+        t = Table("users", convert_exclude=['bdate'], indexes={'university': 'hash', 'graduation': 'sorted'})
+        t.insert({"id": 2})
+        rows = t.insert_many([{"university": "671", "bdate": "1.2", "name": "Иван", "graduation": "2015"},
+                              {"id": 1, "score": "1.5", "name": " 7"},
+                              {"university": 671, "name": "-"}])
+        self.assertEqual([r['id'] for r in rows], [3, 1, 4])
+        self.assertEqual(t.get(3)['university'], 671)
+        self.assertEqual(t.get(3)['bdate'], "1.2")
+        self.assertEqual(t.get(3)['name'], "Иван")
+        self.assertEqual(t.get(3)['graduation'], 2015)
+        self.assertEqual(t.get(1)['score'], 1.5)
+        self.assertEqual(t.get(1)['name'], 7)
+        self.assertEqual(t.get(4)['name'], "-")
+        self.assertEqual(set(t.indexes['university'].lookup(671)), {3, 4})
+
+        # при ошибке в пачке таблица не меняется
+        for bad in ([{"id": 10}, {"id": 10}], [{"id": 11}, {"id": 2}], [{"id": 12}, []], [{"id": "x"}]):
+            with self.assertRaises(DBException):
+                t.insert_many(bad)
+        self.assertEqual(len(t), 4)
+
+        rows = t.upsert_many([{"id": 3, "university": None, "graduation": "2016"},
+                              {"id": 20, "university": "671"},
+                              {"university": 1},
+                              {"id": 20, "sex": 1}])
+        self.assertEqual([r['id'] for r in rows], [3, 20, 5, 20])
+        self.assertNotIn('university', t.get(3))
+        self.assertEqual(t.get(20), {"id": 20, "university": 671, "sex": 1})
+        self.assertEqual(set(t.indexes['university'].lookup(671)), {4, 20})
+        self.assertEqual(t.indexes['graduation'].range(2016, 2016), [3])
+
+        t.get(4)['x'] = 1
+        self.assertIs(t.ins_upd({"id": 4, "y": "2"}), t.get(4))
+        self.assertEqual(t.get(4)['y'], 2)
+        with self.assertRaises(DBTypeError):
+            t.upsert_many([[]])
+
+    def test_columnar(self):
+        db = MemNRDB()
+        t = db.init_table("users", columns={'sex': 'b', 'university': 'q', 'score': 'd'},
+                          indexes={'graduation': 'sorted'})
+        self.assertIsInstance(t.meta_data, ColumnarRows)
+        with self.assertRaises(DBException):
+            Table("bad", columns={'sex': 'x'})
+        with self.assertRaises(DBException):
+            Table("bad", columns={'id': 'q'})
+
+        row = t.insert({"sex": "1", "university": 671, "score": 1.5, "first_name": "Иван", "graduation": 2015})
+        self.assertEqual(row['id'], 1)
+        self.assertEqual(dict(row), {"id": 1, "sex": 1, "university": 671, "score": 1.5,
+                                     "first_name": "Иван", "graduation": 2015})
+        t.insert({"id": 2, "sex": True, "university": 2 ** 70, "score": 3})
+        t.insert({"id": 3, "university": "НГУ", "sex": 0})
+        t.insert_many([{"sex": i % 2, "university": 671 + i % 3} for i in range(30)])
+
+        r2 = t.get(2)
+        self.assertIs(r2['sex'], True)
+        self.assertEqual(r2['university'], 2 ** 70)
+        self.assertEqual(type(r2['score']), int)
+        self.assertNotIn('graduation', r2)
+        self.assertIsNone(t.get(2, to_class=True).graduation)
+
+        # изменение через update и напрямую
+        t.update({"id": 2, "sex": 1, "university": None, "city": "Новосибирск"})
+        self.assertEqual(dict(t.get(2)), {"id": 2, "sex": 1, "score": 3, "city": "Новосибирск"})
+        row['university'] = 1
+        self.assertEqual(t.get(1)['university'], 1)
+        del row['score']
+        self.assertNotIn('score', t.get(1))
+        with self.assertRaises(DBException):
+            t.get(1)["id"] = 5
+
+        U = Query("users")
+        for q in [U.university == 671, U.sex == 1, (U.sex == 1) & (U.university >= 672), U.university == "НГУ",
+                  U.sex == True, U.score < 2.0, (U.graduation > 2000) | (U.sex != 0)]:
+            expected = sorted(r['id'] for r in t.rows() if q._check(r))
+            self.assertEqual(sorted(r['id'] for r in db.query(q).all()), expected)
+        self.assertIsNotNone((U.university == 671)._candidates(t))
+        self.assertIsNone((U.university == 671.0)._candidates(t))
+
+        for file_name in ("test_file.json", "test_columnar.mnrdb"):
+            self.addCleanup(lambda name=file_name: os.path.exists(name) and os.remove(name))
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)['users']
+            self.assertIsInstance(loaded.meta_data, ColumnarRows)
+            self.assertEqual(loaded.columns, t.columns)
+            self.assertEqual([dict(r) for r in loaded.rows()], [dict(r) for r in t.rows()])
+
+    def test_compact(self):
+        db = MemNRDB()
+        t = db.init_table("users", compact=True, indexes=['university'])
+        with self.assertRaises(DBException):
+            Table("bad", compact=True, columns={'sex': 'b'})
+
+        t.insert_many([{"sex": i % 2, "university": 671, "first_name": "Имя", "cost": {"g": 0.8}}
+                       for i in range(20)])
+        row = t.insert({"id": 100, "sex": "1", "groups": [1, 2]})
+        self.assertIsInstance(row, CompactRow)
+        self.assertIs(t.get(100), row)
+        self.assertEqual(dict(row), {"id": 100, "sex": 1, "groups": [1, 2]})
+        self.assertEqual(len({id(r._shape) for r in t.rows()}), 2)
+
+        t.update({"id": 1, "university": None, "city": 1})
+        r1 = t.get(1)
+        self.assertEqual(dict(r1), {"id": 1, "sex": 0, "first_name": "Имя", "cost": {"g": 0.8}, "city": 1})
+        self.assertIs(t.get(2)._shape, t.get(3)._shape)
+        self.assertEqual(r1.get("university", 5), 5)
+        with self.assertRaises(KeyError):
+            r1["university"]
+        t.get(2, to_class=True).city = 1
+        t.update({"id": 2, "university": None})
+        self.assertIs(t.get(1)._shape, t.get(2)._shape)
+
+        U = Query("users")
+        q = (U.university == 671) & (U.sex == 0) & (U.cost["g"] > 0.5)
+        self.assertEqual(sorted(r['id'] for r in db.query(q).all()),
+                         sorted(r['id'] for r in t.rows() if q._check(r)))
+
+        for file_name in ("test_file.json", "test_compact.mnrdb"):
+            self.addCleanup(lambda name=file_name: os.path.exists(name) and os.remove(name))
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)['users']
+            self.assertTrue(loaded.compact)
+            self.assertTrue(all(isinstance(r, CompactRow) for r in loaded.rows()))
+            self.assertEqual([dict(r) for r in loaded.rows()], [dict(r) for r in t.rows()])
+
+    def test_intern(self):
+        db = MemNRDB()
+        t = db.init_table("users", intern=['university_name', 'cost'], indexes=['sex'])
+        names = ["НГУ", "НГТУ", "СибГУТИ"]
+        t.insert_many([{"sex": i % 2, "university_name": "".join(names[i % 3]), "first_name": "Имя",
+                        "cost": {"groups": i}} for i in range(30)])
+        rows = list(t.rows())
+        self.assertIs(rows[0]["university_name"], rows[3]["university_name"])
+        self.assertIs(next(iter(rows[0]["cost"])), next(iter(rows[1]["cost"])))
+        self.assertEqual(t.interned("НГУ"), "НГУ")
+        self.assertIsNone(t.interned("МГУ"))
+
+        t.update({"id": 1, "university_name": "".join(["МГ", "У"])})
+        self.assertIs(t.get(1)["university_name"], t.interned("МГУ"))
+
+        U = Query("users")
+        for q in (U.university_name == "НГУ", (U.university_name == "МГУ") | (U.sex == 1),
+                  (U.university_name == "ТГУ") & (U.sex == 0), U.university_name != "НГУ"):
+            self.assertEqual(sorted(r['id'] for r in db.query(q).all()),
+                             sorted(r['id'] for r in t.rows() if q._check(r)))
+        self.assertEqual(len((U.university_name == "ТГУ").plan(t).candidates), 0)
+
+        for file_name in ("test_file.json", "test_intern.mnrdb"):
+            self.addCleanup(lambda name=file_name: os.path.exists(name) and os.remove(name))
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)['users']
+            self.assertEqual(loaded.intern, t.intern)
+            self.assertEqual([dict(r) for r in loaded.rows()], [dict(r) for r in t.rows()])
+            a, b = loaded.get(2), loaded.get(5)
+            self.assertIs(a["university_name"], b["university_name"])
+            self.assertIs(a["university_name"], loaded.interned("НГТУ"))
+            self.assertEqual(sorted(r['id'] for r in (U.university_name == "СибГУТИ").plan(loaded).rows()),
+                             [3, 6, 9, 12, 15, 18, 21, 24, 27, 30])
+
+        # снимок без пула строк: параметры init_table к загруженной таблице не применяются,
+        # пул включается через intern_fields
+        db = MemNRDB()
+        db.init_table("users", indexes=['university_name']).insert_many(
+            [{"university_name": "".join(names[i % 3])} for i in range(30)])
+        for file_name in ("test_file.json", "test_intern.mnrdb"):
+            db.serialize(file_name)
+            loaded_db = MemNRDB.load(file_name)
+            loaded = loaded_db.init_table("users", intern=['university_name'])
+            self.assertEqual(loaded.intern, [])
+            self.assertIs(loaded.intern_fields(['university_name']), loaded)
+            self.assertEqual(loaded.intern, ['university_name'])
+            self.assertIs(loaded.get(1)["university_name"], loaded.get(4)["university_name"])
+            self.assertIs(loaded.get(1)["university_name"], loaded.interned("НГУ"))
+            self.assertEqual(loaded_db.query(U.university_name == "НГТУ").count(), 10)
+            loaded_db.serialize(file_name)
+            self.assertEqual(MemNRDB.load(file_name)["users"].intern, ['university_name'])
+
+    def test_query_cache(self):
+        db = MemNRDB()
+        t = db.init_table("users", indexes=['university'])
+        t.insert_many([{"sex": i % 2, "university": 671 if i % 3 else 1, "cost": {"g": i}} for i in range(30)])
+        U = Query("users")
+        q = (U.university == 671) & U.cost.exist()
+
+        first = [r['id'] for r in db.query(q).all()]
+        self.assertEqual(len(db._query_cache), 1)
+        # тот же запрос с другим порядком операндов берётся из кеша
+        self.assertEqual((U.cost.exist() & (U.university == 671))._cache_key(), q._cache_key())
+        self.assertNotEqual((U.university == 671.0)._cache_key(), (U.university == 671)._cache_key())
+        self.assertEqual([r['id'] for r in db.query(U.cost.exist() & (U.university == 671)).all()], first)
+        self.assertEqual(len(db._query_cache), 1)
+
+        # изменение таблицы делает кеш неактуальным
+        t.insert({"university": 671, "cost": {}})
+        self.assertEqual([r['id'] for r in db.query(q).all()], first + [31])
+        t.update({"id": 2, "cost": None})
+        self.assertNotIn(2, [r['id'] for r in db.query(q).all()])
+        # изменения через Row тоже
+        self.assertEqual(len(list(db.query(U.sex == 1).all())), 15)
+        t.get(3, to_class=True).sex = 1
+        self.assertEqual(len(list(db.query(U.sex == 1).all())), 16)
+        next(db.query(U.sex == 1).all(to_class=True))["sex"] = 0
+        self.assertEqual(len(list(db.query(U.sex == 1).all())), 15)
+        for row in t.rows(to_class=True):
+            if row.id == 5:
+                row.sex = 1
+        self.assertEqual(len(list(db.query(U.sex == 1).all())), 16)
+        self.assertIn(5, t._dirty)
+
+        # незавершённые запросы не кешируются, некешируемые значения выполняются как обычно
+        db.clear_query_cache()
+        self.assertEqual(len(list(db.query(U.sex == 1).limit(2))), 2)
+        self.assertEqual(len(db._query_cache), 0)
+        self.assertEqual(len(list(db.query(U.cost == {"g": 3}).all())), 1)
+        self.assertEqual(len(db._query_cache), 0)
+
+        db.query_cache_size = 2
+        for sex in range(3):
+            list(db.query(U.sex == sex).all())
+        self.assertEqual([key[1] for key in db._query_cache], [(U.sex == 1)._cache_key(), (U.sex == 2)._cache_key()])
+
+    def test_parallel_scan(self):
+        db = MemNRDB()
+        db.query_cache_size = 0
+        t = db.init_table("users", indexes=['university'])
+        t.insert_many([{"sex": i % 2, "university": i % 5, "graduation": 2000 + i % 20} for i in range(500)])
+        U = Query("users")
+        old_min_rows = QueryPlan.PARALLEL_MIN_ROWS
+        QueryPlan.PARALLEL_MIN_ROWS = 10
+        self.addCleanup(setattr, QueryPlan, "PARALLEL_MIN_ROWS", old_min_rows)
+
+        for q in ((U.graduation >= 2010) & (U.sex == 1), (U.university == 3) | (U.graduation == 2001)):
+            serial = [r['id'] for r in db.query(q).all()]
+            self.assertEqual([r['id'] for r in db.query(q).all(workers=3)], serial)
+            self.assertEqual([r['id'] for r in db.query(q).limit(7, workers=3)], serial[:7])
+
+        # процессы возвращают только id, сами записи берутся из таблицы родителя
+        rows = db.query(U.sex == 0).all(workers=2)
+        first = next(rows)
+        t.update({"id": first['id'], "sex": 1})
+        self.assertEqual(first['sex'], 1)
+        self.assertEqual(len(list(rows)), 249)
+
+        # параллельные просмотры из разных потоков не путают запросы и таблицы
+        db.init_table("posts").insert_many([{"likes": i % 7} for i in range(300)])
+        P = Query("posts")
+        queries = [U.graduation >= 2015, P.likes == 3, U.sex == 1, P.likes > 4]
+        expected = [[r['id'] for r in db.query(q).all()] for q in queries]
+        results = {}
+
+        def scan(n):
+            for _ in range(3):
+                results.setdefault(n, []).append([r['id'] for r in db.query(queries[n]).all(workers=2)])
+
+        threads = [threading.Thread(target=scan, args=(n,)) for n in range(len(queries))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n, ids in enumerate(expected):
+            self.assertEqual(results[n], [ids] * 3)
+
+    def test_aggregation(self):
+        db = MemNRDB()
+        users = db.init_table("users", indexes=['faculty'])
+        plain = db.init_table("plain")
+        columnar = db.init_table("columnar", columns={'faculty': 'q', 'graduation': 'h', 'sex': 'b'})
+        for i in range(60):
+            row = {"sex": i % 2, "faculty": i % 4 or None, "graduation": 2000 + i % 7, "cost": {"g": i / 10}}
+            if 5 == i:
+                row["graduation"] = "давно"
+            for t in (users, plain, columnar):
+                t.insert(dict(row, cost=dict(row["cost"])))
+        users.insert({"faculty": [1, 2]})
+
+        rows = [r for r in users.rows() if r.get("sex") == 1]
+        expected = {}
+        for r in rows:
+            if isinstance(r.get("faculty"), int):
+                expected.setdefault(r["faculty"], []).append(r["cost"]["g"])
+
+        for name in ("users", "plain"):
+            U = Query(name)
+            self.assertEqual(db.query(U.sex == 1).count(), 30)
+            result = db.query(U.sex == 1).group_by("faculty").agg(n="count", cost=("avg", "cost", "g"),
+                                                                  hi=("max", "cost", "g"), s=("sum", "cost", "g"))
+            self.assertEqual(set(result), set(expected))
+            for faculty, costs in expected.items():
+                self.assertEqual(result[faculty]["n"], len(costs))
+                self.assertAlmostEqual(result[faculty]["cost"], sum(costs) / len(costs))
+                self.assertAlmostEqual(result[faculty]["s"], sum(costs))
+                self.assertEqual(result[faculty]["hi"], max(costs))
+            self.assertEqual(db.query(U.sex == 5).agg(n="count", m=("min", "graduation"), s=("sum", "cost", "g")),
+                             {"n": 0, "m": None, "s": 0})
+            with self.assertRaises(DBTypeError):
+                db.query(U).agg(s=("sum", "graduation"))
+            # "давно" не сравнивается с годами
+            with self.assertRaises(DBTypeError):
+                db.query(U.sex == 1).agg(lo=("min", "graduation"))
+            with self.assertRaises(DBTypeError):
+                db.query(U).group_by("faculty").agg(hi=("max", "graduation"))
+            self.assertEqual(db.query(U.sex == 0).agg(lo=("min", "graduation"), hi=("max", "graduation"),
+                                                      n=("count", "graduation")),
+                             {"lo": 2000, "hi": 2006, "n": 30})
+            with self.assertRaises(DBException):
+                db.query(U).agg(s=("median", "graduation"))
+
+        # без фильтра число записей в группах берётся из индекса
+        U = Query("users")
+        self.assertEqual(db.query(U).group_by("faculty").agg(n="count"),
+                         {f: {"n": 15} for f in (1, 2, 3)})
+        self.assertEqual(db.query(U).group_by("faculty").agg(n="count"),
+                         db.query(Query("plain")).group_by("faculty").agg(n="count"))
+
+        # колоночная таблица: поля читаются из колонок, значения вне колонки -- из записи
+        C = Query("columnar")
+        self.assertEqual(db.query(C.sex == 0).group_by("faculty").agg(first=("min", "graduation"), n="count"),
+                         db.query(Query("plain").sex == 0).group_by("faculty").agg(first=("min", "graduation"),
+                                                                                  n="count"))
+        self.assertEqual(db.query(C.graduation < 2003).count(), 27)
+
+        # без группировки агрегаты по колонкам считаются прямо по массивам
+        columnar.insert({"faculty": 1})
+        plain.insert({"faculty": 1})
+        self.assertEqual(columnar.meta_data.column_state("sex"), [60, 30, 0, 1, None, None])
+        self.assertEqual(columnar.meta_data.column_state("sex", [0, 1, 2, 60], order=False),
+                         [3, 1, None, None, None, None])
+        self.assertIsNone(columnar.meta_data.column_state("graduation"))
+        P = Query("plain")
+        aggregates = {"n": "count", "k": ("count", "sex"), "s": ("sum", "sex"), "a": ("avg", "sex"),
+                      "lo": ("min", "sex"), "hi": ("max", "sex"), "f": ("max", "faculty")}
+        for c, p in ((C, P), (C.faculty == 1, P.faculty == 1), (C.sex == 5, P.sex == 5)):
+            self.assertEqual(db.query(c).agg(**aggregates), db.query(p).agg(**aggregates))
+        self.assertEqual(db.query(C).agg(s=("sum", "sex"), lo=("min", "sex"), hi=("max", "sex")),
+                         {"s": 30, "lo": 0, "hi": 1})
+        with self.assertRaises(DBTypeError):
+            db.query(C.sex == 1).agg(s=("sum", "graduation"))
+
+    def test_order_by(self):
+        db = MemNRDB()
+        db.query_cache_size = 0
+        plain = db.init_table("plain", indexes=['university'])
+        indexed = db.init_table("indexed", indexes={'university': 'hash', 'graduation': 'sorted'})
+        for i in range(200):
+            row = {"sex": i % 2, "university": i % 3, "graduation": 2000 + (i * 7) % 13, "cost": {"g": (i * 5) % 11}}
+            if 0 == i % 17:
+                del row["graduation"]
+            elif 0 == i % 23:
+                row["graduation"] = "давно"
+            plain.insert(dict(row))
+            indexed.insert(dict(row))
+
+        def expected(rows, path, desc):
+            def value(row):
+                for p in path:
+                    row = row.get(p) if isinstance(row, dict) else None
+                return row
+            ordered = [r for r in rows if isinstance(value(r), (int, float, str))]
+            ordered.sort(key=lambda r: (isinstance(value(r), str), value(r), r['id']), reverse=desc)
+            return [r['id'] for r in ordered] + [r['id'] for r in rows if r not in ordered]
+
+        for name in ("plain", "indexed"):
+            T = Query(name)
+            for q in (T, T.sex == 1, (T.university == 2) & (T.sex == 0)):
+                rows = [r for r in plain.rows() if q._check(r)]
+                for path in (["graduation"], ["cost", "g"]):
+                    for desc in (False, True):
+                        ordered = q.order_by(*path, desc=desc)
+                        full = expected(rows, path, desc)
+                        self.assertEqual([r['id'] for r in db.query(ordered).all()], full)
+                        for k in (1, 10, len(full) - 3, len(full) + 5):
+                            self.assertEqual([r['id'] for r in db.query(ordered).limit(k)], full[:k])
+
+        # записи без поля идут последними
+        G = Query("indexed")
+        last = list(db.query(G.order_by("graduation")).all())[-12:]
+        self.assertTrue(all("graduation" not in r for r in last))
+        with self.assertRaises(DBException):
+            G.order_by()
+
+    def test_select(self):
+        db = MemNRDB()
+        db.query_cache_size = 0
+        t = db.init_table("users", columns={'sex': 'b'})
+        t.insert_many([{"sex": i % 2, "first_name": "Имя{}".format(i), "cost": {"g": i}} for i in range(40)])
+        U = Query("users")
+        q = (U.sex == 1).select("id", "first_name", ("cost", "g"), ["cost", "nope"])
+        expected = [(r['id'], r['first_name'], r['cost']['g'], None) for r in t.rows() if r['sex'] == 1]
+        self.assertEqual(list(db.query(q).all()), expected)
+        self.assertEqual(list(db.query(q).limit(3)), expected[:3])
+        self.assertEqual(list(db.query(q.order_by("cost", "g", desc=True)).limit(2)), expected[::-1][:2])
+        with self.assertRaises(DBException):
+            list(db.query(q).all(to_class=True))
+
+        old_min_rows = QueryPlan.PARALLEL_MIN_ROWS
+        QueryPlan.PARALLEL_MIN_ROWS = 10
+        self.addCleanup(setattr, QueryPlan, "PARALLEL_MIN_ROWS", old_min_rows)
+        self.assertEqual(list(db.query(q).all(workers=2)), expected)
+
+        # из бинарного снимка записи для проекции читаются без сохранения в памяти
+        self.addCleanup(lambda: os.path.exists("test_select.mnrdb") and os.remove("test_select.mnrdb"))
+        plain = MemNRDB()
+        plain.init_table("users").insert_many(dict(r) for r in t.rows())
+        plain.serialize("test_select.mnrdb")
+        loaded = MemNRDB.load("test_select.mnrdb")
+        self.assertEqual(list(loaded.query(q).all()), expected)
+        self.assertEqual(loaded["users"].meta_data.decoded, 0)
+
+    def test_snapshot(self):
+        for settings in ({}, {"compact": True}, {"columns": {"a": "q", "b": "q"}}):
+            t = Table("users", indexes=['a'], **settings)
+            t.insert_many([{"a": 0, "b": 0} for _ in range(300)])
+            stop = threading.Event()
+
+            def writer():
+                step = 0
+                while not stop.is_set():
+                    step += 1
+                    t.update({"id": step % 300 + 1, "a": step, "b": step})
+                    if 0 == step % 10:
+                        t.ins_upd({"id": 1000 + step, "a": step, "b": step})
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+            try:
+                for _ in range(20):
+                    with t.snapshot() as snapshot:
+                        first = [dict(r) for r in snapshot.rows()]
+                        # ровно состояние на момент снимка: пары не рвутся, повторное чтение совпадает
+                        self.assertTrue(all(r["a"] == r["b"] for r in first))
+                        self.assertEqual(len(first), len(snapshot))
+                        self.assertEqual([dict(r) for r in snapshot.rows()], first)
+                        self.assertEqual(dict(snapshot.get(first[-1]["id"])), first[-1])
+                        self.assertEqual(len(list(snapshot.query(Query("users").a >= 0))), len(first))
+            finally:
+                stop.set()
+                thread.join()
+            self.assertEqual(len(t._snapshots), 0)
+            self.assertTrue(all(r["a"] == r["b"] for r in t.rows()))
+
+        # обычные rows() и полный просмотр запросом тоже переживают вставки из другого потока
+        for settings in ({}, {"compact": True}, {"columns": {"a": "q"}}):
+            db = MemNRDB()
+            t = db.init_table("users", **settings)
+            t.insert_many([{"a": i % 2} for i in range(2000)])
+
+            def inserter():
+                for _id in range(10001, 40001):
+                    t.ins_upd({"id": _id, "a": 1})
+
+            thread = threading.Thread(target=inserter)
+            thread.start()
+            try:
+                while thread.is_alive():
+                    self.assertGreaterEqual(sum(1 for _ in t.rows()), 2000)
+                    self.assertGreaterEqual(len(list(db.query(Query("users").a == 1).all())), 1000)
+            finally:
+                thread.join()
+            self.assertEqual(db.query(Query("users").a == 1).count(), 31000)
+
+    def test_checkpoint_async(self):
+        file_name = "test_checkpoint.json"
+        for suffix in ("", ".journal", ".journal.compacting", ".old"):
+            self.addCleanup(lambda name=file_name + suffix: os.path.exists(name) and os.remove(name))
+        db = MemNRDB()
+        t = db.init_table("users", indexes=['sex'])
+        t.insert_many([{"sex": i % 2} for i in range(100)])
+        db.serialize(file_name, journal=True)
+        t.update({"id": 1, "sex": 5})
+        db.serialize(file_name, journal=True)
+        t.update({"id": 2, "sex": 5})
+
+        checkpoint = db.checkpoint_async(file_name)
+        # пока снимок пишется, БД работает и журнал пишется поверх будущего снимка
+        t.insert({"sex": 7})
+        t.update({"id": 3, "sex": 5})
+        db.serialize(file_name, journal=True)
+        stats = checkpoint.wait()
+        self.assertEqual(stats["rows"], 100)
+        self.assertGreater(stats["bytes"], 0)
+        self.assertGreater(stats["bytes_per_sec"], 0)
+        self.assertFalse(os.path.exists(file_name + ".journal.compacting"))
+        self.assertEqual(db.wait_checkpoint(), stats)
+        self.assertIsNone(db.wait_checkpoint())
+
+        # в снимке -- состояние на момент запуска, остальное -- в журнале
+        self.assertEqual(len(MemNRDB._load_snapshot(file_name)["users"]), 100)
+        loaded = MemNRDB.load(file_name)["users"]
+        self.assertEqual([dict(r) for r in loaded.rows()], [dict(r) for r in t.rows()])
+
+        # падение после записи снимка, но до удаления отложенного журнала: повторное проигрывание безопасно
+        t.update({"id": 4, "sex": 5})
+        db.serialize(file_name, journal=True)
+        os.rename(file_name + ".journal", file_name + ".journal.compacting")
+        db._write_snapshot(file_name)
+        loaded = MemNRDB.load(file_name)["users"]
+        self.assertEqual([dict(r) for r in loaded.rows()], [dict(r) for r in t.rows()])
+
+    def test_sharded(self):
+        file_name = "test_sharded.json"
+        for name in [file_name] + [ShardedMemNRDB._shard_file(file_name, i) for i in range(3)]:
+            for suffix in ("", ".journal"):
+                self.addCleanup(lambda name=name + suffix: os.path.exists(name) and os.remove(name))
+        rows = [{"sex": i % 3, "graduation": 2000 + i % 17, "cost": {"g": i / 10}} for i in range(200)]
+        db = MemNRDB()
+        t = db.init_table("users", indexes={"sex": "hash"})
+        t.insert_many(copy.deepcopy(rows))
+        with ShardedMemNRDB(shards=3) as sdb:
+            st = sdb.init_table("users", indexes={"sex": "hash"})
+            self.assertEqual([r["id"] for r in st.insert_many(copy.deepcopy(rows))], list(range(1, 201)))
+            self.assertEqual(len(st), 200)
+            self.assertEqual(st.get(7), t.get(7))
+            self.assertEqual(st.insert({"id": "500", "sex": 1})["id"], 500)
+            self.assertEqual(st.insert({"sex": 2})["id"], 501)
+            with self.assertRaises(DBException):
+                st.insert_many([{"sex": 1}, {"id": 7}])
+            self.assertEqual(len(st), 202)
+            self.assertEqual(st.update({"id": 500, "sex": None}), {"id": 500})
+            st.upsert_many([{"id": 500, "sex": 1}, {"id": 501, "sex": 1}])
+            self.assertEqual(st.get(501)["sex"], 1)
+            t.insert({"id": 500, "sex": 1})
+            t.insert({"id": 501, "sex": 1})
+
+            U = Query("users")
+            for q in [U, U.sex == 1, (U.sex == 0) | (U.graduation > 2010),
+                      (U.sex == 1).order_by("graduation"), U.order_by("graduation", desc=True)]:
+                self.assertEqual(sorted(r["id"] for r in sdb.query(q).all()), sorted(r["id"] for r in db.query(q).all()))
+                if q._order is not None:
+                    self.assertEqual([r["id"] for r in sdb.query(q).limit(15)], [r["id"] for r in db.query(q).limit(15)])
+                    self.assertEqual(list(sdb.query(q.select("id", ("cost", "g"))).all()),
+                                     list(db.query(q.select("id", ("cost", "g"))).all()))
+                self.assertEqual(sdb.query(q).count(), db.query(q).count())
+            aggregates = dict(n="count", avg=("avg", "cost", "g"), low=("min", "graduation"), total=("sum", "cost", "g"))
+            result, expected = sdb.query(U.sex != 2).agg(**aggregates), db.query(U.sex != 2).agg(**aggregates)
+            self.assertEqual((result["n"], result["low"]), (expected["n"], expected["low"]))
+            # суммы шардов складываются в другом порядке
+            self.assertAlmostEqual(result["avg"], expected["avg"])
+            self.assertAlmostEqual(result["total"], expected["total"])
+            grouped = sdb.query(U).group_by("graduation").agg(**aggregates)
+            expected = db.query(U).group_by("graduation").agg(**aggregates)
+            self.assertEqual(grouped.keys(), expected.keys())
+            for key in expected:
+                self.assertEqual(grouped[key]["n"], expected[key]["n"])
+                self.assertAlmostEqual(grouped[key]["avg"], expected[key]["avg"])
+
+            sdb.serialize(file_name)
+            # каждый шард -- обычная БД
+            shard = MemNRDB.load(ShardedMemNRDB._shard_file(file_name, 0))
+            self.assertTrue(all(0 == r["id"] % 3 for r in shard["users"].rows()))
+            st.update({"id": 1, "sex": 5})
+            sdb.serialize(file_name, journal=True)
+        with ShardedMemNRDB.load(file_name) as sdb:
+            self.assertEqual(sdb.table_names(), ["users"])
+            self.assertEqual(len(sdb["users"]), 202)
+            self.assertEqual(sdb["users"].get(1)["sex"], 5)
+            self.assertEqual(sdb["users"].insert({})["id"], 502)
+
+    def test_stats_profile(self):
+        db = MemNRDB()
+        t = db.init_table("users", indexes={"sex": "hash", "graduation": "sorted"}, intern=["city"])
+        t.insert_many([{"sex": i % 2, "graduation": 2000 + i, "city": "Новосибирск",
+                        "about": "x" * 500, "cost": {"g": 0.5}} for i in range(2000)])
+        stats = t.stats(sample=100)
+        self.assertEqual(stats["rows"], 2000)
+        self.assertEqual(stats["storage"], "dict")
+        self.assertEqual(stats["fields"]["about"]["rows"], 2000)
+        # поле с самыми тяжёлыми значениями -- первое; строки из пула и малые числа ничего не стоят
+        self.assertEqual(next(iter(stats["fields"])), "about")
+        self.assertEqual(stats["fields"]["city"]["bytes"], 0)
+        self.assertEqual(stats["fields"]["sex"]["bytes"], 0)
+        self.assertGreater(stats["fields"]["cost"]["bytes"], 0)
+        self.assertEqual(stats["strings"]["count"], 1)
+        self.assertFalse(stats["indexes"]["sex"]["built"])
+        self.assertEqual(stats["indexes"]["sex"]["bytes"], 0)
+        self.assertEqual(stats["bytes"], stats["row_bytes"] + sum(f["bytes"] for f in stats["fields"].values())
+                         + stats["strings"]["bytes"])
+        columnar = Table("users", columns={"sex": "b", "graduation": "h"})
+        columnar.insert_many([{"sex": i % 2, "graduation": 2000 + i, "name": "a"} for i in range(100)])
+        stats = columnar.stats()
+        self.assertEqual(stats["storage"], "columnar")
+        self.assertEqual(stats["fields"]["graduation"], {"rows": 100, "bytes": 300})
+
+        profiler = db.profile()
+        self.assertIs(db.profile(), profiler)
+        U = Query("users")
+        self.assertEqual(len(list(db.query(U.sex == 1).all())), 1000)
+        self.assertEqual(len(list(db.query(U.sex == 1).all())), 1000)
+        self.assertEqual(len(list(db.query(U.about.exist()).limit(10))), 10)
+        self.assertEqual(db.query((U.graduation >= 3000) & (U.sex == 0)).count(), 500)
+        records = {(r["query"]): r for r in profiler.report()}
+        self.assertEqual(records["users.sex == 1"]["calls"], 2)
+        self.assertEqual(records["users.sex == 1"]["cache_hits"], 1)
+        self.assertEqual(records["users.sex == 1"]["index_hits"], {"sex": 1})
+        self.assertEqual(records["users.sex == 1"]["scanned"], 1000)
+        self.assertEqual(records["users.about exists"]["rows"], 10)
+        self.assertEqual(records["users.about exists"]["full_scans"], 1)
+        self.assertEqual(records["users.about exists"]["scanned"], 10)
+        record = records["(users.graduation >= 3000) & (users.sex == 0)"]
+        self.assertEqual((record["calls"], record["rows"], record["candidates"]), (1, 1, 500))
+        self.assertEqual(json.loads(profiler.to_json())["queries"][0]["query"], profiler.report()[0]["query"])
+        self.assertIs(db.profile(False), profiler)
+        self.assertIsNone(t._profiler)
+        list(db.query(U.sex == 0).all())
+        self.assertNotIn("users.sex == 0", {r["query"] for r in profiler.report()})
+        self.assertEqual(db.stats()["tables"]["users"]["rows"], 2000)
+
+    def test_path_multi_index(self):
+        def make(indexed: bool) -> Table:
+            t = Table("users")
+            if indexed:
+                t.create_index(("cost", "g"), kind="sorted")
+                t.create_index("universities", multi=True)
+                t.create_index(("groups", "ids"), kind="sorted", multi=True)
+            for i in range(300):
+                row = {"cost": {"g": i % 7}, "universities": [i % 5, 671] if i % 3 else [i % 5, i % 5],
+                       "groups": {"ids": list(range(i % 4, i % 4 + 3))}}
+                if i % 10 == 0:
+                    row = {"cost": "нет", "universities": 671}
+                t.insert(row)
+            t.update({"id": 2, "universities": [999]})
+            t.update({"id": 3, "cost": {"g": 100}})
+            return t
+
+        indexed, plain = make(True), make(False)
+        U = Query("users")
+        queries = [
+            U.universities.any() == 671,
+            U.universities.any() == 999,
+            (U.universities.any() == 4) & (U.cost.g >= 3),
+            (U.cost.g >= 2) & (U.cost.g < 5),
+            U.cost.g == 100,
+            (U.groups.ids.any() >= 4) & (U.groups.ids.any() <= 3),
+            U.groups.ids.any() > 4,
+            U.universities == 671,
+        ]
+        for q in queries:
+            self.assertEqual(sorted(r["id"] for r in q.plan(indexed).rows()),
+                             [r["id"] for r in plain.rows() if q._check(r)], str(q))
+        plan = ((U.universities.any() == 4) & (U.cost.g >= 3)).plan(indexed)
+        self.assertEqual(sorted(plan.used_indexes), ["cost.g", "universities[]"])
+        # сравнения на разных элементах списка не склеиваются в один диапазон
+        self.assertEqual(len(list(((U.groups.ids.any() >= 4) & (U.groups.ids.any() <= 3)).plan(indexed).rows())), 135)
+        self.assertIsNone((U.universities == 671).plan(indexed).candidates)
+        self.assertEqual(indexed.indexes["universities"].counts()[671], 179)
+        with self.assertRaises(DBException):
+            indexed.create_index("universities")
+        self.assertEqual(str(U.universities.any() == 671), "users.universities.any() == 671")
+        self.assertIn("universities[]", indexed.stats()["indexes"])
+
+        db = MemNRDB()
+        db.tables["users"] = indexed
+        for file_name in ("test_file.json", "test_file.mnrdb"):
+            self.addCleanup(lambda name=file_name: os.path.exists(name) and os.remove(name))
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)["users"]
+            self.assertEqual(set(loaded.indexes), {("cost", "g"), "universities", ("groups", "ids")})
+            self.assertTrue(loaded.indexes["universities"].multi)
+            self.assertEqual(len(list((U.universities.any() == 671).plan(loaded).rows())), 179)
+
+        # вложенное поле и список изменили на месте до update (как User.load_from -> load_to)
+        t = Table("users")
+        t.create_index(("cost", "g"), kind="sorted")
+        t.create_index("universities", multi=True)
+        t.insert({"cost": {"g": 0.1}, "universities": [1, 2]})
+        self.assertEqual(len(list((U.cost.g == 0.1).plan(t).rows())), 1)
+        cost, universities = t.get(1)["cost"], t.get(1)["universities"]
+        cost["g"] = 0.2
+        universities.append(3)
+        t.update({"id": 1, "cost": cost, "universities": universities})
+        self.assertEqual([r["id"] for r in (U.cost.g == 0.2).plan(t).rows()], [1])
+        self.assertEqual(list((U.cost.g == 0.1).plan(t).rows()), [])
+        self.assertEqual([r["id"] for r in (U.universities.any() == 3).plan(t).rows()], [1])
+        t.update({"id": 1, "cost": {"g": 0.3}, "universities": [3]})
+        self.assertEqual(list((U.cost.g == 0.2).plan(t).rows()), [])
+        self.assertEqual(list((U.universities.any() == 1).plan(t).rows()), [])
+        self.assertEqual([r["id"] for r in (U.cost.g == 0.3).plan(t).rows()], [1])
+
+    def test_jsonl(self):
+        directory = "test_jsonl.jsonl"
+        self.addCleanup(lambda: shutil.rmtree(directory, ignore_errors=True))
+        self.addCleanup(lambda: [os.remove(name) for name in (directory + ".journal", "test_users.jsonl")
+                                 if os.path.exists(name)])
+        db = MemNRDB()
+        users = db.init_table("users", convert_exclude=["bdate"], indexes=["university"],
+                              intern=["university_name"], compact=True)
+        users.insert_many([{"university": i % 7, "university_name": "МГУ" if i % 2 else "СПбГУ",
+                            "bdate": "1.1", "cost": {"group_a": 1}} for i in range(2500)])
+        users.update({"id": 3, "university": None})
+        db.init_table("posts/all").insert({"id": 10, "text": "пост\nс переносом"})
+
+        # таблица выгружается и загружается отдельно, без остальной БД
+        self.assertEqual(users.export_jsonl("test_users.jsonl"), 2500)
+        with open("test_users.jsonl", encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 2501)
+        loaded = Table.load_jsonl("test_users.jsonl")
+        self.assertEqual(loaded.name, "users")
+        self.assertTrue(loaded.compact)
+        self.assertEqual([dict(row) for row in loaded.rows()], [dict(row) for row in users.rows()])
+        self.assertEqual(set(loaded.indexes["university"].lookup(3)), set(users.indexes["university"].lookup(3)))
+        self.assertEqual(loaded.insert({})["id"], 2501)
+        self.assertIs(loaded.get(2)["university_name"], loaded.interned("МГУ"))
+
+        db.serialize(directory)
+        self.assertEqual(sorted(os.listdir(directory)), ["__MemNRDB__.json", "posts%2Fall.jsonl", "users.jsonl"])
+        reloaded = MemNRDB.load(directory)
+        self.assertEqual(reloaded.tables, {})
+        self.assertEqual(sorted(reloaded.table_names()), ["posts/all", "users"])
+        self.assertEqual(reloaded["posts/all"].get(10)["text"], "пост\nс переносом")
+        self.assertEqual(list(reloaded.tables), ["posts/all"])
+
+        # журнал и его вливание: незатронутая таблица не разбирается и не переписывается
+        mtime = os.stat(os.path.join(directory, "users.jsonl")).st_mtime_ns
+        reloaded["posts/all"].insert({"text": "ещё"})
+        reloaded.serialize(directory, journal=True)
+        reloaded.compact(directory, background=False)
+        self.assertFalse(os.path.exists(directory + ".journal"))
+        self.assertEqual(os.stat(os.path.join(directory, "users.jsonl")).st_mtime_ns, mtime)
+        compacted = MemNRDB.load(directory)
+        self.assertEqual(len(compacted["posts/all"]), 2)
+        self.assertEqual(len(compacted["users"]), 2500)
+
+        # таблицы, которых больше нет, удаляются из каталога, чужие файлы -- нет
+        with open(os.path.join(directory, "events.jsonl"), "w") as f:
+            f.write("{}\n")
+        other = MemNRDB()
+        other.init_table("users")
+        other.serialize(directory, fmt="jsonl")
+        self.assertEqual(sorted(os.listdir(directory)), ["__MemNRDB__.json", "events.jsonl", "users.jsonl"])
+        self.assertEqual(MemNRDB.load(directory).table_names(), ["users"])
+
+        # произвольный каталог не считается JSONL-снимком
+        foreign = "test_jsonl_foreign"
+        os.makedirs(foreign, exist_ok=True)
+        self.addCleanup(lambda: shutil.rmtree(foreign, ignore_errors=True))
+        with open(os.path.join(foreign, "events.jsonl"), "w") as f:
+            f.write("{}\n")
+        with self.assertRaises(DBException):
+            other.serialize(foreign)
+        with self.assertRaises(DBException):
+            MemNRDB.load(foreign)
+        other.serialize(foreign, fmt="jsonl")
+        self.assertEqual(sorted(os.listdir(foreign)), ["__MemNRDB__.json", "events.jsonl", "users.jsonl"])
+        other.serialize(foreign)
+        self.assertEqual(MemNRDB.load(foreign).table_names(), ["users"])
+
+    def test_sketches(self):
+        users = Table("users", sketches={"city": "hll"})
+        users.create_sketch("university", kind="cms")
+        users.create_sketch("cost", kind="cms", multi=True)
+        with self.assertRaises(DBIndexError):
+            users.create_sketch("city", kind="bloom")
+        with self.assertRaises(DBIndexError):
+            users.create_sketch("cost", kind="cms")
+        with self.assertRaises(DBIndexError):
+            users.distinct("university")
+
+        users.insert_many([{"city": "city{}".format(i % 3000), "university": 671 if i % 3 else i % 50,
+                            "cost": {"group_a": 1, "group_b" if i % 5 else "group_c": 2}} for i in range(20000)])
+        # сводки строятся лениво -- по уже вставленным записям -- и дальше поддерживаются при вставке
+        self.assertFalse(users.sketches[("city", "hll")].built)
+        self.assertLess(abs(users.distinct("city") - 3000), 150)
+        users.insert_many([{"city": "new{}".format(i)} for i in range(1000)])
+        self.assertLess(abs(users.distinct("city") - 4000), 200)
+
+        self.assertEqual(users.heavy_hitters("university", 1), [(671, 13333)])
+        self.assertEqual(users.heavy_hitters("cost", 3), [("group_a", 20000), ("group_b", 16000), ("group_c", 4000)])
+        # update вычитает старое значение
+        for _id in range(1, 4001):
+            users.update({"id": _id, "cost": {"group_c": 1}})
+        self.assertEqual(users.heavy_hitters("cost", 3), [("group_a", 16000), ("group_b", 12800), ("group_c", 7200)])
+        # поле-словарь изменили на месте до update: вычитается то, что было учтено
+        for _id in range(4001, 4006):
+            cost = users.get(_id)["cost"]
+            cost["g2"] = 1
+            users.update({"id": _id, "cost": cost})
+        cms = users.sketches[("cost", "cms")]
+        self.assertEqual(cms.estimate("g2"), 5)
+        self.assertEqual(cms.estimate("group_a"), 16000)
+        self.assertIn(("g2", 5), users.heavy_hitters("cost", 10))
+
+        stats = users.stats()
+        self.assertEqual(stats["sketches"]["hll:city"]["entries"], 4096)
+        self.assertTrue(stats["sketches"]["cms:cost[]"]["built"])
+
+        # параметры сводок сохраняются вместе с таблицей, сами сводки пересобираются
+        db = MemNRDB()
+        db.tables["users"] = users
+        for file_name in ("test_file.json", "test_sketches.mnrdb"):
+            self.addCleanup(lambda name=file_name: os.path.exists(name) and os.remove(name))
+            db.serialize(file_name)
+            loaded = MemNRDB.load(file_name)["users"]
+            self.assertEqual(set(loaded.sketches), set(users.sketches))
+            self.assertEqual(loaded.heavy_hitters("university", 1), [(671, 13333)])
+
+    def test_views(self):
+        db = MemNRDB()
+        users = db.init_table("users", compact=True)
+        users.insert_many([{"university": 671 if i % 2 else 1, "sex": i % 3, "cost": {"g": i % 10}}
+                           for i in range(1, 101)])
+        U = Query("users")
+        query = (U.university == 671) & (U.sex != 0)
+        view = db.create_view("nsu", query, users="count", cost=("sum", "cost", "g"),
+                              low=("min", "cost", "g"), high=("max", "cost", "g"), avg=("avg", "cost", "g"))
+        self.assertIs(users.view("nsu"), view)
+        with self.assertRaises(DBException):
+            users.create_view("nsu", query)
+        with self.assertRaises(DBException):
+            users.create_view("posts", Query("posts").id == 1)
+
+        def expected():
+            rows = [row for row in users.rows() if query._check(row)]
+            costs = [row["cost"]["g"] for row in rows]
+            return {"users": len(rows), "cost": sum(costs), "low": min(costs, default=None),
+                    "high": max(costs, default=None), "avg": sum(costs) / len(costs) if costs else None}
+
+        self.assertFalse(view.built)
+        self.assertEqual(view.agg(), expected())
+        self.assertEqual(view.ids(), [_id for _id in range(1, 101) if _id % 2 and _id % 3])
+
+        # вставки и изменения поправляют представление без пересчёта
+        users.insert({"university": 671, "sex": 1, "cost": {"g": 100}})
+        users.update({"id": 1, "sex": 0})
+        users.update({"id": 3, "sex": 1})
+        users.update({"id": 5, "cost": {"g": -1}})
+        users.ins_upd({"id": 7, "university": None})
+        self.assertEqual(view.agg(), expected())
+        for _id in range(1, 102, 2):
+            users.update({"id": _id, "cost": {"g": 3}})
+        self.assertEqual(view.agg(), expected())
+        self.assertEqual(sorted(view.ids()), [row["id"] for row in users.rows() if query._check(row)])
+        self.assertIn(3, view)
+        self.assertNotIn(1, view)
+        self.assertEqual([row["id"] for row in view.rows()], view.ids())
+        self.assertEqual(len(view), len(view.ids()))
+
+        # записи, изменённые в обход update, подхватывает refresh
+        users.get(13)["sex"] = 0
+        self.assertIn(13, view)
+        view.refresh()
+        self.assertNotIn(13, view)
+
+        users.update({"id": 11, "cost": {"g": "много"}})
+        with self.assertRaises(DBTypeError):
+            view.agg()
+        users.drop_view("nsu")
+        self.assertEqual(users.views, {})
+
+        # поле-словарь изменили на месте до update: вычитаются значения, учтённые раньше
+        posts = db.init_table("posts")
+        posts.insert_many([{"cost": {"x": x}} for x in (1, 2, 3)])
+        view = db.create_view("all", Query("posts").id > 0, s=("sum", "cost", "x"), m=("min", "cost", "x"))
+        self.assertEqual(view.agg(), {"s": 6, "m": 1})
+        for _id in (1, 2, 3):
+            cost = posts.get(_id)["cost"]
+            cost["x"] = 5
+            posts.update({"id": _id, "cost": cost})
+        self.assertEqual(view.agg(), {"s": 15, "m": 5})
+        posts.update({"id": 1, "cost": {"x": 0}})
+        self.assertEqual(view.agg(), {"s": 10, "m": 0})
+        posts.drop_view("all")
+        view = db.create_view("all", Query("posts").id > 0, m=("min", "cost", "x"))
+        posts.update({"id": 2, "cost": {"x": "давно"}})
+        with self.assertRaises(DBTypeError):
+            view.agg()
+
+        # нечисловые и несравнимые значения (в том числе нехешируемые) учитываются и вычитаются
+        posts.drop_view("all")
+        view = db.create_view("all", Query("posts").id > 0, s=("sum", "cost", "x"), m=("max", "cost", "x"))
+        for x in ("давно", "давно", [1], {"y": 1}):
+            posts.insert({"cost": {"x": x}})
+        for _id in range(4, 8):
+            with self.assertRaises(DBTypeError):
+                view.agg()
+            posts.update({"id": _id, "cost": {"x": _id}})
+        posts.update({"id": 2, "cost": {"x": 2}})
+        self.assertEqual(view.agg(), {"s": 29, "m": 7})
+
+    def test_codecs(self):
+        db = MemNRDB()
+        users = db.init_table("users", intern=["university_name"])
+        users.insert_many([{"university_name": "Новосибирский государственный университет", "faculty": "ФИТ",
+                            "cost": {"group_a": i % 5}} for i in range(2000)])
+        expected = [dict(row) for row in users.rows()]
+
+        def cleanup(name):
+            if os.path.isdir(name):
+                shutil.rmtree(name)
+            for n in (name, name + MemNRDB.JOURNAL_SUFFIX):
+                if os.path.exists(n):
+                    os.remove(n)
+
+        db.serialize("test_codecs.json")
+        plain_size = os.path.getsize("test_codecs.json")
+        self.addCleanup(cleanup, "test_codecs.json")
+        for file_name, codec, magic in (("test_codecs.json.gz", None, b"\x1f\x8b"),
+                                        ("test_codecs.json.bz2", None, b"BZh"),
+                                        ("test_codecs.xz", None, b"\xfd7zXZ"),
+                                        ("test_codecs.db", "gzip", b"\x1f\x8b")):
+            self.addCleanup(cleanup, file_name)
+            db.serialize(file_name, codec=codec)
+            with open(file_name, "rb") as f:
+                self.assertEqual(f.read(len(magic)), magic)
+            self.assertLess(os.path.getsize(file_name), plain_size / 10)
+            loaded = MemNRDB.load(file_name)
+            self.assertEqual([dict(row) for row in loaded["users"].rows()], expected)
+
+            # журнал не сжимается, а вливание журнала сохраняет сжатие снимка
+            loaded["users"].insert({"faculty": "ММФ"})
+            loaded.serialize(file_name, journal=True)
+            loaded.compact(file_name, background=False)
+            with open(file_name, "rb") as f:
+                self.assertEqual(f.read(len(magic)), magic)
+            self.assertEqual(len(MemNRDB.load(file_name)["users"]), 2001)
+
+        self.addCleanup(cleanup, "test_codecs.mnrdb")
+        with self.assertRaises(DBException):
+            db.serialize("test_codecs.mnrdb", codec="gzip")
+        with self.assertRaises(DBException):
+            db.checkpoint_async("test_codecs.mnrdb.gz")
+        with self.assertRaises(DBException):
+            db.serialize("test_codecs.json", codec="zip")
+        self.assertFalse(os.path.exists("test_codecs.mnrdb"))
+
+        # JSONL-снимок сжимает каждый файл таблицы
+        self.addCleanup(cleanup, "test_codecs.jsonl")
+        db.serialize("test_codecs.jsonl", codec="lzma")
+        self.assertEqual(sorted(os.listdir("test_codecs.jsonl")), ["__MemNRDB__.json", "users.jsonl.xz"])
+        self.assertEqual([dict(row) for row in MemNRDB.load("test_codecs.jsonl")["users"].rows()], expected)
+        db.serialize("test_codecs.jsonl")
+        self.assertEqual(sorted(os.listdir("test_codecs.jsonl")), ["__MemNRDB__.json", "users.jsonl"])
+
+        checkpoint = db.checkpoint_async("test_codecs.json.gz")
+        self.assertLess(checkpoint.wait()["bytes"], plain_size / 10)
+        self.assertEqual(len(MemNRDB.load("test_codecs.json.gz")["users"]), 2000)
+
+    def test_bench(self):
+        report = bench_db.run_benchmarks(sizes=[300], repeat=1)
+        names = [result["name"] for result in report["results"]]
+        self.assertIn("insert", names)
+        self.assertIn("query_compound_indexed", names)
+        self.assertIn("load_json", names)
+        # отчёт -- JSON, прогоны с одним seed находят одно и то же
+        report = json.loads(json.dumps(report))
+        self.assertEqual(report["meta"]["sizes"], [300])
+        found = {result["name"]: result.get("found") for result in report["results"]}
+        self.assertEqual(found["query_simple"], found["query_simple_indexed"])
+        self.assertEqual(found["query_compound"], found["query_compound_indexed"])
+
+        slower = copy.deepcopy(report)
+        for result in slower["results"]:
+            result["min"] *= 2 if "insert" == result["name"] else 1
+        regressions = [row["name"] for row in bench_db.compare(report, slower) if row["regression"]]
+        self.assertEqual(regressions, ["insert"])
+
 
 if __name__ == '__main__':
     unittest.main()
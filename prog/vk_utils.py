@@ -152,6 +152,15 @@ class User:
         """
         table.ins_upd(self.row)
 
+    @staticmethod
+    def load_many_to(table: Table, users: Iterable["User"]):
+        """
+        Загружает пачку пользователей в таблицу за один проход
+        :param table: Таблица из БД
+        :param users: пользователи
+        """
+        table.upsert_many(user.row for user in users)
+
     @classmethod
     def load_from(cls, table: Table, _id: int) -> "User":
         """